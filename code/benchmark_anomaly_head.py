@@ -0,0 +1,94 @@
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from model.AnomalyGPT_models import LinearLayer
+from model.openllama import OpenLLAMAPEFTModel
+
+parser = argparse.ArgumentParser("AnomalyGPT anomaly-map head benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--repeat", type=int, default=20)
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+B, L, K = command_args.batch_size, 256, 4
+
+image_decoder = LinearLayer(1280, 1024, K).to(device, dtype).eval()
+# ImageBind out_layers tokens are seq-first with the CLS token in front
+patch_features = [torch.randn(1 + L, B, 1280, device=device, dtype=dtype) for _ in range(K)]
+feats_text_tensor = F.normalize(torch.randn(B, 2, 1024, device=device, dtype=dtype), dim=-1)
+
+# the head methods only depend on their arguments, no weights are needed
+head = OpenLLAMAPEFTModel.__new__(OpenLLAMAPEFTModel)
+
+
+def per_layer():
+    # the head as it was in forward / extract_multimodal_feature before
+    patch_tokens = image_decoder(list(patch_features))
+    anomaly_maps = []
+    for layer in range(len(patch_tokens)):
+        patch_tokens[layer] = patch_tokens[layer] / patch_tokens[layer].norm(dim=-1, keepdim=True)
+        anomaly_map = (100.0 * patch_tokens[layer] @ feats_text_tensor.transpose(-2,-1))
+        B, L, C = anomaly_map.shape
+        H = int(np.sqrt(L))
+        anomaly_map = F.interpolate(anomaly_map.permute(0, 2, 1).view(B, 2, H, H),
+                                    size=224, mode='bilinear', align_corners=True)
+        anomaly_map = torch.softmax(anomaly_map, dim=1)
+        anomaly_maps.append(anomaly_map[:,1,:,:])
+    return torch.mean(torch.stack(anomaly_maps, dim=0), dim=0).unsqueeze(1)
+
+
+def fused(full_resolution):
+    patch_tokens = image_decoder.forward_stacked(patch_features)
+    return head.anomaly_map_head(patch_tokens, feats_text_tensor, full_resolution=full_resolution)[0]
+
+
+def fused_maps_only(full_resolution):
+    # map generation alone, from already projected tokens
+    return head.anomaly_map_head(projected, feats_text_tensor, full_resolution=full_resolution)[0]
+
+
+def per_layer_maps_only():
+    anomaly_maps = []
+    for layer in range(K):
+        tokens = projected[layer] / projected[layer].norm(dim=-1, keepdim=True)
+        anomaly_map = F.interpolate((100.0 * tokens @ feats_text_tensor.transpose(-2,-1)).permute(0, 2, 1).view(B, 2, 16, 16),
+                                    size=224, mode='bilinear', align_corners=True)
+        anomaly_maps.append(torch.softmax(anomaly_map, dim=1)[:,1,:,:])
+    return torch.mean(torch.stack(anomaly_maps, dim=0), dim=0).unsqueeze(1)
+
+
+def timed(fn):
+    with torch.no_grad():
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(command_args.repeat):
+            out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / command_args.repeat * 1000, out
+
+
+with torch.no_grad():
+    projected = image_decoder.forward_stacked(patch_features)
+
+reference_time, reference = timed(per_layer)
+exact_time, exact = timed(lambda: fused(True))
+fast_time, fast = timed(lambda: fused(False))
+maps_reference_time, _ = timed(per_layer_maps_only)
+maps_exact_time, _ = timed(lambda: fused_maps_only(True))
+maps_fast_time, _ = timed(lambda: fused_maps_only(False))
+
+print(f'device: {device}, dtype: {dtype}, batch size: {B}')
+print(f'projection + maps   per-layer: {reference_time:.2f}ms  fused exact: {exact_time:.2f}ms  fused patch-resolution softmax: {fast_time:.2f}ms')
+print(f'maps only           per-layer: {maps_reference_time:.2f}ms  fused exact: {maps_exact_time:.2f}ms  fused patch-resolution softmax: {maps_fast_time:.2f}ms')
+print(f'max |exact - per-layer|: {(exact - reference).abs().max().item():.2e}')
+print(f'max |patch-resolution softmax - per-layer|: {(fast - reference).abs().max().item():.2e}, mean: {(fast - reference).abs().mean().item():.2e}')
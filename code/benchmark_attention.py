@@ -0,0 +1,101 @@
+import time
+import argparse
+import torch
+from transformers import LlamaConfig
+from model.modeling_llama import LlamaForCausalLM, _SDPA_AVAILABLE
+
+parser = argparse.ArgumentParser("AnomalyGPT llama attention backend benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=4)
+parser.add_argument("--seq_lens", type=int, nargs='+', default=[128, 256, 512, 1024])
+parser.add_argument("--hidden_size", type=int, default=512)
+parser.add_argument("--num_layers", type=int, default=4)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+assert _SDPA_AVAILABLE, 'scaled_dot_product_attention needs torch>=2.0'
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+config = LlamaConfig(
+    vocab_size=32001,
+    hidden_size=command_args.hidden_size,
+    intermediate_size=command_args.hidden_size * 4,
+    num_hidden_layers=command_args.num_layers,
+    num_attention_heads=command_args.hidden_size // 64,
+    pad_token_id=0,
+)
+model = LlamaForCausalLM(config).to(device, dtype).eval()
+B = command_args.batch_size
+
+
+def run(backend, input_ids, attention_mask=None, past_key_values=None, position_ids=None):
+    model.config.attention_backend = backend
+    with torch.no_grad():
+        return model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                     past_key_values=past_key_values, use_cache=True, return_dict=True)
+
+
+def max_diff(a, b, valid=None):
+    diff = (a.float() - b.float()).abs()
+    return (diff[valid] if valid is not None else diff).max().item()
+
+
+# parity: no padding, left padding, and decode steps on top of a cache
+S = 64
+input_ids = torch.randint(3, config.vocab_size, (B, S), device=device)
+eager, sdpa = run('eager', input_ids), run('sdpa', input_ids)
+print(f'[!] no padding, max |sdpa - eager| logits: {max_diff(sdpa.logits, eager.logits):.2e}')
+
+attention_mask = torch.ones(B, S, dtype=torch.long, device=device)
+for i in range(B):
+    attention_mask[i, :i * 7] = 0
+position_ids = (attention_mask.cumsum(-1) - 1).masked_fill(attention_mask == 0, 1)
+eager = run('eager', input_ids, attention_mask, position_ids=position_ids)
+sdpa = run('sdpa', input_ids, attention_mask, position_ids=position_ids)
+valid = attention_mask.bool()
+print(f'[!] left padding, max |sdpa - eager| logits on real tokens: {max_diff(sdpa.logits, eager.logits, valid):.2e}')
+print(f'[!] left padding, sdpa logits finite: {torch.isfinite(sdpa.logits).all().item()}')
+
+next_ids = eager.logits[:, -1:].argmax(dim=-1)
+step_mask = torch.cat([attention_mask, attention_mask.new_ones(B, 1)], dim=1)
+step_positions = position_ids[:, -1:] + 1
+eager_step = run('eager', next_ids, step_mask, eager.past_key_values, step_positions)
+sdpa_step = run('sdpa', next_ids, step_mask, sdpa.past_key_values, step_positions)
+print(f'[!] decode step, max |sdpa - eager| logits: {max_diff(sdpa_step.logits, eager_step.logits):.2e}')
+
+model.config.attention_backend = 'sdpa'
+with torch.no_grad():
+    output_attentions = model(input_ids=input_ids, output_attentions=True, return_dict=True).attentions
+assert output_attentions[0] is not None, 'output_attentions should keep the eager path'
+
+
+def timed(backend, input_ids, attention_mask):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    run(backend, input_ids, attention_mask)
+    start = time.time()
+    for _ in range(command_args.repeat):
+        run(backend, input_ids, attention_mask)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return (time.time() - start) / command_args.repeat * 1000, peak
+
+
+print(f'device: {device}, dtype: {dtype}, batch size: {B}, layers: {config.num_hidden_layers}, hidden: {config.hidden_size}')
+for seq_len in command_args.seq_lens:
+    input_ids = torch.randint(3, config.vocab_size, (B, seq_len), device=device)
+    attention_mask = torch.ones(B, seq_len, dtype=torch.long, device=device)
+    attention_mask[0, :seq_len // 4] = 0
+    for padded in [False, True]:
+        mask = attention_mask if padded else None
+        eager_time, eager_peak = timed('eager', input_ids, mask)
+        sdpa_time, sdpa_peak = timed('sdpa', input_ids, mask)
+        memory = f'  peak memory eager {eager_peak:.0f}MB sdpa {sdpa_peak:.0f}MB' if device.type == 'cuda' else ''
+        print(f'prefill {seq_len:5d} tokens, {"left padded" if padded else "no padding "}: '
+              f'eager {eager_time:8.2f}ms  sdpa {sdpa_time:8.2f}ms{memory}')
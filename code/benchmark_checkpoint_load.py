@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import resource
+import argparse
+import threading
+import subprocess
+import torch
+import torch.nn as nn
+from model.checkpoint import MappedCheckpoint, load_checkpoint
+
+parser = argparse.ArgumentParser("AnomalyGPT checkpoint loading benchmark", add_help=True)
+parser.add_argument("--checkpoint_dir", type=str, default='./ckpt/benchmark_checkpoint')
+parser.add_argument("--size_mb", type=int, default=1024, help="size of the synthetic fp32 checkpoint")
+parser.add_argument("--layers", type=int, default=16)
+parser.add_argument("--device", type=str, default='cpu')
+parser.add_argument("--half", action='store_true', help="load into a fp16 model")
+parser.add_argument("--mode", type=str, default=None, choices=['torch_load', 'mmap'], help="internal, one loader per process")
+
+command_args = parser.parse_args()
+
+
+def build_model():
+    # square linears adding up to about size_mb of fp32 weights
+    dim = int((command_args.size_mb * 2 ** 20 / 4 / command_args.layers) ** 0.5)
+    return nn.Sequential(*[nn.Linear(dim, dim) for _ in range(command_args.layers)])
+
+
+def rss_mb(field):
+    # linux only: VmRSS is the current, VmHWM the peak resident memory
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def reset_peak_rss():
+    # so that VmHWM only covers the loading, not building the model
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class PeakSampler:
+    def __init__(self, field, interval=0.005):
+        self.field, self.interval, self.peak = field, interval, rss_mb(field)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss_mb(self.field))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return max(self.peak, rss_mb(self.field))
+
+
+checkpoint_path = os.path.join(command_args.checkpoint_dir, f'synthetic_{command_args.size_mb}mb.pt')
+
+if command_args.mode is not None:
+    model = build_model()
+    dtype = torch.float16 if command_args.half else torch.float32
+    model = model.to(command_args.device, dtype)
+    base_rss, base_anon = rss_mb('VmRSS'), rss_mb('RssAnon')
+    reset_peak_rss()
+    sampler = PeakSampler('RssAnon')
+    start = time.time()
+    if command_args.mode == 'torch_load':
+        # what the test scripts did before
+        state_dict = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+        model.load_state_dict(state_dict, strict=False)
+        del state_dict
+    else:
+        load_checkpoint(model, checkpoint_path, verbose=False)
+    if command_args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    load_time = time.time() - start
+    peak_rss, peak_anon = rss_mb('VmHWM'), sampler.stop()
+    # mapped checkpoint pages count in RSS but are clean page cache, the anonymous memory is what the loader holds
+    print(f'{command_args.mode:10s} load: {load_time:.2f}s, peak RSS {peak_rss - base_rss:+.0f}MB, '
+          f'peak anonymous memory {peak_anon - base_anon:+.0f}MB over the model')
+    sys.exit(0)
+
+if not os.path.isfile(checkpoint_path):
+    os.makedirs(command_args.checkpoint_dir, exist_ok=True)
+    torch.save(build_model().state_dict(), checkpoint_path)
+
+start = time.time()
+checkpoint = MappedCheckpoint(checkpoint_path)
+print(f'[!] conversion (first run only): {time.time() - start:.2f}s')
+
+# parity: every tensor comes back bit-identical
+reference = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+assert all(torch.equal(reference[key], checkpoint[key]) for key in reference), 'mapped tensors differ from torch.load'
+print(f'[!] {len(reference)} mapped tensors equal torch.load')
+del reference
+
+print(f'checkpoint: {os.path.getsize(checkpoint_path) / 2 ** 20:.0f}MB, device: {command_args.device}, half: {command_args.half}')
+for mode in ['torch_load', 'mmap']:
+    # a fresh process per loader, the peak RSS is per process
+    arguments = [sys.executable, __file__, '--mode', mode, '--checkpoint_dir', command_args.checkpoint_dir,
+                 '--size_mb', str(command_args.size_mb), '--layers', str(command_args.layers), '--device', command_args.device]
+    if command_args.half:
+        arguments.append('--half')
+    subprocess.run(arguments, check=True)
@@ -0,0 +1,115 @@
+import time
+import argparse
+import torch
+from transformers import LlamaConfig, StoppingCriteriaList
+from model.modeling_llama import LlamaForCausalLM
+from model.openllama import StoppingCriteriaSub
+from model.decoding import decode_batch
+
+parser = argparse.ArgumentParser("AnomalyGPT batched decode loop benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--prompt_len", type=int, default=64)
+parser.add_argument("--max_new_tokens", type=int, default=128)
+parser.add_argument("--sync_every", type=int, default=8)
+parser.add_argument("--hidden_size", type=int, default=256)
+parser.add_argument("--num_layers", type=int, default=4)
+parser.add_argument("--stop_id", type=int, default=2277)
+parser.add_argument("--stop_scale", type=float, default=3.0, help="scales the stop token row of lm_head so rows finish early")
+parser.add_argument("--eos_scale", type=float, default=3.0, help="the same for eos, some rows end with it instead of the stop token")
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+# a small random llama, the loop cost does not depend on the weights
+config = LlamaConfig(
+    vocab_size=32001,
+    hidden_size=command_args.hidden_size,
+    intermediate_size=command_args.hidden_size * 4,
+    num_hidden_layers=command_args.num_layers,
+    num_attention_heads=command_args.hidden_size // 64,
+    pad_token_id=0,
+)
+model = LlamaForCausalLM(config).to(device, dtype).eval()
+embed_tokens = model.get_input_embeddings()
+
+B, S = command_args.batch_size, command_args.prompt_len
+# left-padded prompts of different lengths, like prepare_generation_embedding_batch builds
+prompt_lengths = torch.randint(S // 2, S + 1, (B,))
+attention_mask = (torch.arange(S).unsqueeze(0) >= (S - prompt_lengths).unsqueeze(1)).long().to(device)
+input_ids = torch.randint(3, config.vocab_size, (B, S), device=device)
+with torch.no_grad():
+    input_embeds = embed_tokens(input_ids)
+# make the stop token likely after a while so rows finish at different steps
+with torch.no_grad():
+    model.lm_head.weight[command_args.stop_id] *= command_args.stop_scale
+    model.lm_head.weight[config.eos_token_id] *= command_args.eos_scale
+
+
+def hf_generate(do_sample):
+    stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(stops=[command_args.stop_id], encounters=1)])
+    outputs = model.generate(
+        inputs_embeds=input_embeds,
+        attention_mask=attention_mask,
+        max_new_tokens=command_args.max_new_tokens,
+        top_p=0.01,
+        temperature=1.0,
+        do_sample=do_sample,
+        use_cache=True,
+        pad_token_id=0,
+        stopping_criteria=stopping_criteria,
+    )
+    responses = []
+    for output_ids in outputs.tolist():
+        # generate starts from bos when only inputs_embeds are given
+        output_ids = output_ids[1:]
+        # generate pads the rows that ended with eos, cut at the first stop token or eos
+        ends = [output_ids.index(token) + 1 for token in [command_args.stop_id, config.eos_token_id] if token in output_ids]
+        responses.append(output_ids[:min(ends)] if ends else output_ids)
+    return responses
+
+
+def lean_decode(do_sample, sync_every=command_args.sync_every):
+    return decode_batch(
+        model, embed_tokens, input_embeds, attention_mask,
+        max_new_tokens=command_args.max_new_tokens,
+        top_p=0.01,
+        temperature=1.0,
+        stop_sequences=((command_args.stop_id,),),
+        pad_token_id=0,
+        eos_token_id=config.eos_token_id,
+        sync_every=sync_every,
+        do_sample=do_sample,
+    )
+
+
+def timed(fn):
+    with torch.no_grad():
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        out = fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return time.time() - start, out
+
+
+with torch.no_grad():
+    reference = hf_generate(do_sample=False)
+    for sync_every in [1, command_args.sync_every]:
+        assert lean_decode(do_sample=False, sync_every=sync_every) == reference, f'greedy mismatch, sync_every={sync_every}'
+eos_rows = sum(ids[-1] == config.eos_token_id for ids in reference)
+print(f'[!] greedy decode_batch matches generate, response lengths: {[len(ids) for ids in reference]}, {eos_rows} rows end with eos')
+
+hf_time, hf_out = timed(lambda: hf_generate(do_sample=True))
+lean_time, lean_out = timed(lambda: lean_decode(do_sample=True))
+hf_tokens, lean_tokens = sum(len(ids) for ids in hf_out), sum(len(ids) for ids in lean_out)
+
+print(f'device: {device}, dtype: {dtype}, batch size: {B}, sync every: {command_args.sync_every}')
+print(f'generate:     {hf_tokens} tokens, {hf_tokens / hf_time:.1f} tokens/s')
+print(f'decode_batch: {lean_tokens} tokens, {lean_tokens / lean_time:.1f} tokens/s')
@@ -0,0 +1,105 @@
+import os
+import time
+from model.openllama import OpenLLAMAPEFTModel
+from model.checkpoint import load_checkpoint
+import torch
+import argparse
+
+parser = argparse.ArgumentParser("AnomalyGPT batched generation benchmark", add_help=True)
+parser.add_argument("--data_root", type=str, default="../data/mvtec_anomaly_detection")
+parser.add_argument("--class_name", type=str, default="bottle")
+parser.add_argument("--num_images", type=int, default=32)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--k_shot", type=int, default=0)
+parser.add_argument("--max_tgt_len", type=int, default=512)
+
+command_args = parser.parse_args()
+
+args = {
+    'model': 'openllama_peft',
+    'imagebind_ckpt_path': '../pretrained_ckpt/imagebind_ckpt/imagebind_huge.pth',
+    'vicuna_ckpt_path': '../pretrained_ckpt/vicuna_ckpt/7b_v0',
+    'anomalygpt_ckpt_path': './ckpt/train_mvtec/pytorch_model.pt',
+    'delta_ckpt_path': '../pretrained_ckpt/pandagpt_ckpt/7b/pytorch_model.pt',
+    'stage': 2,
+    'max_tgt_len': 128,
+    'lora_r': 32,
+    'lora_alpha': 32,
+    'lora_dropout': 0.1,
+}
+
+model = OpenLLAMAPEFTModel(**args)
+model = model.eval().half().cuda()
+# copied from the memory-mapped checkpoints straight into the fp16 cuda weights
+load_checkpoint(model, args['delta_ckpt_path'])
+load_checkpoint(model, args['anomalygpt_ckpt_path'])
+
+print(f'[!] init the 7b model over ...')
+
+class_root = os.path.join(command_args.data_root, command_args.class_name)
+image_paths = []
+for root, dirs, files in sorted(os.walk(os.path.join(class_root, 'test'))):
+    for file in sorted(files):
+        if file.endswith('.png'):
+            image_paths.append(os.path.join(root, file))
+image_paths = image_paths[:command_args.num_images]
+
+good_dir = os.path.join(class_root, 'train', 'good')
+normal_img_paths = [os.path.join(good_dir, file) for file in sorted(os.listdir(good_dir))[:command_args.k_shot]]
+
+prompt = f"This is a photo of a {command_args.class_name} for anomaly detection. Is there any anomaly in the image?"
+
+
+def run_loop():
+    for image_path in image_paths:
+        model.generate({
+            'prompt': prompt,
+            'image_paths': [image_path],
+            'normal_img_paths': normal_img_paths,
+            'audio_paths': [],
+            'video_paths': [],
+            'thermal_paths': [],
+            'top_p': 0.01,
+            'temperature': 1.0,
+            'max_tgt_len': command_args.max_tgt_len,
+            'modality_embeds': []
+        })
+
+
+def run_batch():
+    for start in range(0, len(image_paths), command_args.batch_size):
+        batch_paths = image_paths[start:start + command_args.batch_size]
+        model.generate_batch({
+            'prompt': prompt,
+            'image_paths': batch_paths,
+            'normal_img_paths': [normal_img_paths] * len(batch_paths),
+            'top_p': 0.01,
+            'temperature': 1.0,
+            'max_tgt_len': command_args.max_tgt_len,
+        })
+
+
+def timed(fn):
+    torch.cuda.synchronize()
+    start = time.time()
+    fn()
+    torch.cuda.synchronize()
+    return time.time() - start
+
+
+# warm up cuda kernels and the allocator before measuring
+model.generate_batch({
+    'prompt': prompt,
+    'image_paths': image_paths[:2],
+    'top_p': 0.01,
+    'temperature': 1.0,
+    'max_tgt_len': 8,
+})
+
+loop_time = timed(run_loop)
+batch_time = timed(run_batch)
+
+print(f'images: {len(image_paths)}, batch size: {command_args.batch_size}, k_shot: {command_args.k_shot}')
+print(f'per-image loop: {len(image_paths) / loop_time:.2f} images/s')
+print(f'generate_batch: {len(image_paths) / batch_time:.2f} images/s')
+print(f'speedup: {loop_time / batch_time:.2f}x')
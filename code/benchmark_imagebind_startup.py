@@ -0,0 +1,32 @@
+import time
+import resource
+import argparse
+import torch
+from model.ImageBind.models import imagebind_model
+
+parser = argparse.ArgumentParser("AnomalyGPT ImageBind modality-selective startup benchmark", add_help=True)
+# run once per modality set, the peak resident memory is per process
+parser.add_argument("--modalities", type=str, nargs='+', default=None, help="e.g. vision text, all modalities by default")
+parser.add_argument("--imagebind_ckpt_path", type=str, default=None, help="also time loading the checkpoint")
+
+command_args = parser.parse_args()
+
+start = time.time()
+model, _ = imagebind_model.imagebind_huge({'imagebind_modalities': command_args.modalities})
+build_time = time.time() - start
+
+load_time, dropped = None, 0
+if command_args.imagebind_ckpt_path:
+    start = time.time()
+    dropped = imagebind_model.load_imagebind_checkpoint(model, command_args.imagebind_ckpt_path)
+    load_time = time.time() - start
+
+num_params = sum(param.numel() for param in model.parameters())
+# ru_maxrss is in KB on linux
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 20
+
+print(f'modalities: {model.modalities}')
+print(f'parameters: {num_params / 1e6:.1f}M ({num_params * 4 / 2 ** 30:.2f}GB in fp32), build: {build_time:.1f}s')
+if load_time is not None:
+    print(f'checkpoint load: {load_time:.1f}s, {dropped} tensors of other modalities skipped')
+print(f'peak resident memory: {peak_rss:.2f}GB')
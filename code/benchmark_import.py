@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import argparse
+
+parser = argparse.ArgumentParser("AnomalyGPT import / first-request latency benchmark", add_help=True)
+parser.add_argument("--class_name", type=str, default="bottle")
+parser.add_argument("--repeat", type=int, default=3)
+
+command_args = parser.parse_args()
+
+# every measurement runs in a fresh interpreter so that nothing is already imported or cached
+IMPORT_SNIPPET = '''
+import time
+start = time.time()
+import model.openllama
+print(time.time() - start)
+'''
+
+FIRST_REQUEST_SNIPPET = '''
+import time
+import model.openllama as openllama
+start = time.time()
+sentences = openllama.prompt_sentences[{class_name!r}]
+first = time.time() - start
+start = time.time()
+sentences = openllama.prompt_sentences[{class_name!r}]
+print(first, time.time() - start)
+'''
+
+
+def run(snippet):
+    output = subprocess.check_output([sys.executable, '-c', snippet], stderr=subprocess.DEVNULL)
+    return [float(value) for value in output.decode().strip().splitlines()[-1].split()]
+
+
+import_times = [run(IMPORT_SNIPPET)[0] for _ in range(command_args.repeat)]
+request_times = [run(FIRST_REQUEST_SNIPPET.format(class_name=command_args.class_name)) for _ in range(command_args.repeat)]
+
+print(f'import model.openllama: {min(import_times):.3f}s (best of {command_args.repeat})')
+print(f'first prompt tokenization of {command_args.class_name!r}: {min(t[0] for t in request_times) * 1000:.1f}ms')
+print(f'memoized prompt tokenization of {command_args.class_name!r}: {min(t[1] for t in request_times) * 1000:.3f}ms')
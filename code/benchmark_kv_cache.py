@@ -0,0 +1,78 @@
+import time
+import argparse
+import torch
+from transformers import LlamaConfig
+from model.modeling_llama import LlamaForCausalLM, StaticKVCache
+from model.decoding import decode_batch
+
+parser = argparse.ArgumentParser("AnomalyGPT static KV cache benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=4)
+parser.add_argument("--prompt_len", type=int, default=128)
+parser.add_argument("--max_new_tokens", type=int, default=512)
+parser.add_argument("--hidden_size", type=int, default=512)
+parser.add_argument("--num_layers", type=int, default=8)
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+config = LlamaConfig(
+    vocab_size=32001,
+    hidden_size=command_args.hidden_size,
+    intermediate_size=command_args.hidden_size * 4,
+    num_hidden_layers=command_args.num_layers,
+    num_attention_heads=command_args.hidden_size // 64,
+    pad_token_id=0,
+)
+model = LlamaForCausalLM(config).to(device, dtype).eval()
+embed_tokens = model.get_input_embeddings()
+
+B, S, T = command_args.batch_size, command_args.prompt_len, command_args.max_new_tokens
+input_ids = torch.randint(3, config.vocab_size, (B, S), device=device)
+attention_mask = torch.ones(B, S, dtype=torch.long, device=device)
+with torch.no_grad():
+    input_embeds = embed_tokens(input_ids)
+
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def greedy(static_cache):
+    '''greedy decode, returns the logits of every step and the latency of every decode step'''
+    past_key_values = StaticKVCache.allocate(config, B, S + T, dtype, device) if static_cache else None
+    outputs = model(inputs_embeds=input_embeds, past_key_values=past_key_values, use_cache=True, return_dict=True)
+    all_logits, step_times = [outputs.logits[:, -1]], []
+    for _ in range(T - 1):
+        next_tokens = all_logits[-1].argmax(dim=-1, keepdim=True)
+        synchronize()
+        start = time.time()
+        outputs = model(input_ids=next_tokens, past_key_values=outputs.past_key_values, use_cache=True, return_dict=True)
+        synchronize()
+        step_times.append(time.time() - start)
+        all_logits.append(outputs.logits[:, -1])
+    return torch.stack(all_logits, dim=1), step_times
+
+
+greedy(static_cache=False) # warm up
+dynamic_logits, dynamic_times = greedy(static_cache=False)
+static_logits, static_times = greedy(static_cache=True)
+print(f'[!] max |static - dynamic| logits: {(static_logits - dynamic_logits).abs().max().item():.2e}')
+
+with torch.no_grad():
+    dynamic_ids = decode_batch(model, embed_tokens, input_embeds, attention_mask, 64, do_sample=False)
+    static_ids = decode_batch(model, embed_tokens, input_embeds, attention_mask, 64, do_sample=False, static_cache=True)
+assert dynamic_ids == static_ids, 'decode_batch differs with the static cache'
+print(f'[!] decode_batch gives the same tokens with the static cache')
+
+print(f'device: {device}, dtype: {dtype}, batch size: {B}, prompt: {S}, new tokens: {T}')
+window = max(1, T // 8)
+for name, times in [('torch.cat cache', dynamic_times), ('static cache', static_times)]:
+    first, last = sum(times[:window]) / window * 1000, sum(times[-window:]) / window * 1000
+    print(f'{name:16s} decode step: first {window} steps {first:.2f}ms, last {window} steps {last:.2f}ms, total {sum(times):.2f}s')
@@ -0,0 +1,108 @@
+import copy
+import time
+import argparse
+import torch
+from torch import nn
+from transformers import LlamaConfig
+from peft import LoraConfig, TaskType, get_peft_model
+from model.modeling_llama import LlamaForCausalLM
+from model.decoding import decode_batch
+from model.lora_merge import lora_layers, merge_lora, unmerge_lora, unload_lora
+
+parser = argparse.ArgumentParser("AnomalyGPT LoRA merge benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--prompt_len", type=int, default=64)
+parser.add_argument("--max_new_tokens", type=int, default=64)
+parser.add_argument("--hidden_size", type=int, default=512)
+parser.add_argument("--num_layers", type=int, default=4)
+parser.add_argument("--lora_r", type=int, default=32)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+# a small random llama with the AnomalyGPT LoRA layout, B is random so the adapters change the outputs
+config = LlamaConfig(
+    vocab_size=32001,
+    hidden_size=command_args.hidden_size,
+    intermediate_size=command_args.hidden_size * 4,
+    num_hidden_layers=command_args.num_layers,
+    num_attention_heads=command_args.hidden_size // 64,
+    pad_token_id=0,
+)
+peft_config = LoraConfig(
+    task_type=TaskType.CAUSAL_LM,
+    inference_mode=False,
+    r=command_args.lora_r,
+    lora_alpha=32,
+    lora_dropout=0.1,
+    target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj']
+)
+adapter_model = get_peft_model(LlamaForCausalLM(config), peft_config)
+with torch.no_grad():
+    for _, layer in lora_layers(adapter_model):
+        nn.init.normal_(layer.lora_B['default'].weight, std=0.02)
+adapter_model = adapter_model.to(device, dtype).eval()
+base_weights = {name: layer.weight.detach().clone() for name, layer in lora_layers(adapter_model)}
+
+merged_model = copy.deepcopy(adapter_model)
+merge_lora(merged_model)
+unloaded_model = unload_lora(copy.deepcopy(adapter_model))
+
+B, S = command_args.batch_size, command_args.prompt_len
+input_ids = torch.randint(3, config.vocab_size, (B, S), device=device)
+attention_mask = torch.ones(B, S, dtype=torch.long, device=device)
+
+
+def decode(model):
+    embed_tokens = model.get_input_embeddings()
+    return decode_batch(
+        model, embed_tokens, embed_tokens(input_ids), attention_mask,
+        max_new_tokens=command_args.max_new_tokens,
+        stop_sequences=((-1,),), # never stops, every row decodes max_new_tokens
+        do_sample=False,
+    )
+
+
+with torch.no_grad():
+    reference = adapter_model(input_ids=input_ids).logits.float()
+    for name, model in [('merged', merged_model), ('unloaded', unloaded_model)]:
+        diff = (model(input_ids=input_ids).logits.float() - reference).abs().max().item()
+        print(f'[!] {name} vs adapter logits max abs diff: {diff:.2e}')
+
+    models = [('adapter', adapter_model), ('merged', merged_model), ('unloaded', unloaded_model)]
+    reference_ids = decode(adapter_model)
+    times = {name: [] for name, _ in models}
+    outputs = {}
+    # the modes take turns so that clock or load drift does not favour one of them
+    for _ in range(command_args.repeat):
+        for name, model in models:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            outputs[name] = decode(model)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times[name].append(time.time() - start)
+    results = {}
+    for name, _ in models:
+        tokens = sum(len(ids) for ids in outputs[name])
+        results[name] = tokens / min(times[name])
+        same = outputs[name] == reference_ids
+        print(f'{name:9s} {tokens} tokens, {results[name]:.1f} tokens/s, greedy tokens match adapter: {same}')
+    print(f'unloaded / adapter tokens/s: {results["unloaded"] / results["adapter"]:.2f}x')
+
+    # training falls back to the adapters: unmerge restores the base weights
+    unmerge_lora(merged_model)
+    error = max((layer.weight - base_weights[name]).abs().max().item() for name, layer in lora_layers(merged_model))
+    before = {name: layer.weight.detach().clone() for name, layer in lora_layers(merged_model)}
+    merge_lora(merged_model, keep_base=True)
+    unmerge_lora(merged_model)
+    exact = all(torch.equal(layer.weight, before[name]) for name, layer in lora_layers(merged_model))
+    print(f'[!] unmerge max abs weight error: {error:.2e}, with keep_base bit-exact: {exact}')
+print(f'device: {device}, dtype: {dtype}, batch size: {B}, prompt: {S}, new tokens: {command_args.max_new_tokens}')
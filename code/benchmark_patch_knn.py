@@ -0,0 +1,62 @@
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from model.patch_knn import max_cosine_similarity, build_patch_index
+
+parser = argparse.ArgumentParser("AnomalyGPT few-shot patch matching benchmark (cpu)", add_help=True)
+parser.add_argument("--bank_images", type=int, nargs='+', default=[1, 4, 16, 64, 256])
+parser.add_argument("--num_queries", type=int, default=1)
+parser.add_argument("--num_layers", type=int, default=4)
+parser.add_argument("--chunk_size", type=int, default=4096)
+parser.add_argument("--naive_limit", type=int, default=16, help="largest bank (in images) still run with the broadcast F.cosine_similarity")
+parser.add_argument("--ivfpq", action='store_true', help="also build and time an IVF-PQ index")
+parser.add_argument("--repeat", type=int, default=3)
+
+command_args = parser.parse_args()
+
+torch.manual_seed(0)
+L, C = 256, 1280
+
+
+def naive(query, bank):
+    # what few_shot_anomaly_map did before: a bsz x L x N x C broadcast per layer
+    sim = F.cosine_similarity(query.unsqueeze(2), bank.reshape(1, 1, -1, C), dim=-1)
+    return sim.max(dim=-1)[0]
+
+
+def timed(fn):
+    times = []
+    for _ in range(command_args.repeat):
+        start = time.time()
+        out = fn()
+        times.append(time.time() - start)
+    return min(times), out
+
+
+print(f'{"bank":>6} {"patches":>8} {"naive":>10} {"chunked":>10} {"fp16":>10} {"ivfpq":>10} {"broadcast MB":>13} {"chunk MB":>9} {"max |diff|":>11} {"ivfpq err":>10}')
+for bank_images in command_args.bank_images:
+    queries = [torch.randn(command_args.num_queries, L, C) for _ in range(command_args.num_layers)]
+    # normal patches are the query patches plus noise so that the nearest neighbour is meaningful
+    banks = [torch.cat([q.reshape(-1, C)[torch.randint(0, q.shape[0] * L, (L * bank_images,))] + 0.5 * torch.randn(L * bank_images, C)]) for q in queries]
+    N = banks[0].shape[0]
+
+    chunked_time, chunked = timed(lambda: [max_cosine_similarity(q, b, command_args.chunk_size) for q, b in zip(queries, banks)])
+    fp16_indexes = [build_patch_index(b, 'fp16', chunk_size=command_args.chunk_size) for b in banks]
+    fp16_time, _ = timed(lambda: [index.search(q) for q, index in zip(queries, fp16_indexes)])
+
+    naive_time, diff = float('nan'), float('nan')
+    if bank_images <= command_args.naive_limit:
+        naive_time, reference = timed(lambda: [naive(q, b) for q, b in zip(queries, banks)])
+        diff = max((a - b).abs().max().item() for a, b in zip(chunked, reference))
+
+    ivfpq_time, ivfpq_err = float('nan'), float('nan')
+    if command_args.ivfpq:
+        ivfpq_indexes = [build_patch_index(b, 'ivfpq') for b in banks]
+        ivfpq_time, approx = timed(lambda: [index.search(q) for q, index in zip(queries, ivfpq_indexes)])
+        ivfpq_err = max((a - b).abs().mean().item() for a, b in zip(chunked, approx))
+
+    broadcast_mb = command_args.num_queries * L * N * C * 4 / 2 ** 20
+    chunk_mb = command_args.num_queries * L * min(N, command_args.chunk_size) * 4 / 2 ** 20
+    print(f'{bank_images:>6} {N:>8} {naive_time * 1000:>8.1f}ms {chunked_time * 1000:>8.1f}ms {fp16_time * 1000:>8.1f}ms {ivfpq_time * 1000:>8.1f}ms '
+          f'{broadcast_mb:>13.0f} {chunk_mb:>9.1f} {diff:>11.2e} {ivfpq_err:>10.4f}')
@@ -0,0 +1,78 @@
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from model.AnomalyGPT_models import PromptLearner, native_from_prompt_learner
+
+# PromptLearner on the 224 x 224 upsampled anomaly map against NativePromptLearner on the 16 x 16 patch-level map,
+# given either directly or as the same 224 x 224 map (reduced exactly, see NativePromptLearner.native_map)
+parser = argparse.ArgumentParser("AnomalyGPT prompt learner benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--repeat", type=int, default=10)
+parser.add_argument("--threads", type=int, default=None)
+parser.add_argument("--device", type=str, default='cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+if command_args.threads:
+    torch.set_num_threads(command_args.threads)
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+prompt_learner = PromptLearner(1, 4096).to(device, dtype).eval()
+native = native_from_prompt_learner(prompt_learner).eval()
+maps16 = torch.rand(command_args.batch_size, 1, 16, 16, device=device, dtype=dtype)
+maps224 = F.interpolate(maps16, size=224, mode='bilinear', align_corners=True)
+variants = [
+    ('PromptLearner, 224 x 224 map', prompt_learner, maps224),
+    ('NativePromptLearner, 224 x 224 map', native, maps224),
+    ('NativePromptLearner, 16 x 16 map', native, maps16),
+]
+
+
+def conv_macs(module, maps):
+    '''multiply-accumulates of the convolutions, plus the two matmuls of the 224 -> 16 reduction'''
+    macs = []
+    hooks = [m.register_forward_hook(lambda m, i, o: macs.append(o.numel() * m.in_channels // m.groups * m.kernel_size[0] * m.kernel_size[1]))
+             for m in module.modules() if isinstance(m, nn.Conv2d)]
+    with torch.no_grad():
+        module(maps)
+    for hook in hooks:
+        hook.remove()
+    B, _, H, _ = maps.shape
+    if isinstance(module, type(native)) and H != module.map_size:
+        macs.append(B * (module.map_size * H * H + module.map_size ** 2 * H))
+    return sum(macs)
+
+
+def timed(module, maps):
+    with torch.no_grad():
+        module(maps)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(command_args.repeat):
+            module(maps)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start) / command_args.repeat * 1000
+
+
+# the variants take turns so that load drift does not favour one of them
+times = {name: [] for name, _, _ in variants}
+for _ in range(3):
+    for name, module, maps in variants:
+        times[name].append(timed(module, maps))
+
+with torch.no_grad():
+    same_input = (native(maps224) - native(maps16)).abs().max().item()
+print(f'device: {device}, dtype: {dtype}, batch size: {command_args.batch_size}, threads: {torch.get_num_threads()}')
+reference = min(times[variants[0][0]])
+for name, module, maps in variants:
+    params = sum(p.numel() for p in module.parameters())
+    print(f'{name}: {conv_macs(module, maps) / 1e9:.3f} GMACs, {params / 1e6:.2f}M parameters, '
+          f'{min(times[name]):.2f}ms, speedup: {reference / min(times[name]):.2f}x')
+print(f'[!] max |native(224 x 224 map) - native(16 x 16 map)|: {same_input:.2e}')
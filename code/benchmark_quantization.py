@@ -0,0 +1,92 @@
+import copy
+import time
+import tempfile
+import argparse
+import torch
+from transformers import LlamaConfig
+from model.modeling_llama import LlamaForCausalLM
+from model.decoding import decode_batch
+from model.quantization import quantize_llama, quantized_size, save_quantized_llama, load_quantized_llama
+
+parser = argparse.ArgumentParser("AnomalyGPT int8 cpu language model benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--prompt_len", type=int, default=128)
+parser.add_argument("--max_new_tokens", type=int, default=32)
+parser.add_argument("--hidden_size", type=int, default=1024)
+parser.add_argument("--num_layers", type=int, default=4)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--threads", type=int, default=None)
+parser.add_argument("--lm_head", action='store_true', help="quantize lm_head as well")
+
+command_args = parser.parse_args()
+if command_args.threads is not None:
+    torch.set_num_threads(command_args.threads)
+
+torch.manual_seed(0)
+# a random llama with the 7B layout (intermediate size 11008 / 4096), scaled down
+config = LlamaConfig(
+    vocab_size=32001,
+    hidden_size=command_args.hidden_size,
+    intermediate_size=command_args.hidden_size * 11008 // 4096,
+    num_hidden_layers=command_args.num_layers,
+    num_attention_heads=command_args.hidden_size // 128,
+    pad_token_id=0,
+)
+fp32_model = LlamaForCausalLM(config).eval()
+int8_model = quantize_llama(copy.deepcopy(fp32_model), include_lm_head=command_args.lm_head)
+
+B, S = command_args.batch_size, command_args.prompt_len
+input_ids = torch.randint(3, config.vocab_size, (B, S))
+attention_mask = torch.ones(B, S, dtype=torch.long)
+
+
+def prefill(model):
+    return model(inputs_embeds=model.get_input_embeddings()(input_ids), attention_mask=attention_mask).logits
+
+
+def decode(model):
+    embed_tokens = model.get_input_embeddings()
+    return decode_batch(
+        model, embed_tokens, embed_tokens(input_ids), attention_mask,
+        max_new_tokens=command_args.max_new_tokens,
+        stop_sequences=((-1,),), # never stops, every row decodes max_new_tokens
+        do_sample=False,
+    )
+
+
+models = [('fp32', fp32_model), ('int8', int8_model)]
+times = {name: {'prefill': [], 'decode': []} for name, _ in models}
+with torch.no_grad():
+    for name, model in models:
+        decode(model)
+    # the two models take turns so that load drift does not favour one of them
+    for _ in range(command_args.repeat):
+        for name, model in models:
+            start = time.time()
+            prefill(model)
+            times[name]['prefill'].append(time.time() - start)
+            start = time.time()
+            decode(model)
+            times[name]['decode'].append(time.time() - start)
+
+    fp32_logits, int8_logits = prefill(fp32_model).float(), prefill(int8_model).float()
+    agreement = (fp32_logits.argmax(dim=-1) == int8_logits.argmax(dim=-1)).float().mean().item()
+    relative_error = ((int8_logits - fp32_logits).norm() / fp32_logits.norm()).item()
+
+    # save / load round trip
+    save_dir = tempfile.mkdtemp()
+    save_quantized_llama(int8_model, save_dir)
+    start = time.time()
+    loaded_model = load_quantized_llama(save_dir)
+    load_time = time.time() - start
+    round_trip = torch.equal(prefill(loaded_model), prefill(int8_model))
+
+print(f'threads: {torch.get_num_threads()}, engine: {torch.backends.quantized.engine}, batch size: {B}, prompt: {S}, '
+      f'new tokens: {command_args.max_new_tokens}, hidden size: {config.hidden_size}, layers: {config.num_hidden_layers}')
+for name, model in models:
+    prefill_time, decode_time = min(times[name]['prefill']), min(times[name]['decode'])
+    tokens = B * command_args.max_new_tokens
+    print(f'{name}: weights {quantized_size(model) / 2 ** 20:.0f}MB, prefill {prefill_time * 1000:.0f}ms, '
+          f'decode {tokens / decode_time:.1f} tokens/s')
+print(f'[!] int8 vs fp32 prefill logits: relative error {relative_error:.3e}, argmax agreement {agreement:.4f}')
+print(f'[!] save / load round trip identical: {round_trip}, load {load_time:.2f}s')
@@ -0,0 +1,121 @@
+import os
+import math
+import argparse
+import torch
+from model.openllama import OpenLLAMAPEFTModel
+from model.checkpoint import load_checkpoint
+
+# accuracy guard of the int8 cpu language model: the same MVTec test images go through the fp32 model
+# (LoRA merged) and then through the int8 one. Reports the agreement of the Yes/No answers, the gap in
+# P(Yes), and the token-level perplexity of the reference answers of the training data.
+parser = argparse.ArgumentParser("AnomalyGPT int8 accuracy check", add_help=True)
+parser.add_argument("--imagebind_ckpt_path", type=str, default='../pretrained_ckpt/imagebind_ckpt/imagebind_huge.pth')
+parser.add_argument("--vicuna_ckpt_path", type=str, default='../pretrained_ckpt/vicuna_ckpt/7b_v0')
+parser.add_argument("--delta_ckpt_path", type=str, default='../pretrained_ckpt/pandagpt_ckpt/7b/pytorch_model.pt')
+parser.add_argument("--anomalygpt_ckpt_path", type=str, default='./ckpt/train_mvtec/pytorch_model.pt')
+parser.add_argument("--data_root", type=str, default='../data/mvtec_anomaly_detection')
+parser.add_argument("--classes", type=str, nargs='*', default=['bottle', 'cable', 'capsule', 'hazelnut', 'metal_nut', 'screw'])
+parser.add_argument("--images_per_class", type=int, default=8)
+parser.add_argument("--lm_head", action='store_true', help="quantize lm_head as well")
+
+command_args = parser.parse_args()
+
+NORMAL_ANSWER = 'No, there is no anomaly in the image.'
+ABNORMAL_ANSWER = 'Yes, there is an anomaly in the image.'
+
+args = {
+    'model': 'openllama_peft',
+    'imagebind_ckpt_path': command_args.imagebind_ckpt_path,
+    'vicuna_ckpt_path': command_args.vicuna_ckpt_path,
+    'stage': 2,
+    'max_tgt_len': 128,
+    'lora_r': 32,
+    'lora_alpha': 32,
+    'lora_dropout': 0.1,
+    'text_feature_cache_dir': './ckpt/text_feature_cache',
+    'memory_bank_dir': './ckpt/memory_bank',
+    'imagebind_modalities': ['vision', 'text'],
+    'device': 'cpu',
+    'meta_init': True,
+    'init_device': 'cpu',
+    'init_dtype': torch.float32,
+}
+model = OpenLLAMAPEFTModel(**args).eval()
+load_checkpoint(model, command_args.delta_ckpt_path)
+load_checkpoint(model, command_args.anomalygpt_ckpt_path)
+model.merge_lora(unload=True)
+
+
+def test_images(c_name):
+    '''the first images of every defect type of the class, normal ones included'''
+    test_dir = os.path.join(command_args.data_root, c_name, 'test')
+    per_type = max(1, command_args.images_per_class // len(os.listdir(test_dir)))
+    samples = []
+    for defect_type in sorted(os.listdir(test_dir)):
+        files = sorted(f for f in os.listdir(os.path.join(test_dir, defect_type)) if f.endswith('.png'))
+        samples += [(os.path.join(test_dir, defect_type, f), defect_type != 'good') for f in files[:per_type]]
+    return samples[:command_args.images_per_class]
+
+
+samples = []
+for c_name in command_args.classes:
+    normal_img_path = os.path.join(command_args.data_root, c_name, 'train', 'good', '000.png')
+    for image_path, abnormal in test_images(c_name):
+        samples.append((c_name, image_path, normal_img_path, abnormal))
+
+
+def make_inputs(c_name, image_path, normal_img_path):
+    return {
+        'prompt': f'This is a photo of a {c_name.replace("_", " ")} for anomaly detection. Is there any anomaly in the image?',
+        'image_paths': [image_path],
+        'audio_paths': [],
+        'video_paths': [],
+        'thermal_paths': [],
+        'normal_img_paths': [normal_img_path],
+        'top_p': 0.01,
+        'temperature': 1.0,
+        'max_tgt_len': 128,
+        'modality_embeds': [],
+    }
+
+
+# the vision side is not quantized: the prompt embeddings are computed once and fed to both models
+with torch.no_grad():
+    prompt_embeds = [model.prepare_generation_embedding(make_inputs(c_name, image_path, normal_img_path), False)[0]
+                     for c_name, image_path, normal_img_path, _ in samples]
+    answer_ids = [model.llama_tokenizer((ABNORMAL_ANSWER if abnormal else NORMAL_ANSWER) + '\n###', add_special_tokens=False,
+                                        return_tensors='pt').input_ids.to(model.device) for _, _, _, abnormal in samples]
+yes_ids, no_ids = model.answer_token_ids('Yes'), model.answer_token_ids('No')
+
+
+@torch.no_grad()
+def evaluate():
+    '''
+        one forward per image over the prompt and the reference answer (+ '\n###' like in training):
+        P(Yes) against P(No) at the first answer token, like classify, and the answer token NLL
+        return: list of P(Yes), perplexity of the reference answers
+    '''
+    p_yes, nll, tokens = [], 0.0, 0
+    for embeds, ids in zip(prompt_embeds, answer_ids):
+        inputs_embeds = torch.cat([embeds, model._embed_tokens(ids)], dim=1)
+        logits = model.llama_model(inputs_embeds=inputs_embeds).logits[0, embeds.shape[1] - 1:-1].float()
+        yes_no = torch.stack([logits[0, yes_ids].logsumexp(dim=0), logits[0, no_ids].logsumexp(dim=0)])
+        p_yes.append(float(yes_no.softmax(dim=0)[0]))
+        nll += torch.nn.functional.cross_entropy(logits, ids[0], reduction='sum').item()
+        tokens += ids.shape[1]
+    return p_yes, math.exp(nll / tokens)
+
+
+fp32_p_yes, fp32_ppl = evaluate()
+model.quantize_llm(include_lm_head=command_args.lm_head)
+int8_p_yes, int8_ppl = evaluate()
+
+labels = [abnormal for _, _, _, abnormal in samples]
+agreement = sum((a >= 0.5) == (b >= 0.5) for a, b in zip(fp32_p_yes, int8_p_yes)) / len(samples)
+fp32_accuracy = sum((p >= 0.5) == label for p, label in zip(fp32_p_yes, labels)) / len(samples)
+int8_accuracy = sum((p >= 0.5) == label for p, label in zip(int8_p_yes, labels)) / len(samples)
+max_gap = max(abs(a - b) for a, b in zip(fp32_p_yes, int8_p_yes))
+print(f'{len(samples)} images of {command_args.classes}')
+print(f'Yes/No agreement fp32 vs int8: {agreement:.4f}, max |P(Yes) fp32 - int8|: {max_gap:.4f}')
+print(f'Yes/No accuracy fp32: {fp32_accuracy:.4f}, int8: {int8_accuracy:.4f}')
+print(f'reference answer perplexity fp32: {fp32_ppl:.4f}, int8: {int8_ppl:.4f}')
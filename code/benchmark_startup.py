@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+import torch
+from transformers import LlamaConfig
+from peft import LoraConfig, TaskType, get_peft_model
+from model.modeling_llama import LlamaForCausalLM
+from model.meta_init import init_on_meta, materialize, reset_lora_parameters, load_pretrained_weights
+
+parser = argparse.ArgumentParser("AnomalyGPT language model startup benchmark", add_help=True)
+parser.add_argument("--pretrained_dir", type=str, default='./ckpt/benchmark_llama', help="a save_pretrained llama, created if missing")
+parser.add_argument("--hidden_size", type=int, default=1536)
+parser.add_argument("--num_layers", type=int, default=8)
+parser.add_argument("--device", type=str, default='cpu')
+parser.add_argument("--mode", type=str, default=None, choices=['from_pretrained', 'meta'], help="internal, one mode per process")
+
+command_args = parser.parse_args()
+
+peft_config = LoraConfig(
+    task_type=TaskType.CAUSAL_LM,
+    inference_mode=False,
+    r=32,
+    lora_alpha=32,
+    lora_dropout=0.1,
+    target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj']
+)
+
+
+def rss_mb(field):
+    # linux only: VmRSS is the current resident memory, RssAnon the part that is not file-backed
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 2 ** 10
+
+
+class PeakSampler:
+    def __init__(self, field, interval=0.005):
+        self.field, self.interval, self.peak = field, interval, rss_mb(field)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, rss_mb(self.field))
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        return max(self.peak, rss_mb(self.field))
+
+
+if command_args.mode is not None:
+    base_anon = rss_mb('RssAnon')
+    sampler = PeakSampler('RssAnon')
+    start = time.time()
+    if command_args.mode == 'from_pretrained':
+        # what init_language_decoder does by default, followed by the .half() of the scripts
+        model = LlamaForCausalLM.from_pretrained(command_args.pretrained_dir)
+        model = get_peft_model(model, peft_config)
+        model = model.half().to(command_args.device)
+    else:
+        # args['meta_init'] = True
+        with init_on_meta():
+            model = get_peft_model(LlamaForCausalLM(LlamaConfig.from_pretrained(command_args.pretrained_dir)), peft_config)
+        materialize(model, command_args.device, torch.float16)
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            load_pretrained_weights(model.base_model.model, command_args.pretrained_dir)
+            sys.stdout = stdout
+        reset_lora_parameters(model)
+    wall_time = time.time() - start
+    peak_anon = sampler.stop()
+    num_params = sum(param.numel() for param in model.parameters())
+    print(f'{command_args.mode:16s} {num_params / 1e6:.0f}M params: {wall_time:.2f}s, '
+          f'peak anonymous memory {peak_anon - base_anon:+.0f}MB, fp16 weights are {num_params * 2 / 2 ** 20:.0f}MB')
+    sys.exit(0)
+
+if not os.path.isdir(command_args.pretrained_dir):
+    config = LlamaConfig(
+        hidden_size=command_args.hidden_size,
+        intermediate_size=command_args.hidden_size * 8 // 3 // 256 * 256,
+        num_hidden_layers=command_args.num_layers,
+        num_attention_heads=command_args.hidden_size // 128,
+    )
+    # stored in fp16 like the vicuna weights
+    LlamaForCausalLM(config).half().save_pretrained(command_args.pretrained_dir, max_shard_size='1GB')
+
+# convert the shards once, later starts only map them
+with init_on_meta():
+    model = LlamaForCausalLM(LlamaConfig.from_pretrained(command_args.pretrained_dir))
+materialize(model, 'cpu', torch.float16)
+start = time.time()
+load_pretrained_weights(model, command_args.pretrained_dir)
+print(f'[!] first meta start, including the one-time conversion: {time.time() - start:.2f}s')
+del model
+
+for mode in ['from_pretrained', 'meta']:
+    # a fresh process per mode, the memory numbers are per process
+    subprocess.run([sys.executable, __file__, '--mode', mode, '--pretrained_dir', command_args.pretrained_dir,
+                    '--device', command_args.device], check=True)
@@ -0,0 +1,117 @@
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from sklearn.metrics import roc_auc_score
+from model.openllama import OpenLLAMAPEFTModel
+from model.checkpoint import load_checkpoint
+from model.ImageBind import data
+
+# accuracy guard of the cpu variants of the ImageBind vision trunk: the same MVTec test images go through
+# the fp32 trunk, then under bf16 autocast, then through the int8 trunk. Reports the out_layers patch token
+# error, the anomaly map error and the pixel AUROC of every variant against the fp32 reference.
+parser = argparse.ArgumentParser("AnomalyGPT vision trunk quantization accuracy check", add_help=True)
+parser.add_argument("--imagebind_ckpt_path", type=str, default='../pretrained_ckpt/imagebind_ckpt/imagebind_huge.pth')
+parser.add_argument("--anomalygpt_ckpt_path", type=str, default='./ckpt/train_mvtec/pytorch_model.pt')
+parser.add_argument("--data_root", type=str, default='../data/mvtec_anomaly_detection')
+parser.add_argument("--classes", type=str, nargs='*', default=['bottle', 'cable', 'capsule', 'hazelnut', 'metal_nut', 'screw'])
+parser.add_argument("--images_per_class", type=int, default=16)
+parser.add_argument("--k_shot", type=int, default=1, help="normal reference images per class, 0 for the text maps only")
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--variants", type=str, nargs='*', default=['bf16', 'int8'], choices=['bf16', 'int8'])
+
+command_args = parser.parse_args()
+
+args = {
+    'model': 'openllama_peft',
+    'imagebind_ckpt_path': command_args.imagebind_ckpt_path,
+    'stage': 2,
+    'max_tgt_len': 128,
+    'text_feature_cache_dir': './ckpt/text_feature_cache',
+    'memory_bank_dir': './ckpt/memory_bank',
+    'load_llm': False,
+    'imagebind_modalities': ['vision', 'text'],
+    'device': 'cpu',
+    'meta_init': True,
+    'init_device': 'cpu',
+    'init_dtype': torch.float32,
+}
+model = OpenLLAMAPEFTModel(**args).eval()
+# image_decoder comes from the AnomalyGPT checkpoint, the language model parts of it are skipped
+load_checkpoint(model, command_args.anomalygpt_ckpt_path, verbose=False)
+
+mask_transform = transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor()])
+
+
+def validation_subset(c_name):
+    '''the first images of every defect type of the class with their 224 x 224 ground truth masks'''
+    test_dir = os.path.join(command_args.data_root, c_name, 'test')
+    per_type = max(1, command_args.images_per_class // len(os.listdir(test_dir)))
+    samples = []
+    for defect_type in sorted(os.listdir(test_dir)):
+        files = sorted(f for f in os.listdir(os.path.join(test_dir, defect_type)) if f.endswith('.png'))
+        for f in files[:per_type]:
+            image_path = os.path.join(test_dir, defect_type, f)
+            if defect_type == 'good':
+                mask = np.zeros((224, 224), dtype=np.uint8)
+            else:
+                mask_path = os.path.join(command_args.data_root, c_name, 'ground_truth', defect_type, f.replace('.png', '_mask.png'))
+                mask = (mask_transform(Image.open(mask_path).convert('L')).squeeze(0).numpy() > 0.1).astype(np.uint8)
+            samples.append((image_path, mask))
+    return samples[:command_args.images_per_class]
+
+
+batches = [] # (class name, image paths, masks, normal image paths)
+for c_name in command_args.classes:
+    samples = validation_subset(c_name)
+    normal_dir = os.path.join(command_args.data_root, c_name, 'train', 'good')
+    normal_img_paths = [os.path.join(normal_dir, f) for f in sorted(os.listdir(normal_dir))[:command_args.k_shot]]
+    for i in range(0, len(samples), command_args.batch_size):
+        chunk = samples[i:i + command_args.batch_size]
+        batches.append((c_name, [path for path, _ in chunk], [mask for _, mask in chunk], normal_img_paths))
+model.text_feature_cache.prefetch([c_name.replace('_', ' ') for c_name in command_args.classes])
+
+
+@torch.no_grad()
+def run_variant():
+    '''return: out_layers patch tokens (list per batch), anomaly maps, pixel AUROC, seconds per image'''
+    tokens, maps, masks, seconds = [], [], [], 0.0
+    for c_name, image_paths, batch_masks, normal_img_paths in batches:
+        vision_inputs = data.load_and_transform_vision_data(image_paths, model.device)
+        start = time.time()
+        _, raw_patch_tokens, _ = model.encode_vision_features(vision_inputs, features_only=True)
+        normal_refs = [normal_img_paths] * len(image_paths) if normal_img_paths else None
+        anomaly_maps, _ = model.score(vision_inputs, c_name.replace('_', ' '), normal_refs)
+        seconds += time.time() - start
+        tokens.append([t.float() for t in raw_patch_tokens])
+        maps.append(anomaly_maps.float().reshape(-1, 224, 224))
+        masks += batch_masks
+    maps = torch.cat(maps, dim=0)
+    p_auroc = roc_auc_score(np.stack(masks).ravel(), maps.numpy().ravel())
+    return tokens, maps, p_auroc, seconds / len(masks)
+
+
+def relative_error(a, b):
+    return ((a - b).norm() / b.norm()).item()
+
+
+reference_tokens, reference_maps, reference_auroc, reference_seconds = run_variant()
+print(f'{len(reference_maps)} images of {command_args.classes}, {command_args.k_shot}-shot')
+print(f'fp32: pixel AUROC {reference_auroc * 100:.2f}, {reference_seconds:.2f}s per image (vision pass counted twice)')
+for variant in command_args.variants:
+    if variant == 'bf16':
+        model.vision_autocast = 'bf16'
+    else:
+        model.vision_autocast = None
+        model.quantize_vision()
+    tokens, maps, p_auroc, seconds = run_variant()
+    layer_errors = [max(relative_error(batch[layer], reference[layer]) for batch, reference in zip(tokens, reference_tokens))
+                    for layer in range(len(reference_tokens[0]))]
+    print(f'{variant}: pixel AUROC {p_auroc * 100:.2f} ({(p_auroc - reference_auroc) * 100:+.2f}), {seconds:.2f}s per image, '
+          f'speedup {reference_seconds / seconds:.2f}x')
+    print(f'    out_layers patch token relative error: {", ".join(f"{e:.2e}" for e in layer_errors)}')
+    print(f'    anomaly map relative error {relative_error(maps, reference_maps):.2e}, '
+          f'max abs error {(maps - reference_maps).abs().max().item():.2e}')
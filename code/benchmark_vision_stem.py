@@ -0,0 +1,70 @@
+import time
+import argparse
+import torch
+import torch.nn as nn
+from model.ImageBind.models.multimodal_preprocessors import PadIm2Video, PatchEmbedGeneric
+
+# the image stem of imagebind_huge: PadIm2Video repeats every image into 2 frames for the (2, 14, 14) Conv3d,
+# PatchEmbedGeneric runs the temporal kernel folded into a Conv2d instead (fold_image_time)
+parser = argparse.ArgumentParser("AnomalyGPT ImageBind vision stem benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--threads", type=int, default=None)
+parser.add_argument("--device", type=str, default='cpu')
+parser.add_argument("--half", action='store_true')
+
+command_args = parser.parse_args()
+if command_args.threads:
+    torch.set_num_threads(command_args.threads)
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+embed_dim, kernel_size = 1280, (2, 14, 14)
+stem = PatchEmbedGeneric(
+    proj_stem=[
+        PadIm2Video(pad_type="repeat", ntimes=2),
+        nn.Conv3d(in_channels=3, kernel_size=kernel_size, out_channels=embed_dim, stride=kernel_size, bias=False),
+    ]
+).to(device, dtype).eval()
+assert stem.image_stem() is not None
+images = torch.randn(command_args.batch_size, 3, 224, 224, device=device, dtype=dtype)
+
+
+def run(fold):
+    stem.fold_image_time = fold
+    with torch.no_grad():
+        return stem(images)
+
+
+def timed(fold):
+    run(fold)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(command_args.repeat):
+        out = run(fold)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / command_args.repeat * 1000, out
+
+
+# the two stems take turns so that load drift does not favour one of them
+times = {False: [], True: []}
+for _ in range(3):
+    for fold in [False, True]:
+        elapsed, out = timed(fold)
+        times[fold].append(elapsed)
+reference, folded = run(False), run(True)
+
+B, patches = command_args.batch_size, 16 * 16
+macs = {fold: B * patches * embed_dim * 3 * 14 * 14 * (1 if fold else 2) for fold in [False, True]}
+padded_bytes = B * 3 * 2 * 224 * 224 * images.element_size()
+print(f'device: {device}, dtype: {dtype}, batch size: {B}, threads: {torch.get_num_threads()}')
+print(f'max |folded - reference|: {(folded - reference).abs().max().item():.2e}, '
+      f'relative error {((folded - reference).float().norm() / reference.float().norm()).item():.2e}')
+print(f'Conv3d on the padded video: {min(times[False]):.1f}ms, {macs[False] / 1e9:.2f} GMACs, '
+      f'padded input {padded_bytes / 2 ** 20:.1f}MB')
+print(f'folded Conv2d: {min(times[True]):.1f}ms, {macs[True] / 1e9:.2f} GMACs, no padded input, '
+      f'speedup: {min(times[False]) / min(times[True]):.2f}x')
@@ -0,0 +1,93 @@
+import copy
+import time
+import argparse
+from functools import partial
+import torch
+import torch.nn as nn
+from model.ImageBind.models.helpers import EinOpsRearrange
+from model.ImageBind.models.transformer import MultiheadAttention, SimpleTransformer
+
+parser = argparse.ArgumentParser("AnomalyGPT ImageBind vision trunk benchmark", add_help=True)
+parser.add_argument("--batch_size", type=int, default=4)
+parser.add_argument("--num_blocks", type=int, default=32, help="imagebind_huge has 32 vision blocks")
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--threads", type=int, default=None)
+parser.add_argument("--device", type=str, default='cpu')
+parser.add_argument("--half", action='store_true')
+# cpu variants of the fast path, compared with the fp32 fast blocks: int8 dynamic quantization and bf16 autocast
+parser.add_argument("--int8", action='store_true')
+parser.add_argument("--bf16", action='store_true')
+
+command_args = parser.parse_args()
+if command_args.threads:
+    torch.set_num_threads(command_args.threads)
+
+torch.manual_seed(0)
+device = torch.device(command_args.device)
+dtype = torch.float16 if command_args.half else torch.float32
+
+# the vision trunk of imagebind_huge, see ImageBindModel._create_modality_trunks
+embed_dim, num_heads = 1280, 16
+trunk = SimpleTransformer(
+    embed_dim=embed_dim,
+    num_blocks=command_args.num_blocks,
+    ffn_dropout_rate=0.0,
+    drop_path_rate=0.0,
+    attn_target=partial(MultiheadAttention, embed_dim=embed_dim, num_heads=num_heads, bias=True, add_bias_kv=False),
+    pre_transformer_layer=nn.Sequential(nn.LayerNorm(embed_dim, eps=1e-6), EinOpsRearrange("b l d -> l b d")),
+    post_transformer_layer=EinOpsRearrange("l b d -> b l d"),
+).to(device, dtype).eval()
+
+# a 224x224 image gives 16 x 16 patches and the CLS token
+tokens = torch.randn(command_args.batch_size, 257, embed_dim, device=device, dtype=dtype)
+out_layers = [layer for layer in [7, 15, 23, 31] if layer < command_args.num_blocks] or [command_args.num_blocks - 1]
+
+
+def run(fast):
+    trunk.fast_inference = fast
+    with torch.no_grad():
+        return trunk(tokens, out_layers=out_layers)
+
+
+def timed(fast):
+    run(fast)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(command_args.repeat):
+        out = run(fast)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / command_args.repeat * 1000, out
+
+
+reference_time, (reference, reference_layers) = timed(False)
+fast_time, (fast, fast_layers) = timed(True)
+
+print(f'device: {device}, dtype: {dtype}, batch size: {command_args.batch_size}, blocks: {command_args.num_blocks}, threads: {torch.get_num_threads()}')
+print(f'max |fast - reference| output: {(fast - reference).abs().max().item():.2e}')
+for layer, a, b in zip(out_layers, fast_layers, reference_layers):
+    assert a.shape == b.shape
+    print(f'max |fast - reference| out_layer {layer}: {(a - b).abs().max().item():.2e}')
+print(f'nn.MultiheadAttention blocks: {reference_time:.1f}ms, fast blocks: {fast_time:.1f}ms, speedup: {reference_time / fast_time:.2f}x')
+
+
+def compare(name, variant_time, variant, variant_layers):
+    print(f'{name}: {variant_time:.1f}ms, speedup over the fp32 fast blocks: {fast_time / variant_time:.2f}x')
+    for layer, a, b in zip(out_layers, variant_layers, fast_layers):
+        a, b = a.float(), b.float()
+        relative_error = ((a - b).norm() / b.norm()).item()
+        cosine = torch.nn.functional.cosine_similarity(a, b, dim=-1).min().item()
+        print(f'    out_layer {layer}: relative error {relative_error:.2e}, min token cosine {cosine:.5f}')
+
+
+if command_args.bf16:
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+        bf16_time, (bf16, bf16_layers) = timed(True)
+    compare('bf16 autocast', bf16_time, bf16, bf16_layers)
+if command_args.int8:
+    assert device.type == 'cpu' and dtype == torch.float32, 'dynamic quantization runs on fp32 cpu models'
+    trunk = copy.deepcopy(trunk)
+    trunk.quantize_dynamic_()
+    int8_time, (int8, int8_layers) = timed(True)
+    compare('int8 dynamic', int8_time, int8, int8_layers)
@@ -0,0 +1,161 @@
+import os
+import math
+import argparse
+import torch
+import torch.nn.functional as F
+from model.AnomalyGPT_models import PromptLearner, native_from_prompt_learner, upsample_pseudo_inverse
+from model.checkpoint import MappedCheckpoint
+
+# distills the PromptLearner of an AnomalyGPT checkpoint into NativePromptLearner: the final 5 x 5 conv and
+# base_prompts are copied and frozen, native_net learns to give the same 9 image prompts from the 16 x 16 map
+# that the original conv stack gives from its 224 x 224 bilinear upsampling. The maps are synthetic blobs,
+# plus the real anomaly maps of MVTec images with --data_root (ImageBind and image_decoder, no language model).
+# Writes the native_net tensors under prompt_learner., load them with load_checkpoint after the AnomalyGPT
+# checkpoint and args['native_prompt_learner'] = True (--native_prompt_learner in test_mvtec.py / test_visa.py).
+parser = argparse.ArgumentParser("AnomalyGPT PromptLearner distillation", add_help=True)
+parser.add_argument("--anomalygpt_ckpt_path", type=str, default='./ckpt/train_mvtec/pytorch_model.pt')
+parser.add_argument("--imagebind_ckpt_path", type=str, default='../pretrained_ckpt/imagebind_ckpt/imagebind_huge.pth')
+parser.add_argument("--data_root", type=str, default=None, help="MVTec root, real anomaly maps are added to the synthetic ones")
+parser.add_argument("--k_shot", type=int, default=1, help="the real maps are computed zero-shot and with k normal references")
+parser.add_argument("--maps_cache", type=str, default='./ckpt/native_prompt_learner_maps.pt')
+parser.add_argument("--output", type=str, default='./ckpt/native_prompt_learner.pt')
+parser.add_argument("--steps", type=int, default=3000)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--lr", type=float, default=1e-3)
+parser.add_argument("--real_ratio", type=float, default=0.5, help="share of real maps in every batch when there are some")
+parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument("--seed", type=int, default=0)
+
+command_args = parser.parse_args()
+torch.manual_seed(command_args.seed)
+device = torch.device(command_args.device)
+MAP_SIZE = 16
+
+
+def synthetic_anomaly_maps(n, generator=None):
+    '''
+        n x 1 x 16 x 16 maps in [0, 1] like the text and few-shot maps: a smooth background level and
+        0 to 3 gaussian blobs of random position, size and height
+    '''
+    background = torch.rand(n, 1, 4, 4, generator=generator) * torch.rand(n, 1, 1, 1, generator=generator) * 0.5
+    maps = F.interpolate(background, size=MAP_SIZE, mode='bilinear', align_corners=True)
+    grid = torch.arange(MAP_SIZE, dtype=torch.float32)
+    for _ in range(3):
+        present = (torch.rand(n, 1, 1, 1, generator=generator) < 0.5).float()
+        center = torch.rand(n, 2, generator=generator) * (MAP_SIZE - 1)
+        sigma = 0.5 + torch.rand(n, 1, 1, 1, generator=generator) * 3
+        height = torch.rand(n, 1, 1, 1, generator=generator)
+        dist = (grid.view(1, 1, -1, 1) - center[:, 0].view(-1, 1, 1, 1)) ** 2 + (grid.view(1, 1, 1, -1) - center[:, 1].view(-1, 1, 1, 1)) ** 2
+        maps = maps + present * height * torch.exp(-dist / (2 * sigma ** 2))
+    return maps.clamp(0, 1)
+
+
+@torch.no_grad()
+def real_anomaly_maps():
+    '''16 x 16 maps of every MVTec train and test image, zero-shot and k-shot, cached in maps_cache'''
+    if os.path.isfile(command_args.maps_cache):
+        return torch.load(command_args.maps_cache)
+    from model.openllama import OpenLLAMAPEFTModel
+    from model.checkpoint import load_checkpoint
+    model = OpenLLAMAPEFTModel(
+        model='openllama_peft',
+        imagebind_ckpt_path=command_args.imagebind_ckpt_path,
+        stage=2,
+        max_tgt_len=128,
+        load_llm=False,
+        imagebind_modalities=['vision', 'text'],
+        device=device,
+        init_device=device,
+        init_dtype=torch.float32,
+        meta_init=True,
+    ).eval()
+    model = model.to(device) # the image_decoder is built outside of init_device
+    load_checkpoint(model, command_args.anomalygpt_ckpt_path, verbose=False)
+
+    maps = []
+    for c_name in sorted(os.listdir(command_args.data_root)):
+        class_dir = os.path.join(command_args.data_root, c_name)
+        if not os.path.isdir(os.path.join(class_dir, 'test')):
+            continue
+        image_paths = []
+        for split in ['train', 'test']:
+            for defect_type in sorted(os.listdir(os.path.join(class_dir, split))):
+                type_dir = os.path.join(class_dir, split, defect_type)
+                image_paths += [os.path.join(type_dir, f) for f in sorted(os.listdir(type_dir)) if f.endswith('.png')]
+        normal_refs = image_paths[:command_args.k_shot] # the first train/good images
+        for i in range(0, len(image_paths), 16):
+            batch = image_paths[i:i + 16]
+            for refs in [None, [normal_refs] * len(batch)]:
+                anomaly_maps, _ = model.score(batch, c_name.replace('_', ' '), refs)
+                # exact: the 224 x 224 maps are bilinear upsamplings of the patch-level ones
+                reduce = upsample_pseudo_inverse(MAP_SIZE, anomaly_maps.shape[-1]).to(anomaly_maps.device, anomaly_maps.dtype)
+                maps.append((reduce @ anomaly_maps @ reduce.T).float().cpu())
+        print(f'[!] {c_name}: {len(image_paths)} images')
+    maps = torch.cat(maps, dim=0)
+    os.makedirs(os.path.dirname(command_args.maps_cache) or '.', exist_ok=True)
+    torch.save(maps, command_args.maps_cache)
+    del model
+    return maps
+
+
+# teacher: the PromptLearner of the checkpoint, student: NativePromptLearner sharing its final conv and base_prompts
+checkpoint = MappedCheckpoint(command_args.anomalygpt_ckpt_path)
+teacher = PromptLearner(1, 4096)
+teacher.load_state_dict({key[len('prompt_learner.'):]: checkpoint[key] for key in checkpoint.keys() if key.startswith('prompt_learner.')})
+teacher = teacher.to(device).eval().requires_grad_(False)
+student = native_from_prompt_learner(teacher, MAP_SIZE).to(device)
+student.meta_net.requires_grad_(False)
+student.base_prompts.requires_grad_(False)
+
+real_maps = real_anomaly_maps() if command_args.data_root else None
+if real_maps is not None:
+    # every 10th real map is kept for validation
+    val_real, real_maps = real_maps[::10], torch.cat([real_maps[i::10] for i in range(1, 10)], dim=0)
+    print(f'[!] {len(real_maps)} real maps for training, {len(val_real)} for validation')
+val_synthetic = synthetic_anomaly_maps(512, torch.Generator().manual_seed(command_args.seed + 1))
+
+
+def image_prompts(module, maps16):
+    '''the 9 prompts from the map, base_prompts are shared and left out. maps16: n x 1 x 16 x 16'''
+    if isinstance(module, PromptLearner):
+        maps16 = F.interpolate(maps16, size=224, mode='bilinear', align_corners=True)
+    return module(maps16)[:, 9:]
+
+
+@torch.no_grad()
+def relative_error(maps16):
+    '''relative error of the student prompts over a set of maps'''
+    err, norm = 0.0, 0.0
+    for i in range(0, len(maps16), 64):
+        batch = maps16[i:i + 64].to(device)
+        target = image_prompts(teacher, batch)
+        err += (image_prompts(student, batch) - target).pow(2).sum().item()
+        norm += target.pow(2).sum().item()
+    return math.sqrt(err / norm)
+
+
+optimizer = torch.optim.AdamW(student.native_net.parameters(), lr=command_args.lr, weight_decay=0.0)
+scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 0.5 * (1 + math.cos(math.pi * step / command_args.steps)))
+for step in range(command_args.steps):
+    n_real = int(command_args.batch_size * command_args.real_ratio) if real_maps is not None else 0
+    maps16 = synthetic_anomaly_maps(command_args.batch_size - n_real)
+    if n_real:
+        maps16 = torch.cat([maps16, real_maps[torch.randint(len(real_maps), (n_real,))]], dim=0)
+    maps16 = maps16.to(device)
+    with torch.no_grad():
+        target = image_prompts(teacher, maps16)
+    loss = F.mse_loss(image_prompts(student, maps16), target) / target.pow(2).mean()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    scheduler.step()
+    if step % 200 == 0 or step == command_args.steps - 1:
+        print(f'[!] step {step}: relative squared error {loss.item():.4e}')
+
+student.eval()
+print(f'[!] validation relative error of the image prompts, synthetic maps: {relative_error(val_synthetic):.4e}')
+if real_maps is not None:
+    print(f'[!] validation relative error of the image prompts, real maps: {relative_error(val_real):.4e}')
+os.makedirs(os.path.dirname(command_args.output) or '.', exist_ok=True)
+torch.save({f'prompt_learner.native_net.{key}': value.cpu() for key, value in student.native_net.state_dict().items()}, command_args.output)
+print(f'[!] native_net of the prompt learner saved to {command_args.output}')
@@ -0,0 +1,61 @@
+import argparse
+import torch
+from model.openllama import OpenLLAMAPEFTModel, CLASS_NAMES
+from model.checkpoint import load_checkpoint
+from model.bundle import export_bundle, bundle_tensors, Bundle
+
+# packs ImageBind, Vicuna, the PandaGPT delta and the AnomalyGPT delta into one inference bundle:
+# the used ImageBind branches, LLaMA with the LoRA merged, llama_proj, image_decoder, prompt_learner
+# and the text features of the classes. Load it with args['bundle_path'] instead of the four paths.
+parser = argparse.ArgumentParser("AnomalyGPT bundle export", add_help=True)
+parser.add_argument("--imagebind_ckpt_path", type=str, default='../pretrained_ckpt/imagebind_ckpt/imagebind_huge.pth')
+parser.add_argument("--vicuna_ckpt_path", type=str, default='../pretrained_ckpt/vicuna_ckpt/7b_v0')
+parser.add_argument("--delta_ckpt_path", type=str, default='../pretrained_ckpt/pandagpt_ckpt/7b/pytorch_model.pt')
+parser.add_argument("--anomalygpt_ckpt_path", type=str, default='./ckpt/train_mvtec/pytorch_model.pt')
+parser.add_argument("--output", type=str, default='./ckpt/bundle/train_mvtec')
+parser.add_argument("--class_names", type=str, nargs='*', default=None, help="classes whose text features are stored, CLASS_NAMES by default")
+# leave the ImageBind text trunk out, the replicas then only have the text features stored in the bundle
+parser.add_argument("--text_free", action='store_true')
+# vision and anomaly maps only, no language model in the bundle
+parser.add_argument("--score_only", action='store_true')
+parser.add_argument("--lora_r", type=int, default=32)
+parser.add_argument("--lora_alpha", type=int, default=32)
+# read the bundle back, verify its checksum and compare every tensor with the exported model
+parser.add_argument("--check", action='store_true')
+
+command_args = parser.parse_args()
+
+args = {
+    'model': 'openllama_peft',
+    'imagebind_ckpt_path': command_args.imagebind_ckpt_path,
+    'vicuna_ckpt_path': command_args.vicuna_ckpt_path,
+    'anomalygpt_ckpt_path': command_args.anomalygpt_ckpt_path,
+    'delta_ckpt_path': command_args.delta_ckpt_path,
+    'stage': 2,
+    'max_tgt_len': 128,
+    'lora_r': command_args.lora_r,
+    'lora_alpha': command_args.lora_alpha,
+    'lora_dropout': 0.1,
+    'text_feature_cache_dir': './ckpt/text_feature_cache',
+    'memory_bank_dir': './ckpt/memory_bank',
+    'load_llm': not command_args.score_only,
+    # the text branch computes the features of the classes that are not cached yet
+    'imagebind_modalities': ['vision', 'text'],
+    'meta_init': True,
+}
+
+model = OpenLLAMAPEFTModel(**args)
+model = model.eval().half().cuda()
+load_checkpoint(model, args['delta_ckpt_path'])
+load_checkpoint(model, args['anomalygpt_ckpt_path'])
+
+class_names = command_args.class_names or CLASS_NAMES
+manifest = export_bundle(model, command_args.output, class_names=class_names,
+                         modalities=['vision'] if command_args.text_free else ['vision', 'text'])
+
+if command_args.check:
+    bundle = Bundle(command_args.output, verify=True)
+    mismatched = [key for key, tensor in bundle_tensors(model, manifest['imagebind_modalities'])
+                  if not torch.equal(bundle[key], tensor.cpu())]
+    assert not mismatched, f'tensors differ from the exported model: {mismatched[:10]}'
+    print(f'[!] {command_args.output}: sha256 {manifest["sha256"]} verified, {len(bundle.keys())} tensors match')
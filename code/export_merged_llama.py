@@ -0,0 +1,65 @@
+import argparse
+import torch
+from torch import nn
+from transformers import LlamaConfig, LlamaTokenizer
+from peft import LoraConfig, TaskType, get_peft_model
+from model.modeling_llama import LlamaForCausalLM
+from model.meta_init import init_on_meta, materialize, load_pretrained_weights
+from model.checkpoint import load_checkpoint
+from model.lora_merge import lora_layers, unload_lora
+from model.quantization import quantize_llama, save_quantized_llama
+
+# writes Vicuna with the LoRA of the PandaGPT and AnomalyGPT checkpoints merged in as a plain save_pretrained
+# directory. Use it as vicuna_ckpt_path with args['lora_merged'] = True: no peft wrapper is built and the
+# LoRA tensors of the checkpoints are skipped, llama_proj / image_decoder / prompt_learner still load from them.
+# With --int8 the merged model is quantized for cpu inference instead, see args['quantized_llm_path'].
+parser = argparse.ArgumentParser("AnomalyGPT merged LLaMA export", add_help=True)
+parser.add_argument("--vicuna_ckpt_path", type=str, default='../pretrained_ckpt/vicuna_ckpt/7b_v0')
+parser.add_argument("--delta_ckpt_path", type=str, default='../pretrained_ckpt/pandagpt_ckpt/7b/pytorch_model.pt')
+parser.add_argument("--anomalygpt_ckpt_path", type=str, default='./ckpt/train_mvtec/pytorch_model.pt')
+parser.add_argument("--output", type=str, default='../pretrained_ckpt/vicuna_ckpt/7b_v0_anomalygpt_merged')
+parser.add_argument("--lora_r", type=int, default=32)
+parser.add_argument("--lora_alpha", type=int, default=32)
+parser.add_argument("--dtype", type=str, default='float16', choices=['float16', 'bfloat16', 'float32'])
+parser.add_argument("--max_shard_size", type=str, default='2GB')
+# cpu replicas: int8 decoder linears with dynamic activation quantization, load with args['quantized_llm_path']
+parser.add_argument("--int8", action='store_true')
+parser.add_argument("--int8_lm_head", action='store_true', help="quantize lm_head as well")
+
+command_args = parser.parse_args()
+dtype = torch.float32 if command_args.int8 else getattr(torch, command_args.dtype)
+
+peft_config = LoraConfig(
+    task_type=TaskType.CAUSAL_LM,
+    inference_mode=True,
+    r=command_args.lora_r,
+    lora_alpha=command_args.lora_alpha,
+    lora_dropout=0.1,
+    target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj']
+)
+
+config = LlamaConfig.from_pretrained(command_args.vicuna_ckpt_path)
+with init_on_meta():
+    llama_model = get_peft_model(LlamaForCausalLM(config), peft_config)
+materialize(llama_model, 'cpu', dtype)
+load_pretrained_weights(llama_model.base_model.model, command_args.vicuna_ckpt_path)
+
+# the checkpoints store the adapters under llama_model., like OpenLLAMAPEFTModel
+holder = nn.Module()
+holder.llama_model = llama_model
+lora_keys = {key for key in holder.state_dict() if 'lora_' in key}
+loaded = set()
+for path in [command_args.delta_ckpt_path, command_args.anomalygpt_ckpt_path]:
+    missing_keys, _ = load_checkpoint(holder, path, verbose=False)
+    loaded.update(lora_keys.difference(missing_keys))
+assert loaded == lora_keys, f'LoRA tensors missing from the checkpoints: {sorted(lora_keys - loaded)[:10]}'
+
+num_layers = len(list(lora_layers(llama_model)))
+llama_model = unload_lora(llama_model)
+if command_args.int8:
+    quantize_llama(llama_model, include_lm_head=command_args.int8_lm_head)
+    save_quantized_llama(llama_model, command_args.output)
+else:
+    llama_model.save_pretrained(command_args.output, max_shard_size=command_args.max_shard_size)
+LlamaTokenizer.from_pretrained(command_args.vicuna_ckpt_path, use_fast=False).save_pretrained(command_args.output)
+print(f'[!] merged {num_layers} LoRA layers into {command_args.output}')
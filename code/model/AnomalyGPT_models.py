@@ -1,3 +1,5 @@
+from collections import OrderedDict
+from functools import lru_cache
 import torch
 from torch import nn
 import numpy as np
@@ -28,6 +30,21 @@ class LinearLayer(nn.Module):
                 B, C, H, W = tokens[i].shape
                 tokens[i] = self.fc[i](tokens[i].view(B, C, -1).permute(0, 2, 1).contiguous())
         return tokens
+
+    def forward_stacked(self, tokens):
+        '''
+            the k projections as one batched matmul, same weights as forward
+            tokens: list of k (1+h*w) x bsz x dim_in seq-first tokens, the CLS token is dropped
+            return: k x bsz x h*w x dim_out
+        '''
+        k = len(tokens)
+        # stack copies anyway, so the batch-first layout comes for free
+        x = torch.stack([token[1:].transpose(0, 1) for token in tokens], dim=0) # k x bsz x h*w x dim_in
+        B, L = x.shape[1], x.shape[2]
+        weight = torch.stack([fc.weight for fc in self.fc[:k]], dim=0) # k x dim_out x dim_in
+        bias = torch.stack([fc.bias for fc in self.fc[:k]], dim=0).unsqueeze(1) # k x 1 x dim_out
+        out = torch.baddbmm(bias.to(x.dtype), x.view(k, B * L, -1), weight.to(x.dtype).transpose(1, 2))
+        return out.view(k, B, L, -1)
     
 class PromptLearner(nn.Module):
     def __init__(self, dim_in, dim_out) -> None:
@@ -70,4 +87,75 @@ class PromptLearner(nn.Module):
         # print(input.shape, img_prompts.shape)
         img_prompts = img_prompts.reshape(B,4096,9).transpose(-2,-1)
         output = torch.cat([self.base_prompts.expand(B,-1,-1), img_prompts], dim=1)
-        return output
\ No newline at end of file
+        return output
+
+
+@lru_cache()
+def upsample_pseudo_inverse(map_size, size):
+    '''
+        map_size x size pseudo-inverse of the bilinear (align_corners) upsampling of a map_size grid to size,
+        P @ up(m) @ P.T gives m back exactly since the upsampling is injective, on cpu in float64
+    '''
+    up = F.interpolate(torch.eye(map_size, dtype=torch.float64).unsqueeze(1), size=size, mode='linear', align_corners=True)
+    return torch.linalg.pinv(up.squeeze(1).T) # map_size x size
+
+
+class NativePromptLearner(nn.Module):
+    '''
+        PromptLearner on the patch-level map_size x map_size anomaly map instead of its 224 x 224 upsampling:
+        a light conv stack replaces the five conv + max pool stages and feeds the same 5 x 5 conv. That conv
+        keeps its meta_net.15 name, so it loads with base_prompts from the AnomalyGPT checkpoints as they are,
+        native_net comes from distill_prompt_learner.py
+    '''
+    def __init__(self, dim_in, dim_out, map_size=16) -> None:
+        super().__init__()
+        self.map_size = map_size
+        self.native_net = nn.Sequential(
+            nn.Conv2d(dim_in, dim_in * 64, kernel_size=3, padding=1), # 16 * 16
+            nn.ReLU(inplace=True),
+
+            nn.Conv2d(dim_in * 64, dim_in * 256, kernel_size=3, padding=0), # 14 * 14
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(2), # 7 * 7
+
+            nn.Conv2d(dim_in * 256, dim_in * 1024, kernel_size=3, padding=1), # 7 * 7
+            nn.ReLU(inplace=True),
+        )
+        self.meta_net = nn.Sequential(OrderedDict([
+            ('15', nn.Conv2d(dim_in * 1024, dim_out, kernel_size=5, padding=0)),
+        ]))
+        self.base_prompts = nn.Parameter(torch.randn((9, dim_out)),requires_grad=True)
+
+    def native_map(self, input):
+        '''
+            input: B x C x H x W anomaly map, H == W. The model passes the patch-level maps as they are
+                   (see OpenLLAMAPEFTModel.patch_level_maps), 224 x 224 inputs are the fallback
+            return: B x C x map_size x map_size, exact for the bilinear upsamplings of the model maps
+                    (least squares otherwise, e.g. with exact_anomaly_map)
+        '''
+        H = input.shape[-1]
+        if H == self.map_size:
+            return input
+        reduce = upsample_pseudo_inverse(self.map_size, H).to(input.device, input.dtype)
+        return reduce @ input @ reduce.T
+
+    def forward(self, input):
+        B = input.shape[0]
+        img_prompts = self.meta_net(self.native_net(self.native_map(input)))
+        img_prompts = img_prompts.reshape(B,4096,9).transpose(-2,-1)
+        output = torch.cat([self.base_prompts.expand(B,-1,-1), img_prompts], dim=1)
+        return output
+
+
+@torch.no_grad()
+def native_from_prompt_learner(prompt_learner, map_size=16):
+    '''
+        NativePromptLearner with the final conv and base_prompts of a trained PromptLearner copied in,
+        native_net is left untrained, see distill_prompt_learner.py
+    '''
+    final_conv = prompt_learner.meta_net[15]
+    native = NativePromptLearner(final_conv.in_channels // 1024, final_conv.out_channels, map_size)
+    native.to(final_conv.weight.device, final_conv.weight.dtype)
+    native.meta_net[0].load_state_dict(final_conv.state_dict())
+    native.base_prompts.copy_(prompt_learner.base_prompts)
+    return native
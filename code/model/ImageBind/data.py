@@ -6,6 +6,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import math
+from functools import lru_cache
 
 import torch
 import torch.nn as nn
@@ -152,10 +153,16 @@ def load_and_transform_thermal_data(thermal_paths, device):
     return torch.stack(thermal_ouputs, dim=0)
 
 
+@lru_cache()
+def get_text_tokenizer(bpe_path=BPE_PATH):
+    # building the tokenizer reads and merges the whole bpe vocabulary, do it once
+    return SimpleTokenizer(bpe_path=bpe_path)
+
+
 def load_and_transform_text(text, device):
     if text is None:
         return None
-    tokenizer = SimpleTokenizer(bpe_path=BPE_PATH)
+    tokenizer = get_text_tokenizer()
     tokens = [tokenizer(t).unsqueeze(0).to(device) for t in text]
     tokens = torch.cat(tokens, dim=0)
     return tokens
@@ -5,6 +5,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import inspect
 import logging
 import os
 from functools import partial
@@ -34,6 +35,15 @@ ModalityType = SimpleNamespace(
     POINT="point",
 )
 
+ALL_MODALITIES = [
+    ModalityType.VISION,
+    ModalityType.TEXT,
+    ModalityType.AUDIO,
+    ModalityType.DEPTH,
+    ModalityType.THERMAL,
+    ModalityType.IMU,
+]
+
 
 class ImageBindModel(nn.Module):
     def __init__(
@@ -70,11 +80,19 @@ class ImageBindModel(nn.Module):
         imu_num_blocks=6,
         imu_num_heads=8,
         imu_drop_path=0.7,
-        layers = [7,15,23,31]
+        layers = [7,15,23,31],
+        modalities=None,
     ):
+        '''
+            modalities: the modalities whose preprocessor, trunk, head and postprocessor are built,
+                        all of them by default, e.g. [ModalityType.VISION, ModalityType.TEXT]
+        '''
         super().__init__()
 
         self.out_layers = layers
+        self.modalities = list(ALL_MODALITIES if modalities is None else modalities)
+        unknown = [modality for modality in self.modalities if modality not in ALL_MODALITIES]
+        assert not unknown, f'unknown modalities {unknown}, expected a subset of {ALL_MODALITIES}'
 
         self.modality_preprocessors = self._create_modality_preprocessors(
             video_frames,
@@ -150,120 +168,125 @@ class ImageBindModel(nn.Module):
         thermal_kernel_size=16,
         imu_embed_dim=512,
     ):
-        rgbt_stem = PatchEmbedGeneric(
-            proj_stem=[
-                PadIm2Video(pad_type="repeat", ntimes=2),
-                nn.Conv3d(
-                    in_channels=3,
-                    kernel_size=kernel_size,
-                    out_channels=vision_embed_dim,
-                    stride=kernel_size,
-                    bias=False,
-                ),
-            ]
-        )
-        rgbt_preprocessor = RGBDTPreprocessor(
-            img_size=[3, video_frames, 224, 224],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            rgbt_stem=rgbt_stem,
-            depth_stem=None,
-        )
-
-        text_preprocessor = TextPreprocessor(
-            context_length=77,
-            vocab_size=49408,
-            embed_dim=text_embed_dim,
-            causal_masking=True,
-        )
-
-        audio_stem = PatchEmbedGeneric(
-            proj_stem=[
-                nn.Conv2d(
-                    in_channels=1,
-                    kernel_size=audio_kernel_size,
-                    stride=audio_stride,
-                    out_channels=audio_embed_dim,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=audio_embed_dim),
-        )
-        audio_preprocessor = AudioPreprocessor(
-            img_size=[1, audio_num_mel_bins, audio_target_len],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            audio_stem=audio_stem,
-        )
-
-        depth_stem = PatchEmbedGeneric(
-            [
-                nn.Conv2d(
-                    kernel_size=depth_kernel_size,
-                    in_channels=1,
-                    out_channels=depth_embed_dim,
-                    stride=depth_kernel_size,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=depth_embed_dim),
-        )
-
-        depth_preprocessor = RGBDTPreprocessor(
-            img_size=[1, 224, 224],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            rgbt_stem=None,
-            depth_stem=depth_stem,
-        )
-
-        thermal_stem = PatchEmbedGeneric(
-            [
-                nn.Conv2d(
-                    kernel_size=thermal_kernel_size,
-                    in_channels=1,
-                    out_channels=thermal_embed_dim,
-                    stride=thermal_kernel_size,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=thermal_embed_dim),
-        )
-        thermal_preprocessor = ThermalPreprocessor(
-            img_size=[1, 224, 224],
-            num_cls_tokens=1,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            thermal_stem=thermal_stem,
-        )
-
-        imu_stem = PatchEmbedGeneric(
-            [
-                nn.Linear(
-                    in_features=48,
-                    out_features=imu_embed_dim,
-                    bias=False,
-                ),
-            ],
-            norm_layer=nn.LayerNorm(normalized_shape=imu_embed_dim),
-        )
+        modality_preprocessors = {}
+
+        if ModalityType.VISION in self.modalities:
+            rgbt_stem = PatchEmbedGeneric(
+                proj_stem=[
+                    PadIm2Video(pad_type="repeat", ntimes=2),
+                    nn.Conv3d(
+                        in_channels=3,
+                        kernel_size=kernel_size,
+                        out_channels=vision_embed_dim,
+                        stride=kernel_size,
+                        bias=False,
+                    ),
+                ]
+            )
+            rgbt_preprocessor = RGBDTPreprocessor(
+                img_size=[3, video_frames, 224, 224],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                rgbt_stem=rgbt_stem,
+                depth_stem=None,
+            )
+            modality_preprocessors[ModalityType.VISION] = rgbt_preprocessor
+
+        if ModalityType.TEXT in self.modalities:
+            text_preprocessor = TextPreprocessor(
+                context_length=77,
+                vocab_size=49408,
+                embed_dim=text_embed_dim,
+                causal_masking=True,
+            )
+            modality_preprocessors[ModalityType.TEXT] = text_preprocessor
+
+        if ModalityType.AUDIO in self.modalities:
+            audio_stem = PatchEmbedGeneric(
+                proj_stem=[
+                    nn.Conv2d(
+                        in_channels=1,
+                        kernel_size=audio_kernel_size,
+                        stride=audio_stride,
+                        out_channels=audio_embed_dim,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=audio_embed_dim),
+            )
+            audio_preprocessor = AudioPreprocessor(
+                img_size=[1, audio_num_mel_bins, audio_target_len],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                audio_stem=audio_stem,
+            )
+            modality_preprocessors[ModalityType.AUDIO] = audio_preprocessor
+
+        if ModalityType.DEPTH in self.modalities:
+            depth_stem = PatchEmbedGeneric(
+                [
+                    nn.Conv2d(
+                        kernel_size=depth_kernel_size,
+                        in_channels=1,
+                        out_channels=depth_embed_dim,
+                        stride=depth_kernel_size,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=depth_embed_dim),
+            )
 
-        imu_preprocessor = IMUPreprocessor(
-            img_size=[6, 2000],
-            num_cls_tokens=1,
-            kernel_size=8,
-            embed_dim=imu_embed_dim,
-            pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
-            imu_stem=imu_stem,
-        )
+            depth_preprocessor = RGBDTPreprocessor(
+                img_size=[1, 224, 224],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                rgbt_stem=None,
+                depth_stem=depth_stem,
+            )
+            modality_preprocessors[ModalityType.DEPTH] = depth_preprocessor
+
+        if ModalityType.THERMAL in self.modalities:
+            thermal_stem = PatchEmbedGeneric(
+                [
+                    nn.Conv2d(
+                        kernel_size=thermal_kernel_size,
+                        in_channels=1,
+                        out_channels=thermal_embed_dim,
+                        stride=thermal_kernel_size,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=thermal_embed_dim),
+            )
+            thermal_preprocessor = ThermalPreprocessor(
+                img_size=[1, 224, 224],
+                num_cls_tokens=1,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                thermal_stem=thermal_stem,
+            )
+            modality_preprocessors[ModalityType.THERMAL] = thermal_preprocessor
+
+        if ModalityType.IMU in self.modalities:
+            imu_stem = PatchEmbedGeneric(
+                [
+                    nn.Linear(
+                        in_features=48,
+                        out_features=imu_embed_dim,
+                        bias=False,
+                    ),
+                ],
+                norm_layer=nn.LayerNorm(normalized_shape=imu_embed_dim),
+            )
 
-        modality_preprocessors = {
-            ModalityType.VISION: rgbt_preprocessor,
-            ModalityType.TEXT: text_preprocessor,
-            ModalityType.AUDIO: audio_preprocessor,
-            ModalityType.DEPTH: depth_preprocessor,
-            ModalityType.THERMAL: thermal_preprocessor,
-            ModalityType.IMU: imu_preprocessor,
-        }
+            imu_preprocessor = IMUPreprocessor(
+                img_size=[6, 2000],
+                num_cls_tokens=1,
+                kernel_size=8,
+                embed_dim=imu_embed_dim,
+                pos_embed_fn=partial(SpatioTemporalPosEmbeddingHelper, learnable=True),
+                imu_stem=imu_stem,
+            )
+            modality_preprocessors[ModalityType.IMU] = imu_preprocessor
 
         return nn.ModuleDict(modality_preprocessors)
 
@@ -317,54 +340,60 @@ class ImageBindModel(nn.Module):
             )
 
         modality_trunks = {}
-        modality_trunks[ModalityType.VISION] = instantiate_trunk(
-            vision_embed_dim,
-            vision_num_blocks,
-            vision_num_heads,
-            pre_transformer_ln=True,
-            add_bias_kv=False,
-            drop_path=0.0,
-        )
-        modality_trunks[ModalityType.TEXT] = instantiate_trunk(
-            text_embed_dim,
-            text_num_blocks,
-            text_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=False,
-            drop_path=0.0,
-        )
-        modality_trunks[ModalityType.AUDIO] = instantiate_trunk(
-            audio_embed_dim,
-            audio_num_blocks,
-            audio_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=audio_drop_path,
-        )
-        modality_trunks[ModalityType.DEPTH] = instantiate_trunk(
-            depth_embed_dim,
-            depth_num_blocks,
-            depth_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=depth_drop_path,
-        )
-        modality_trunks[ModalityType.THERMAL] = instantiate_trunk(
-            thermal_embed_dim,
-            thermal_num_blocks,
-            thermal_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=thermal_drop_path,
-        )
-        modality_trunks[ModalityType.IMU] = instantiate_trunk(
-            imu_embed_dim,
-            imu_num_blocks,
-            imu_num_heads,
-            pre_transformer_ln=False,
-            add_bias_kv=True,
-            drop_path=imu_drop_path,
-        )
+        if ModalityType.VISION in self.modalities:
+            modality_trunks[ModalityType.VISION] = instantiate_trunk(
+                vision_embed_dim,
+                vision_num_blocks,
+                vision_num_heads,
+                pre_transformer_ln=True,
+                add_bias_kv=False,
+                drop_path=0.0,
+            )
+        if ModalityType.TEXT in self.modalities:
+            modality_trunks[ModalityType.TEXT] = instantiate_trunk(
+                text_embed_dim,
+                text_num_blocks,
+                text_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=False,
+                drop_path=0.0,
+            )
+        if ModalityType.AUDIO in self.modalities:
+            modality_trunks[ModalityType.AUDIO] = instantiate_trunk(
+                audio_embed_dim,
+                audio_num_blocks,
+                audio_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=audio_drop_path,
+            )
+        if ModalityType.DEPTH in self.modalities:
+            modality_trunks[ModalityType.DEPTH] = instantiate_trunk(
+                depth_embed_dim,
+                depth_num_blocks,
+                depth_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=depth_drop_path,
+            )
+        if ModalityType.THERMAL in self.modalities:
+            modality_trunks[ModalityType.THERMAL] = instantiate_trunk(
+                thermal_embed_dim,
+                thermal_num_blocks,
+                thermal_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=thermal_drop_path,
+            )
+        if ModalityType.IMU in self.modalities:
+            modality_trunks[ModalityType.IMU] = instantiate_trunk(
+                imu_embed_dim,
+                imu_num_blocks,
+                imu_num_heads,
+                pre_transformer_ln=False,
+                add_bias_kv=True,
+                drop_path=imu_drop_path,
+            )
 
         return nn.ModuleDict(modality_trunks)
 
@@ -380,75 +409,98 @@ class ImageBindModel(nn.Module):
     ):
         modality_heads = {}
 
-        modality_heads[ModalityType.VISION] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=vision_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(vision_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.VISION in self.modalities:
+            modality_heads[ModalityType.VISION] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=vision_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(vision_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.TEXT] = SelectEOSAndProject(
-            proj=nn.Sequential(
-                nn.LayerNorm(normalized_shape=text_embed_dim, eps=1e-6),
-                nn.Linear(text_embed_dim, out_embed_dim, bias=False),
+        if ModalityType.TEXT in self.modalities:
+            modality_heads[ModalityType.TEXT] = SelectEOSAndProject(
+                proj=nn.Sequential(
+                    nn.LayerNorm(normalized_shape=text_embed_dim, eps=1e-6),
+                    nn.Linear(text_embed_dim, out_embed_dim, bias=False),
+                )
             )
-        )
 
-        modality_heads[ModalityType.AUDIO] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=audio_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(audio_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.AUDIO in self.modalities:
+            modality_heads[ModalityType.AUDIO] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=audio_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(audio_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.DEPTH] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=depth_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(depth_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.DEPTH in self.modalities:
+            modality_heads[ModalityType.DEPTH] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=depth_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(depth_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.THERMAL] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=thermal_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Linear(thermal_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.THERMAL in self.modalities:
+            modality_heads[ModalityType.THERMAL] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=thermal_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Linear(thermal_embed_dim, out_embed_dim, bias=False),
+            )
 
-        modality_heads[ModalityType.IMU] = nn.Sequential(
-            nn.LayerNorm(normalized_shape=imu_embed_dim, eps=1e-6),
-            SelectElement(index=0),
-            nn.Dropout(p=0.5),
-            nn.Linear(imu_embed_dim, out_embed_dim, bias=False),
-        )
+        if ModalityType.IMU in self.modalities:
+            modality_heads[ModalityType.IMU] = nn.Sequential(
+                nn.LayerNorm(normalized_shape=imu_embed_dim, eps=1e-6),
+                SelectElement(index=0),
+                nn.Dropout(p=0.5),
+                nn.Linear(imu_embed_dim, out_embed_dim, bias=False),
+            )
 
         return nn.ModuleDict(modality_heads)
 
     def _create_modality_postprocessors(self, out_embed_dim):
         modality_postprocessors = {}
 
-        modality_postprocessors[ModalityType.VISION] = Normalize(dim=-1)
-        modality_postprocessors[ModalityType.TEXT] = nn.Sequential(
-            Normalize(dim=-1), LearnableLogitScaling(learnable=True)
-        )
-        modality_postprocessors[ModalityType.AUDIO] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=20.0, learnable=False),
-        )
-        modality_postprocessors[ModalityType.DEPTH] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
-        )
-        modality_postprocessors[ModalityType.THERMAL] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=10.0, learnable=False),
-        )
-        modality_postprocessors[ModalityType.IMU] = nn.Sequential(
-            Normalize(dim=-1),
-            LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
-        )
+        if ModalityType.VISION in self.modalities:
+            modality_postprocessors[ModalityType.VISION] = Normalize(dim=-1)
+        if ModalityType.TEXT in self.modalities:
+            modality_postprocessors[ModalityType.TEXT] = nn.Sequential(
+                Normalize(dim=-1), LearnableLogitScaling(learnable=True)
+            )
+        if ModalityType.AUDIO in self.modalities:
+            modality_postprocessors[ModalityType.AUDIO] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=20.0, learnable=False),
+            )
+        if ModalityType.DEPTH in self.modalities:
+            modality_postprocessors[ModalityType.DEPTH] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
+            )
+        if ModalityType.THERMAL in self.modalities:
+            modality_postprocessors[ModalityType.THERMAL] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=10.0, learnable=False),
+            )
+        if ModalityType.IMU in self.modalities:
+            modality_postprocessors[ModalityType.IMU] = nn.Sequential(
+                Normalize(dim=-1),
+                LearnableLogitScaling(logit_scale_init=5.0, learnable=False),
+            )
 
         return nn.ModuleDict(modality_postprocessors)
 
-    def forward(self, inputs):
+    def forward(self, inputs, features_only=False, out_layers=None):
+        '''
+            inputs: {modality: tensor}
+            features_only: only the out_layers tokens are needed, the trunk stops after the deepest
+                           requested block and the head and postprocessor are skipped
+            out_layers: the blocks whose tokens are returned, self.out_layers by default
+            return: {modality: (embedding or None when features_only, list of out_layers tokens)}
+        '''
+        out_layers = self.out_layers if out_layers is None else out_layers
+        stop_after_layer = max(out_layers) if features_only and out_layers else None
         outputs = {}
         for modality_key, modality_value in inputs.items():
+            if modality_key not in self.modality_trunks:
+                raise ValueError(f'the {modality_key} branch is not built, modalities: {self.modalities}')
             reduce_list = (
                 modality_value.ndim >= 5
             )  # Audio and Video inputs consist of multiple clips
@@ -465,9 +517,13 @@ class ImageBindModel(nn.Module):
                 trunk_inputs = modality_value["trunk"]
                 head_inputs = modality_value["head"]
 
-                modality_value, modality_full_value = self.modality_trunks[modality_key](**trunk_inputs, out_layers=self.out_layers)
-                
-                
+                modality_value, modality_full_value = self.modality_trunks[modality_key](
+                    **trunk_inputs, out_layers=out_layers, stop_after_layer=stop_after_layer)
+
+                if features_only:
+                    outputs[modality_key] = None, modality_full_value
+                    continue
+
                 modality_value = self.modality_heads[modality_key](
                     modality_value, **head_inputs
                 )
@@ -501,10 +557,56 @@ def imagebind_huge(args):
         out_embed_dim=1024,
         audio_drop_path=0.1,
         imu_drop_path=0.7,
-        layers = layers
+        layers = layers,
+        modalities = args.get('imagebind_modalities'),
     ), 1024
 
 
+def load_imagebind_checkpoint(model, ckpt_path, mapped=False, cache_dir=None):
+    '''
+        load a full imagebind checkpoint into a model that may only have some of the modalities,
+        the tensors of the other modalities are dropped instead of being copied
+        mapped: read the checkpoint through a model.checkpoint.MappedCheckpoint (converted once) and copy
+                every tensor straight into the existing parameters, in their dtype and on their device,
+                cache_dir is where the mapped copy goes (next to the checkpoint by default)
+        return: number of dropped tensors
+    '''
+    if mapped:
+        return _load_mapped_imagebind_checkpoint(model, ckpt_path, cache_dir)
+    load_kwargs = {'map_location': torch.device('cpu')}
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        # torch>=2.1: the file is mapped, the dropped tensors are never read
+        load_kwargs['mmap'] = True
+    try:
+        state_dict = torch.load(ckpt_path, **load_kwargs)
+    except RuntimeError:
+        # mmap needs the zip serialization format
+        load_kwargs.pop('mmap', None)
+        state_dict = torch.load(ckpt_path, **load_kwargs)
+    dropped = 0
+    for key in list(state_dict.keys()):
+        branch, modality = key.split('.')[:2]
+        if branch.startswith('modality_') and modality not in model.modalities:
+            del state_dict[key]
+            dropped += 1
+    # still strict for the modalities that were built
+    model.load_state_dict(state_dict, strict=True)
+    return dropped
+
+
+@torch.no_grad()
+def _load_mapped_imagebind_checkpoint(model, ckpt_path, cache_dir=None):
+    from ...checkpoint import MappedCheckpoint
+
+    checkpoint = MappedCheckpoint(ckpt_path, cache_dir)
+    destination = model.state_dict(keep_vars=True)
+    missing = [key for key in destination if key not in checkpoint]
+    assert not missing, f'keys missing from {ckpt_path}: {missing}'
+    for key, target in destination.items():
+        target.copy_(checkpoint[key])
+    return sum(1 for key in checkpoint.keys() if key not in destination)
+
+
 def save_module(module_dict: nn.ModuleDict, module_name: str = "",
                 checkpoint_dir: str = "./.checkpoints/full", postfix: str = "_last",
                 extension: str = "pth"):
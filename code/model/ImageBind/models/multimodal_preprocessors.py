@@ -133,14 +133,62 @@ class PatchEmbedGeneric(nn.Module):
             # trained with a standard stem
             self.proj = proj_stem[0]
         self.norm_layer = norm_layer
+        # single images skip the PadIm2Video frames and run the temporal kernel folded into a 2D one
+        self.fold_image_time = True
+
+    def image_stem(self):
+        """
+        The Conv3d of a [PadIm2Video, Conv3d] stem when its temporal kernel spans exactly the
+        ntimes padded frames, so a single frame gives a single output frame. None otherwise.
+        """
+        if not isinstance(self.proj, nn.Sequential) or len(self.proj) != 2:
+            return None
+        pad, conv = self.proj
+        if not isinstance(pad, PadIm2Video) or not isinstance(conv, nn.Conv3d) or pad.time_dim != 2:
+            return None
+        if (
+            conv.kernel_size[0] != pad.ntimes
+            or conv.stride[0] != pad.ntimes
+            or conv.padding[0] != 0
+            or conv.dilation[0] != 1
+            or conv.padding_mode != "zeros"
+        ):
+            return None
+        return conv
+
+    def image_forward(self, x, conv):
+        """
+        x: B x C x H x W (or B x C x 1 x H x W)
+        The ntimes repeated frames all meet the same input, so the Conv3d reduces to a Conv2d with
+        the kernel summed over time (zero padding only keeps the first kernel frame). Half the stem
+        FLOPs and no padded copy of the input.
+        return: B x D x 1 x h x w, like the Conv3d on the padded video
+        """
+        pad = self.proj[0]
+        if x.ndim == 5:
+            x = x.squeeze(2)
+        weight = conv.weight.sum(dim=2) if pad.pad_type == "repeat" else conv.weight[:, :, 0]
+        x = nn.functional.conv2d(
+            x,
+            weight,
+            conv.bias,
+            stride=conv.stride[1:],
+            padding=conv.padding[1:],
+            dilation=conv.dilation[1:],
+            groups=conv.groups,
+        )
+        return x.unsqueeze(2)
 
     def get_patch_layout(self, img_size):
+        # on the device of the stem, which is the meta device when the model is built empty
+        device = next(self.proj.parameters()).device
         with torch.no_grad():
             dummy_img = torch.zeros(
                 [
                     1,
                 ]
-                + img_size
+                + img_size,
+                device=device,
             )
             dummy_out = self.proj(dummy_img)
         embed_dim = dummy_out.shape[1]
@@ -149,7 +197,11 @@ class PatchEmbedGeneric(nn.Module):
         return patches_layout, num_patches, embed_dim
 
     def forward(self, x):
-        x = self.proj(x)
+        conv = self.image_stem() if self.fold_image_time else None
+        if conv is not None and (x.ndim == 4 or (x.ndim == 5 and x.shape[2] == 1)):
+            x = self.image_forward(x, conv)
+        else:
+            x = self.proj(x)
         # B C (T) H W -> B (T)HW C
         x = x.flatten(2).transpose(1, 2)
         if self.norm_layer is not None:
@@ -16,9 +16,15 @@ from typing import Callable, List, Optional
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import DropPath, trunc_normal_
 
+try:
+    import torch.ao.nn.quantized.dynamic as nnqd
+except ImportError:  # torch<1.13
+    import torch.nn.quantized.dynamic as nnqd
+
 
 class Attention(nn.Module):
     def __init__(
@@ -96,6 +102,19 @@ class MultiheadAttention(nn.MultiheadAttention):
         return super().forward(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
 
+def scaled_dot_product_attention(q, k, v, attn_mask=None):
+    """
+    q, k, v: B x heads x L x head_dim, attn_mask: additive L x L mask or None.
+    Uses the fused torch>=2.0 kernel when available and the explicit softmax otherwise.
+    """
+    if hasattr(F, "scaled_dot_product_attention"):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    attn = (q * q.shape[-1] ** -0.5) @ k.transpose(-2, -1)
+    if attn_mask is not None:
+        attn = attn + attn_mask
+    return attn.softmax(dim=-1) @ v
+
+
 class ViTAttention(Attention):
     def forward(self, x: torch.Tensor, attn_mask: torch.Tensor):
         assert attn_mask is None
@@ -121,6 +140,8 @@ class BlockWithMasking(nn.Module):
             attn_target, nn.Module
         ), "attn_target should be a Callable. Otherwise attn_target is shared across blocks!"
         self.attn = attn_target()
+        # int8 q, k, v projection once quantize_dynamic_ has replaced the float in_proj weight
+        self.qkv_proj = None
         if drop_path > 0.0:
             self.drop_path = DropPath(drop_path)
         else:
@@ -169,6 +190,59 @@ class BlockWithMasking(nn.Module):
             x = x + self.drop_path(self.mlp(self.norm_2(x))) # * self.layer_scale_gamma2
         return x
 
+    def supports_fast_forward(self):
+        attn = self.attn
+        return (
+            isinstance(attn, nn.MultiheadAttention)
+            and not attn.batch_first
+            and attn._qkv_same_embed_dim
+            and attn.bias_k is None
+            and (attn.in_proj_bias is not None or self.qkv_proj is not None)
+        )
+
+    @torch.no_grad()
+    def quantize_dynamic_(self):
+        """
+        CPU inference: int8 weights with dynamic (per batch) int8 activations for the q, k, v,
+        output and mlp projections, in place. The float in_proj weight is freed, so only
+        fast_forward can run the block afterwards.
+        """
+        assert self.supports_fast_forward() and self.qkv_proj is None
+        attn = self.attn
+        qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+        qkv = nn.Linear(attn.embed_dim, 3 * attn.embed_dim, device="meta")
+        qkv.weight, qkv.bias = attn.in_proj_weight, attn.in_proj_bias
+        for linear in (qkv, attn.out_proj, self.mlp.fc1, self.mlp.fc2):
+            linear.qconfig = qconfig
+        self.qkv_proj = nnqd.Linear.from_float(qkv)
+        attn.out_proj = nnqd.Linear.from_float(attn.out_proj)
+        self.mlp.fc1 = nnqd.Linear.from_float(self.mlp.fc1)
+        self.mlp.fc2 = nnqd.Linear.from_float(self.mlp.fc2)
+        attn.in_proj_weight = None
+        attn.in_proj_bias = None
+
+    def fast_forward(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
+        """
+        Inference-only forward with the same weights, see supports_fast_forward
+        - x: B x L x D, batch-first unlike forward
+        - attn_mask: additive L x L mask or None
+        DropPath and dropout are identities in eval and are skipped. The layer scale gammas
+        are not applied, like in forward.
+        """
+        B, L, D = x.shape
+        num_heads = self.attn.num_heads
+        # one matmul for q, k and v, nn.MultiheadAttention keeps them in a single in_proj weight
+        if self.qkv_proj is not None:
+            qkv = self.qkv_proj(self.norm_1(x))
+        else:
+            qkv = F.linear(self.norm_1(x), self.attn.in_proj_weight, self.attn.in_proj_bias)
+        q, k, v = qkv.view(B, L, 3, num_heads, D // num_heads).permute(2, 0, 3, 1, 4)
+        attn = scaled_dot_product_attention(q, k, v, attn_mask)
+        attn = attn.transpose(1, 2).reshape(B, L, D)
+        x = x + self.attn.out_proj(attn)
+        x = x + self.mlp.fc2(self.mlp.act(self.mlp.fc1(self.norm_2(x))))
+        return x
+
 
 _LAYER_NORM = partial(nn.LayerNorm, eps=1e-6)
 
@@ -190,6 +264,7 @@ class SimpleTransformer(nn.Module):
         layer_scale_type: Optional[str] = None,  # from cait; possible values are None, "per_channel", "scalar"
         layer_scale_init_value: float = 1e-4,  # from cait; float
         weight_init_style: str = "jax",  # possible values jax or pytorch
+        fast_inference: bool = True,
     ):
         """
         Simple Transformer with the following features
@@ -198,6 +273,7 @@ class SimpleTransformer(nn.Module):
         3. Supports LayerScale
         4. Supports Dropout in Attention and FFN
         5. Makes few assumptions about the input except that it is a Tensor
+        6. In eval, runs the blocks batch-first with fused attention when fast_inference is set
         """
         super().__init__()
         self.pre_transformer_layer = pre_transformer_layer
@@ -225,8 +301,24 @@ class SimpleTransformer(nn.Module):
         )
         self.post_transformer_layer = post_transformer_layer
         self.weight_init_style = weight_init_style
+        self.fast_inference = fast_inference
         self.apply(self._init_weights)
 
+    def use_fast_forward(self):
+        return (
+            self.fast_inference
+            and not self.training
+            and all(isinstance(blk, BlockWithMasking) and blk.supports_fast_forward() for blk in self.blocks)
+        )
+
+    def is_quantized(self):
+        return any(getattr(blk, "qkv_proj", None) is not None for blk in self.blocks)
+
+    def quantize_dynamic_(self):
+        """int8 dynamic quantization of every block for CPU inference, see BlockWithMasking.quantize_dynamic_"""
+        for blk in self.blocks:
+            blk.quantize_dynamic_()
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             if self.weight_init_style == "jax":
@@ -250,16 +342,20 @@ class SimpleTransformer(nn.Module):
         checkpoint_every_n: int = 1,
         checkpoint_blk_ids: Optional[List[int]] = None,
         # return_multi_layer_outputs = False,
-        out_layers = []
+        out_layers = [],
+        stop_after_layer: Optional[int] = None,
     ):
 
         """
         Inputs
         - tokens: data of shape N x L x D (or L x N x D depending on the attention implementation)
         - attn: mask of shape L x L
+        - stop_after_layer: run the blocks up to this index only and skip the post transformer layer,
+          for callers that only need the out_layers tokens
 
         Output
-        - x: data of shape N x L x D (or L x N x D depending on the attention implementation)
+        - x: data of shape N x L x D (or L x N x D depending on the attention implementation),
+          the raw output of the last block that ran when stopping early
         """
         out_tokens = []
 
@@ -273,6 +369,10 @@ class SimpleTransformer(nn.Module):
             ]
         if checkpoint_blk_ids:
             checkpoint_blk_ids = set(checkpoint_blk_ids)
+        if not use_checkpoint and self.use_fast_forward():
+            return self._fast_forward(tokens, attn_mask, out_layers, stop_after_layer)
+        if self.is_quantized():
+            raise RuntimeError("quantized blocks only run through the fast path: eval mode, fast_inference, no checkpointing")
         for blk_id, blk in enumerate(self.blocks):
             if use_checkpoint and blk_id in checkpoint_blk_ids:
                 tokens = checkpoint.checkpoint(
@@ -282,6 +382,29 @@ class SimpleTransformer(nn.Module):
                 tokens = blk(tokens, attn_mask=attn_mask)
             if blk_id in out_layers:
                 out_tokens.append(tokens)
+            if stop_after_layer is not None and blk_id >= stop_after_layer:
+                return tokens, out_tokens
+        if self.post_transformer_layer:
+            tokens = self.post_transformer_layer(tokens)
+        return tokens, out_tokens
+
+    def _fast_forward(self, tokens, attn_mask, out_layers, stop_after_layer):
+        # the blocks expect L x N x D here (nn.MultiheadAttention), run them batch-first and hand
+        # the out_layers tokens back as L x N x D views
+        x = tokens.transpose(0, 1)
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                # nn.MultiheadAttention masks the True positions
+                attn_mask = torch.zeros_like(attn_mask, dtype=x.dtype).masked_fill(attn_mask, float("-inf"))
+            attn_mask = attn_mask.to(x.dtype)
+        out_tokens = []
+        for blk_id, blk in enumerate(self.blocks):
+            x = blk.fast_forward(x, attn_mask)
+            if blk_id in out_layers:
+                out_tokens.append(x.transpose(0, 1))
+            if stop_after_layer is not None and blk_id >= stop_after_layer:
+                return x.transpose(0, 1), out_tokens
+        tokens = x.transpose(0, 1)
         if self.post_transformer_layer:
             tokens = self.post_transformer_layer(tokens)
         return tokens, out_tokens
@@ -1,4 +1,5 @@
 from header import *
+from .checkpoint import load_checkpoint
 import matplotlib.pyplot as plt
 
 class DeepSpeedAgent:
@@ -80,8 +81,7 @@ class DeepSpeedAgent:
         print(f'[!] save model into {path}')
 
     def load_stage_1_parameters(self, path):
-        delta_ckpt = torch.load(path, map_location=torch.device('cpu'))
-        self.model.load_state_dict(delta_ckpt, strict=False)
+        load_checkpoint(self.model, path)
 
     def plot_loss(self):
         plt.plot(self.loss_list)
@@ -0,0 +1,153 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from .checkpoint import write_tensor_file, file_sha256, mapped_tensor
+from .lora_merge import iter_merged_state_dict
+
+BUNDLE_FORMAT = 'anomalygpt-bundle'
+BUNDLE_VERSION = 1
+TEXT_FEATURE_PREFIX = 'text_features.'
+
+
+def bundle_tensors(model, modalities, dtype=torch.float16):
+    '''
+        every tensor an inference replica needs, prefixed like the attributes of OpenLLAMAPEFTModel,
+        floating point weights in dtype, the class text features stay fp32 like in TextFeatureCache
+        yield: (key, tensor)
+    '''
+    def cast(tensor):
+        return tensor.to(dtype) if tensor.is_floating_point() else tensor
+
+    for key, tensor in model.visual_encoder.state_dict().items():
+        branch, modality = key.split('.')[:2]
+        if branch.startswith('modality_') and modality not in modalities:
+            continue
+        yield f'visual_encoder.{key}', cast(tensor)
+    for name in ('image_decoder', 'prompt_learner', 'llama_proj'):
+        module = getattr(model, name, None)
+        if module is None:
+            continue
+        for key, tensor in module.state_dict().items():
+            yield f'{name}.{key}', cast(tensor)
+    if model.llama_model is not None:
+        for key, tensor in iter_merged_state_dict(model.llama_model):
+            yield f'llama_model.{key}', cast(tensor)
+    for class_name, feature in model.text_feature_cache.features.items():
+        yield f'{TEXT_FEATURE_PREFIX}{class_name}', feature.float()
+
+
+@torch.no_grad()
+def export_bundle(model, bundle_dir, class_names=None, dtype=torch.float16, modalities=None):
+    '''
+        pack an OpenLLAMAPEFTModel, with its ImageBind, PandaGPT and AnomalyGPT weights already loaded,
+        into bundle_dir: tensors.bin (every tensor raw at an aligned offset, LoRA merged into LLaMA),
+        manifest.json (offsets, config, fingerprints, sha256) and tokenizer/, see Bundle
+        class_names: the classes whose text features are computed (or taken from the cache) and stored
+        modalities: the ImageBind branches to keep, e.g. ['vision'] to drop the text trunk once the
+                    features of class_names are stored, all the built ones by default
+        return: the manifest
+    '''
+    modalities = list(modalities or model.visual_encoder.modalities)
+    missing = [modality for modality in modalities if modality not in model.visual_encoder.modalities]
+    assert not missing, f'the ImageBind branches {missing} are not built'
+    if class_names:
+        model.text_feature_cache.prefetch(class_names)
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    tensors, sha256, nbytes = write_tensor_file(bundle_tensors(model, modalities, dtype),
+                                                os.path.join(bundle_dir, 'tensors.bin'))
+    llama_config = None
+    if model.llama_model is not None:
+        llama_config = model.llama_model.config.to_dict()
+        model.llama_tokenizer.save_pretrained(os.path.join(bundle_dir, 'tokenizer'))
+
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'imagebind_modalities': modalities,
+        # a replica keeps using the memory banks and text features made from the same checkpoint
+        'imagebind_fingerprint': model.memory_bank.fingerprint,
+        'text_fingerprint': model.text_feature_cache.fingerprint,
+        'visual_hidden_size': model.visual_hidden_size,
+        'llama_config': llama_config,
+        'lora_merged': llama_config is not None,
+        'tensors': tensors,
+        'sha256': sha256,
+        'nbytes': nbytes,
+    }
+    tmp_path = os.path.join(bundle_dir, f'manifest.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(bundle_dir, 'manifest.json'))
+    print(f'[!] exported {len(tensors)} tensors ({nbytes / 2 ** 30:.2f} GB) into {bundle_dir}')
+    return manifest
+
+
+class Bundle:
+
+    '''An inference bundle written by export_bundle, memory-mapped.
+
+    The size of tensors.bin is always checked against the manifest, its sha256 only with
+    verify=True since that reads the whole file. Tensors are np.memmap views: nothing is
+    read before load_into copies them into a model that was built on the meta device and
+    materialized in its final dtype and device (see model/meta_init.py).
+    '''
+
+    def __init__(self, bundle_dir, verify=False):
+        self.bundle_dir = bundle_dir
+        with open(os.path.join(bundle_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != BUNDLE_FORMAT or self.manifest.get('version') != BUNDLE_VERSION:
+            raise RuntimeError(f'{bundle_dir} is not a version {BUNDLE_VERSION} {BUNDLE_FORMAT}: '
+                               f'{self.manifest.get("format")} version {self.manifest.get("version")}')
+        tensor_path = os.path.join(bundle_dir, 'tensors.bin')
+        size = os.path.getsize(tensor_path)
+        if size != self.manifest['nbytes']:
+            raise RuntimeError(f'{tensor_path} is {size} bytes, the manifest expects {self.manifest["nbytes"]}')
+        if verify:
+            sha256 = file_sha256(tensor_path)
+            if sha256 != self.manifest['sha256']:
+                raise RuntimeError(f'{tensor_path} checksum mismatch: {sha256}, the manifest expects {self.manifest["sha256"]}')
+        self.buffer = np.memmap(tensor_path, dtype=np.uint8, mode='c') if size > 0 else None
+
+    @property
+    def tokenizer_path(self):
+        return os.path.join(self.bundle_dir, 'tokenizer')
+
+    def keys(self):
+        return self.manifest['tensors'].keys()
+
+    def __contains__(self, key):
+        return key in self.manifest['tensors']
+
+    def __getitem__(self, key):
+        return mapped_tensor(self.buffer, self.manifest['tensors'][key])
+
+    def text_features(self):
+        '''class name -> 2 x embed_dim fp32 text features, like TextFeatureCache.features'''
+        return {key[len(TEXT_FEATURE_PREFIX):]: self[key].clone()
+                for key in self.keys() if key.startswith(TEXT_FEATURE_PREFIX)}
+
+    @torch.no_grad()
+    def load_into(self, module, prefix):
+        '''
+            copy the tensors under prefix (e.g. 'llama_model.') into module, strict in both directions,
+            every tensor lands in the dtype and on the device of the module
+        '''
+        destination = module.state_dict(keep_vars=True)
+        keys = [key[len(prefix):] for key in self.keys() if key.startswith(prefix)]
+        missing = [key for key in destination if prefix + key not in self]
+        unexpected = [key for key in keys if key not in destination]
+        if missing or unexpected:
+            raise RuntimeError(f'{self.bundle_dir} does not match the model under {prefix}: '
+                               f'missing {missing[:10]}, unexpected {unexpected[:10]}')
+        for key, target in destination.items():
+            source = self[prefix + key]
+            if target.shape != source.shape:
+                raise RuntimeError(f'shape mismatch for {prefix}{key}: bundle {tuple(source.shape)}, model {tuple(target.shape)}')
+            target.copy_(source)
@@ -0,0 +1,31 @@
+class ChatSession:
+
+    '''State of one conversation about one image, kept between turns (e.g. in a gr.State).
+
+    The image prefix [bos, '### Human: <Img>', image embedding, '</Img> ', prompt-learner tokens]
+    is prefilled once into `prefix_past_key_values`. `past_key_values` holds the conversation so
+    far on top of it, so a new turn only prefills the new human message. `ask` style callers can
+    restart from the prefix to ask several independent questions about the same image.
+    '''
+
+    def __init__(self, image_path, normal_img_path=None):
+        self.image_path = image_path
+        self.normal_img_path = normal_img_path
+        self.feature_embeds = None # 1 x 1 x embed_dim
+        self.anomaly_map = None # 1 x 1 x 224 x 224
+        self.anomaly_map_prompts = None # 1 x 18 x embed_dim
+        self.prefix_past_key_values = None
+        self.past_key_values = None
+        self.history = [] # (question, answer) pairs
+
+    def matches(self, image_path, normal_img_path=None):
+        return self.image_path == image_path and self.normal_img_path == normal_img_path
+
+    @property
+    def started(self):
+        return self.prefix_past_key_values is not None
+
+    def reset_conversation(self):
+        '''forget the turns but keep the image prefix'''
+        self.past_key_values = self.prefix_past_key_values
+        self.history = []
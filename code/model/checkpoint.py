@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from .feature_cache import checkpoint_fingerprint
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def write_tensor_file(tensors, path):
+    '''
+        write tensors (a dict, or an iterable of (key, tensor) pairs) raw and contiguous into one file
+        at 64 byte aligned offsets
+        return: {key: {dtype, shape, offset, nbytes}}, sha256 hex digest of the file, file size
+    '''
+    infos, offset, digest = {}, 0, hashlib.sha256()
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    items = tensors.items() if hasattr(tensors, 'items') else tensors
+    with open(tmp_path, 'wb') as f:
+        for key, tensor in items:
+            if not torch.is_tensor(tensor):
+                print(f'[!] {key} is not a tensor, skipped')
+                continue
+            data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+            padding = b'\0' * (-offset % ALIGNMENT)
+            for chunk in (padding, data):
+                f.write(chunk)
+                digest.update(chunk)
+            offset += len(padding)
+            infos[key] = {
+                'dtype': str(tensor.dtype).replace('torch.', ''),
+                'shape': list(tensor.shape),
+                'offset': offset,
+                'nbytes': len(data),
+            }
+            offset += len(data)
+    os.replace(tmp_path, path)
+    return infos, digest.hexdigest(), offset
+
+
+def file_sha256(path, chunk_size=64 * 2 ** 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def mapped_tensor(buffer, info):
+    '''a cpu tensor over buffer (a np.memmap of a write_tensor_file file), nothing is read before it is used'''
+    dtype = getattr(torch, info['dtype'])
+    if info['nbytes'] == 0:
+        return torch.empty(info['shape'], dtype=dtype)
+    data = buffer[info['offset']:info['offset'] + info['nbytes']]
+    return torch.frombuffer(data, dtype=dtype).reshape(info['shape'])
+
+
+class MappedCheckpoint:
+
+    '''A torch.save'd state dict converted once into a flat, memory-mappable tensor file.
+
+    `<path>.mmap/` (or `cache_dir/<name>.mmap/`) holds tensors.bin, every tensor stored raw
+    and contiguous at a 64 byte aligned offset, and manifest.json with the dtype, shape and
+    offset of each key plus the fingerprint of the source .pt. The file is opened with
+    np.memmap, so a tensor is only read from disk when it is copied into the model and the
+    full checkpoint never sits in host memory.
+    '''
+
+    def __init__(self, path, cache_dir=None):
+        self.source_path = path
+        name = os.path.basename(path) + '.mmap'
+        self.mmap_dir = os.path.join(cache_dir, name) if cache_dir is not None else path + '.mmap'
+        self.fingerprint = checkpoint_fingerprint(path)
+        self.manifest = self.read_manifest()
+        if self.manifest is None:
+            self.manifest = self.convert()
+        self.buffer = np.memmap(os.path.join(self.mmap_dir, 'tensors.bin'), dtype=np.uint8, mode='c')
+
+    def read_manifest(self):
+        path = os.path.join(self.mmap_dir, 'manifest.json')
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != FORMAT_VERSION or manifest.get('fingerprint') != self.fingerprint:
+            return None
+        return manifest
+
+    def convert(self):
+        print(f'[!] converting {self.source_path} into {self.mmap_dir}, done once per checkpoint')
+        state_dict = torch.load(self.source_path, map_location=torch.device('cpu'))
+        os.makedirs(self.mmap_dir, exist_ok=True)
+        tensors, _, _ = write_tensor_file(state_dict, os.path.join(self.mmap_dir, 'tensors.bin'))
+        del state_dict
+
+        manifest = {
+            'version': FORMAT_VERSION,
+            'source': os.path.abspath(self.source_path),
+            'fingerprint': self.fingerprint,
+            'tensors': tensors,
+        }
+        tmp_path = os.path.join(self.mmap_dir, f'manifest.json.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.mmap_dir, 'manifest.json'))
+        return manifest
+
+    def keys(self):
+        return self.manifest['tensors'].keys()
+
+    def __contains__(self, key):
+        return key in self.manifest['tensors']
+
+    def __getitem__(self, key):
+        '''a cpu tensor backed by the mapped file, nothing is read before it is used'''
+        return mapped_tensor(self.buffer, self.manifest['tensors'][key])
+
+
+@torch.no_grad()
+def load_checkpoint(model, path, cache_dir=None, verbose=True):
+    '''
+        drop-in for model.load_state_dict(torch.load(path), strict=False): the checkpoint is converted
+        once into a MappedCheckpoint and every tensor is copied straight into the matching parameter or
+        buffer, so it lands in the dtype and on the device the model already has (move the model first)
+        return: (missing_keys, unexpected_keys) like load_state_dict
+    '''
+    checkpoint = MappedCheckpoint(path, cache_dir)
+    destination = model.state_dict(keep_vars=True)
+    unexpected_keys, mismatched_keys, loaded = [], [], 0
+    for key in checkpoint.keys():
+        if key not in destination:
+            unexpected_keys.append(key)
+            continue
+        target = destination[key]
+        source = checkpoint[key]
+        if target.shape != source.shape:
+            mismatched_keys.append(f'{key}: checkpoint {tuple(source.shape)}, model {tuple(target.shape)}')
+            continue
+        target.copy_(source)
+        loaded += 1
+    missing_keys = [key for key in destination if key not in checkpoint]
+    if mismatched_keys:
+        raise RuntimeError(f'shape mismatch while loading {path}:\n' + '\n'.join(mismatched_keys))
+    if verbose:
+        print(f'[!] loaded {loaded} tensors from {path}, {len(unexpected_keys)} unexpected keys')
+        for key in unexpected_keys[:10]:
+            print(f'    unexpected: {key}')
+        if len(unexpected_keys) > 10:
+            print(f'    ... {len(unexpected_keys) - 10} more')
+    return missing_keys, unexpected_keys
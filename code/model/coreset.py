@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+
+
+def coreset_budget(num_patches, budget=None, ratio=None):
+    '''number of patches to keep, `budget` wins over `ratio`, the whole bank when neither is set'''
+    if budget is not None:
+        return max(1, min(int(budget), num_patches))
+    if ratio is not None:
+        return max(1, min(int(round(num_patches * ratio)), num_patches))
+    return num_patches
+
+
+def rows(tokens, start, end, device, normalize=False):
+    '''fp32 copy of tokens[start:end], numpy memory maps are only read chunk by chunk'''
+    if isinstance(tokens, np.ndarray):
+        chunk = torch.from_numpy(np.array(tokens[start:end], dtype=np.float32)).to(device)
+    else:
+        chunk = tokens[start:end].to(device=device, dtype=torch.float32)
+    if normalize:
+        chunk = chunk / chunk.norm(dim=-1, keepdim=True).clamp_min(1e-8)
+    return chunk
+
+
+def coreset_projection(dim, projection_dim=128, seed=0, device='cpu'):
+    '''dim x projection_dim random gaussian projection (Johnson-Lindenstrauss), None when it would not reduce the dimension'''
+    if projection_dim is None or projection_dim >= dim:
+        return None
+    generator = torch.Generator().manual_seed(seed)
+    return (torch.randn(dim, projection_dim, generator=generator) / projection_dim ** 0.5).to(device)
+
+
+def project_rows(chunk, projection, normalize=True):
+    '''n x C tokens -> the n x projection_dim fp32 features greedy_coreset selects on'''
+    chunk = chunk.float()
+    if normalize:
+        chunk = chunk / chunk.norm(dim=-1, keepdim=True).clamp_min(1e-8)
+    return chunk @ projection if projection is not None else chunk
+
+
+def greedy_coreset(tokens, budget, projection_dim=128, chunk_size=65536, seed=0, device=None, normalize=True, features=None):
+    '''
+        greedy k-center selection: every step adds the patch that is farthest from the patches
+        selected so far, so each remaining patch stays within the coverage radius of a kept one
+        tokens: N x C patch tokens (torch or numpy, may be a memory-mapped fp16 array)
+        budget: number of patches to keep
+        projection_dim: distances are computed after a random gaussian projection to this size
+                        (Johnson-Lindenstrauss), None keeps the full dimension
+        chunk_size: patches processed at once, only N distances and the N x projection_dim copy are kept
+        normalize: work on unit-norm tokens, the few-shot search compares patches by cosine similarity
+                   and a radius r then guarantees a similarity of at least 1 - r^2 / 2
+        features: the N x projection_dim features, already computed with coreset_projection(dim, projection_dim, seed)
+                  and project_rows while the tokens were streamed in, tokens are then only read for the radius
+        return: the selected indices (budget), the coverage radius (max distance of a patch to its nearest selected patch)
+    '''
+    num_patches, dim = tokens.shape
+    device = device if device is not None else getattr(tokens, 'device', 'cpu')
+    budget = min(budget, num_patches)
+
+    projection = coreset_projection(dim, projection_dim, seed, device)
+    if features is None:
+        features = torch.cat([project_rows(rows(tokens, start, start + chunk_size, device), projection, normalize)
+                              for start in range(0, num_patches, chunk_size)], dim=0)
+    features = features.to(device)
+    assert features.shape[0] == num_patches
+
+    def distances_to(index):
+        center = features[index:index + 1]
+        return torch.cat([torch.cdist(features[start:start + chunk_size], center).squeeze(1)
+                          for start in range(0, num_patches, chunk_size)])
+
+    generator = torch.Generator().manual_seed(seed)
+    selected = [int(torch.randint(num_patches, (1,), generator=generator))]
+    min_distances = distances_to(selected[0])
+    for _ in range(budget - 1):
+        index = int(torch.argmax(min_distances))
+        selected.append(index)
+        min_distances = torch.minimum(min_distances, distances_to(index))
+
+    # the radius is measured in the full feature space, not in the projection
+    radius = coverage_radius(tokens, torch.tensor(selected), device=device, normalize=normalize) if projection is not None \
+        else float(min_distances.max())
+    return torch.tensor(selected, dtype=torch.long), radius
+
+
+def coverage_radius(tokens, selected, chunk_size=8192, device=None, normalize=True):
+    '''max over all patches of the euclidean distance to the nearest selected patch'''
+    device = device if device is not None else getattr(tokens, 'device', 'cpu')
+    selected = selected.tolist()
+    centers = torch.cat([rows(tokens, index, index + 1, device, normalize) for index in selected], dim=0)
+    radius = 0.
+    for start in range(0, tokens.shape[0], chunk_size):
+        chunk = rows(tokens, start, start + chunk_size, device, normalize)
+        # a chunk x centers distance matrix at a time, a bank can keep tens of thousands of centers
+        nearest = torch.full((chunk.shape[0],), float('inf'), device=device)
+        for center_start in range(0, centers.shape[0], chunk_size):
+            distances = torch.cdist(chunk, centers[center_start:center_start + chunk_size])
+            nearest = torch.minimum(nearest, distances.min(dim=1)[0])
+        radius = max(radius, float(nearest.max()))
+    return radius
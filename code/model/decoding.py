@@ -0,0 +1,125 @@
+import torch
+from .modeling_llama import StaticKVCache
+
+
+def sample_next_token(logits, top_p=1.0, temperature=1.0, top_k=50):
+    '''
+        sampling with the same semantics as the transformers Temperature/TopK/TopP warpers,
+        top_k defaults to 50 like generate does
+        logits: bsz x vocab
+        return: bsz sampled token ids
+    '''
+    logits = logits.float()
+    if temperature is not None and temperature > 0 and temperature != 1.0:
+        logits = logits / temperature
+    if top_k is not None and 0 < top_k < logits.shape[-1]:
+        kth = torch.topk(logits, top_k, dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # drop the tokens once the mass before them already reaches top_p, the most likely one always stays
+        sorted_remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) >= top_p
+        sorted_remove[..., 0] = False
+        remove = sorted_remove.scatter(-1, sorted_indices, sorted_remove)
+        logits = logits.masked_fill(remove, float('-inf'))
+    probs = logits.softmax(dim=-1)
+    return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+
+def truncate_past_key_values(past_key_values, length):
+    '''keep the first `length` positions of every layer's bsz x heads x seq x head_dim key and value'''
+    if isinstance(past_key_values, StaticKVCache):
+        return past_key_values.truncate(length)
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def past_length(past_key_values):
+    if isinstance(past_key_values, StaticKVCache):
+        return past_key_values.length
+    return 0 if past_key_values is None else past_key_values[0][0].shape[2]
+
+
+def index_past_key_values(past_key_values, index):
+    '''keep the rows `index` (a device tensor) of every layer's key and value'''
+    if isinstance(past_key_values, StaticKVCache):
+        return past_key_values.index_select(index)
+    return tuple((key.index_select(0, index), value.index_select(0, index)) for key, value in past_key_values)
+
+
+@torch.no_grad()
+def decode_batch(model, embed_tokens, inputs_embeds, attention_mask, max_new_tokens, top_p=1.0, temperature=1.0,
+                 stop_sequences=((2277,),), pad_token_id=0, sync_every=8, do_sample=True, top_k=50, static_cache=False,
+                 eos_token_id=None):
+    '''
+        batched sampling loop that keeps everything on the device between host syncs
+        model: causal lm taking inputs_embeds / attention_mask / position_ids / past_key_values
+        embed_tokens: token ids -> embeddings
+        inputs_embeds: bsz x s x embed_dim left-padded prompts, attention_mask: bsz x s
+        stop_sequences: a row is finished once its last generated tokens equal one of these sequences
+        eos_token_id: a row is also finished once it generates this token, like generate does
+        sync_every: finished rows are only read on the host, and compacted out of the active batch, every that many steps
+        static_cache: decode into a StaticKVCache sized to prompt + max_new_tokens instead of growing the cache every step
+        return: bsz lists of generated ids, the stop sequence (or eos) included
+    '''
+    batch_size = inputs_embeds.shape[0]
+    device = inputs_embeds.device
+    window_size = max(len(stop) for stop in stop_sequences)
+    stops = [torch.tensor(stop, dtype=torch.long, device=device) for stop in stop_sequences]
+
+    output_ids = torch.full((batch_size, max_new_tokens), pad_token_id, dtype=torch.long, device=device)
+    lengths = torch.full((batch_size,), max_new_tokens, dtype=torch.long, device=device)
+    rows = torch.arange(batch_size, device=device) # index of every active row in the full batch
+    done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    window = torch.full((batch_size, window_size), -1, dtype=torch.long, device=device)
+
+    attention_mask = attention_mask.long()
+    # left padding: positions count the real tokens only, like prepare_inputs_for_generation
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    embeds, past_key_values = inputs_embeds, None
+    if static_cache:
+        past_key_values = StaticKVCache.allocate(model.config, batch_size, inputs_embeds.shape[1] + max_new_tokens,
+                                                 inputs_embeds.dtype, device)
+    for step in range(max_new_tokens):
+        outputs = model(
+            inputs_embeds=embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        past_key_values = outputs.past_key_values
+        logits = outputs.logits[:, -1, :]
+        if do_sample:
+            next_tokens = sample_next_token(logits, top_p, temperature, top_k)
+        else:
+            next_tokens = logits.argmax(dim=-1)
+        # rows that finished since the last sync keep running until they are compacted, their tokens are discarded
+        output_ids[rows, step] = torch.where(done, torch.full_like(next_tokens, pad_token_id), next_tokens)
+
+        window = torch.cat([window[:, 1:], next_tokens.unsqueeze(1)], dim=1)
+        finished = torch.zeros_like(done)
+        for stop in stops:
+            finished |= (window[:, window_size - len(stop):] == stop).all(dim=1)
+        if eos_token_id is not None:
+            finished |= next_tokens == eos_token_id
+        newly_done = finished & ~done
+        lengths[rows] = torch.where(newly_done, torch.full_like(lengths[rows], step + 1), lengths[rows])
+        done = done | finished
+
+        if (step + 1) % sync_every == 0 or step + 1 == max_new_tokens:
+            keep = (~done).nonzero(as_tuple=True)[0] # the only host sync
+            if keep.numel() == 0:
+                break
+            if keep.numel() < rows.numel():
+                rows, done, window, next_tokens = rows[keep], done[keep], window[keep], next_tokens[keep]
+                attention_mask, position_ids = attention_mask[keep], position_ids[keep]
+                past_key_values = index_past_key_values(past_key_values, keep)
+
+        embeds = embed_tokens(next_tokens.unsqueeze(1))
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=1)
+        position_ids = position_ids[:, -1:] + 1
+
+    output_ids, lengths = output_ids.tolist(), lengths.tolist()
+    return [ids[:length] for ids, length in zip(output_ids, lengths)]
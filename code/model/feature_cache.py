@@ -0,0 +1,91 @@
+import hashlib
+import os
+
+import torch
+
+
+def checkpoint_fingerprint(path, extra=''):
+    '''cheap fingerprint of a checkpoint file: its location, size and modification time'''
+    stat = os.stat(path)
+    key = f'{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{extra}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class TextFeatureCache:
+
+    '''Normalized [normal, abnormal] prompt-ensemble text features, keyed by class name.
+
+    The text encoder is frozen, so the features only depend on the class name and on the
+    checkpoint. They are computed once per class, kept in memory (per device and dtype as
+    well, to skip the host-to-device copy) and persisted to `cache_dir` so that other workers
+    and later runs reuse them.
+    '''
+
+    def __init__(self, encode_fn, fingerprint, cache_dir=None):
+        # encode_fn: list of n class names -> n x 2 x embed_dim
+        self.encode_fn = encode_fn
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir
+        self.features = {} # class name -> 2 x embed_dim, fp32 on cpu
+        self.device_features = {}
+        if self.cache_path is not None and os.path.isfile(self.cache_path):
+            # e.g. truncated by a crash: the features are recomputed and the file rewritten on the next save
+            try:
+                self.features.update(torch.load(self.cache_path, map_location='cpu'))
+            except Exception as e:
+                print(f'[!] ignoring unreadable text feature cache {self.cache_path}: {e}')
+
+    @property
+    def cache_path(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'text_features_{self.fingerprint}.pt')
+
+    @staticmethod
+    def class_key(class_name):
+        return class_name.replace('_', ' ')
+
+    def __contains__(self, class_name):
+        return self.class_key(class_name) in self.features
+
+    def prefetch(self, class_names):
+        '''compute every missing class in a single text encoder pass'''
+        missing = [name for name in dict.fromkeys(map(self.class_key, class_names)) if name not in self.features]
+        if not missing:
+            return
+        with torch.no_grad():
+            text_features = self.encode_fn(missing)
+        for name, feature in zip(missing, text_features):
+            self.features[name] = feature.detach().float().cpu()
+        self.save()
+
+    def get(self, class_names, device, dtype=torch.float32):
+        '''
+            class_names: list of n class names, duplicates are computed once
+            return: n x 2 x embed_dim
+        '''
+        keys = [self.class_key(name) for name in class_names]
+        self.prefetch(keys)
+        features = []
+        for key in keys:
+            cache_key = (key, str(device), dtype)
+            if cache_key not in self.device_features:
+                self.device_features[cache_key] = self.features[key].to(device=device, dtype=dtype)
+            features.append(self.device_features[cache_key])
+        return torch.stack(features, dim=0)
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        features = {}
+        # keep the classes added by other workers since we loaded the file
+        if os.path.isfile(self.cache_path):
+            try:
+                features.update(torch.load(self.cache_path, map_location='cpu'))
+            except Exception as e:
+                print(f'[!] ignoring unreadable text feature cache {self.cache_path}: {e}')
+        features.update(self.features)
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        torch.save(features, tmp_path)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,118 @@
+import torch
+from torch import nn
+
+
+def lora_layers(model):
+    '''(name, module) of every peft LoRA linear inside model'''
+    for name, module in model.named_modules():
+        if hasattr(module, 'lora_A') and hasattr(module, 'scaling') and len(module.lora_A) > 0:
+            yield name, module
+
+
+def lora_delta(module, adapter_name=None):
+    '''
+        the weight update of a LoRA linear, scaling * B @ A, computed in fp32 on the weight's device
+        return: out_features x in_features (laid out like module.weight), fp32
+    '''
+    adapter_name = adapter_name or module.active_adapter
+    lora_A = module.lora_A[adapter_name].weight.float() # r x in_features
+    lora_B = module.lora_B[adapter_name].weight.float() # out_features x r
+    delta = (lora_B @ lora_A) * module.scaling[adapter_name]
+    if module.fan_in_fan_out:
+        delta = delta.T
+    return delta
+
+
+def causal_lm(model):
+    '''the LlamaForCausalLM inside a peft model (PeftModel -> LoraModel -> model), or model itself'''
+    if hasattr(model, 'base_model') and hasattr(model.base_model, 'model'):
+        return model.base_model.model
+    return model
+
+
+@torch.no_grad()
+def iter_merged_state_dict(model):
+    '''
+        the state dict of the LlamaForCausalLM inside a peft model with every LoRA adapter folded into
+        its base weight, one tensor at a time so a single merged weight is alive at once. The keys are
+        the ones of a plain LlamaForCausalLM, the lora_A / lora_B tensors are left out.
+        yield: (key, tensor)
+    '''
+    lm = causal_lm(model)
+    layers = dict(lora_layers(lm))
+    for key, tensor in lm.state_dict().items():
+        if '.lora_' in key:
+            continue
+        module_name, _, param_name = key.rpartition('.')
+        layer = layers.get(module_name)
+        if layer is not None and param_name == 'weight' and not layer.merged and not layer.disable_adapters:
+            tensor = (tensor.float() + lora_delta(layer)).to(tensor.dtype)
+        yield key, tensor
+
+
+def merged_state_dict(model):
+    '''iter_merged_state_dict as a dict, holds every merged weight at once'''
+    return dict(iter_merged_state_dict(model))
+
+
+@torch.no_grad()
+def merge_lora(model, keep_base=False):
+    '''
+        fold every LoRA adapter of model into its base weight in place, the forward of a merged
+        peft layer is then a single linear. The adapters are kept so unmerge_lora can undo it.
+        keep_base: keep a cpu copy of every base weight so unmerge_lora restores it bit for bit,
+                   otherwise the delta is subtracted again (within a rounding step of fp16 weights)
+        return: number of merged layers
+    '''
+    merged = 0
+    for _, layer in lora_layers(model):
+        if layer.merged or layer.disable_adapters:
+            continue
+        if keep_base:
+            layer.lora_base_weight = layer.weight.detach().to('cpu', copy=True)
+        layer.weight.copy_(layer.weight.float() + lora_delta(layer))
+        layer.merged = True
+        merged += 1
+    return merged
+
+
+@torch.no_grad()
+def unmerge_lora(model):
+    '''
+        undo merge_lora, e.g. before training the adapters again
+        return: number of unmerged layers
+    '''
+    unmerged = 0
+    for _, layer in lora_layers(model):
+        if not layer.merged:
+            continue
+        base_weight = getattr(layer, 'lora_base_weight', None)
+        if base_weight is not None:
+            layer.weight.copy_(base_weight)
+            del layer.lora_base_weight
+        else:
+            layer.weight.copy_(layer.weight.float() - lora_delta(layer))
+        layer.merged = False
+        unmerged += 1
+    return unmerged
+
+
+@torch.no_grad()
+def unload_lora(model):
+    '''
+        merge the adapters and replace every LoRA linear by a plain nn.Linear sharing its weight,
+        the peft wrapper is dropped as well. This can not be undone.
+        return: the plain LlamaForCausalLM
+    '''
+    lm = causal_lm(model)
+    for name, layer in list(lora_layers(lm)):
+        if not layer.merged and not layer.disable_adapters:
+            layer.weight.copy_(layer.weight.float() + lora_delta(layer))
+        weight = layer.weight.T if layer.fan_in_fan_out else layer.weight
+        linear = nn.Linear(weight.shape[1], weight.shape[0], bias=layer.bias is not None, device='meta')
+        linear.weight = nn.Parameter(weight.detach(), requires_grad=False)
+        if layer.bias is not None:
+            linear.bias = nn.Parameter(layer.bias.detach(), requires_grad=False)
+        parent_name, _, child_name = name.rpartition('.')
+        setattr(lm.get_submodule(parent_name), child_name, linear)
+    return lm
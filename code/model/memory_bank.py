@@ -0,0 +1,162 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from .coreset import coreset_budget, coreset_projection, project_rows, greedy_coreset
+from .patch_knn import build_patch_index
+
+
+class NormalMemoryBank:
+
+    '''Multi-layer patch tokens of the normal reference images of each class.
+
+    A class is encoded once with `build` and stored under `bank_dir/<class_id>/` as one fp16
+    .npy file per layer (num_patches x dim) plus a manifest.json. The files are opened with
+    np.load(mmap_mode='r'), so several workers share the page cache instead of each holding
+    a copy, and `get` only moves a class to the device the first time it is queried.
+    '''
+
+    def __init__(self, bank_dir, fingerprint=''):
+        self.bank_dir = bank_dir
+        self.fingerprint = fingerprint # the tokens are only valid for the vision checkpoint they came from
+        self.device_tokens = {}
+
+    def class_dir(self, class_id):
+        return os.path.join(self.bank_dir, str(class_id))
+
+    def manifest(self, class_id):
+        path = os.path.join(self.class_dir(class_id), 'manifest.json')
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('fingerprint') != self.fingerprint:
+            return None
+        return manifest
+
+    def __contains__(self, class_id):
+        return self.manifest(class_id) is not None
+
+    def build(self, class_id, image_paths, encode_fn, with_rotation=False, chunk_size=8, force=False,
+              coreset_size=None, coreset_ratio=None, coreset_device=None):
+        '''
+            image_paths: the normal reference images of the class
+            encode_fn: list of paths -> list (one per layer) of n x num_patches x dim
+            with_rotation: whether encode_fn also returns the rot90 variants, only recorded in the manifest
+            coreset_size / coreset_ratio: keep a greedy k-center coreset of that many patches (or that
+                                          fraction of them) per layer, see model/coreset.py
+            return: the manifest of the class
+        '''
+        image_paths = list(image_paths)
+        if not image_paths:
+            raise ValueError(f'[!] no normal reference images for {class_id}, leave normal_class_id unset for zero-shot')
+        coreset = {'size': coreset_size, 'ratio': coreset_ratio}
+        manifest = self.manifest(class_id)
+        if not force and manifest is not None and manifest['image_paths'] == image_paths \
+                and manifest['with_rotation'] == with_rotation \
+                and {key: manifest.get('coreset', {}).get(key) for key in coreset} == coreset:
+            return manifest
+
+        class_dir = self.class_dir(class_id)
+        os.makedirs(class_dir, exist_ok=True)
+        use_coreset = coreset_size is not None or coreset_ratio is not None
+        coreset_device = coreset_device if coreset_device is not None else 'cpu'
+        # every layer is streamed to a raw fp16 file on disk, only the projected coreset features stay in memory
+        raw_paths, dims, projections, features = [], [], [], []
+        raw_files, num_patches = [], 0
+        try:
+            with torch.no_grad():
+                for start in range(0, len(image_paths), chunk_size):
+                    patch_tokens = encode_fn(image_paths[start:start + chunk_size])
+                    if not raw_files:
+                        for layer, tokens in enumerate(patch_tokens):
+                            raw_paths.append(os.path.join(class_dir, f'layer_{layer}.{os.getpid()}.tmp.raw'))
+                            raw_files.append(open(raw_paths[-1], 'wb'))
+                            dims.append(tokens.shape[-1])
+                            projections.append(coreset_projection(tokens.shape[-1], device=coreset_device) if use_coreset else None)
+                            features.append([])
+                    for layer, tokens in enumerate(patch_tokens):
+                        tokens = tokens.reshape(-1, tokens.shape[-1]).to(torch.float16) # as stored
+                        raw_files[layer].write(tokens.cpu().numpy().tobytes())
+                        if use_coreset:
+                            features[layer].append(project_rows(tokens.to(coreset_device), projections[layer]))
+                    num_patches += tokens.shape[0]
+        except BaseException:
+            for path in raw_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            for f in raw_files:
+                f.close()
+
+        shapes = []
+        budget = coreset_budget(num_patches, coreset_size, coreset_ratio)
+        coreset['radius'] = []
+        for layer, raw_path in enumerate(raw_paths):
+            tokens = np.memmap(raw_path, dtype=np.float16, mode='r', shape=(num_patches, dims[layer]))
+            if budget < num_patches:
+                # the selection runs on the projected features, the full tokens are only read back chunk by
+                # chunk for the coverage radius and for the selected rows
+                selected, radius = greedy_coreset(tokens, budget, device=coreset_device, features=torch.cat(features[layer]))
+                tokens = tokens[np.sort(selected.numpy())]
+                coreset['radius'].append(radius)
+            features[layer] = None
+            shapes.append(list(tokens.shape))
+            tmp_path = os.path.join(class_dir, f'layer_{layer}.{os.getpid()}.tmp.npy')
+            np.save(tmp_path, tokens)
+            os.replace(tmp_path, os.path.join(class_dir, f'layer_{layer}.npy'))
+            del tokens
+            os.remove(raw_path)
+
+        manifest = {
+            'class_id': str(class_id),
+            'image_paths': image_paths,
+            'with_rotation': with_rotation,
+            'num_layers': len(raw_paths),
+            'num_patches': num_patches,
+            'shapes': shapes,
+            'coreset': coreset,
+            'dtype': 'float16',
+            'fingerprint': self.fingerprint,
+        }
+        # the manifest is written last, a bank without one is never served
+        tmp_path = os.path.join(class_dir, f'manifest.json.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(class_dir, 'manifest.json'))
+
+        self.device_tokens = {key: value for key, value in self.device_tokens.items() if key[0] != str(class_id)}
+        if coreset['radius']:
+            radius = ', '.join(f'{r:.4f}' for r in coreset['radius'])
+            print(f'[!] memory bank {class_id}: coreset of {budget} / {num_patches} patches per layer, coverage radius {radius}')
+        print(f'[!] memory bank {class_id}: {len(image_paths)} normal images, {shapes[0][0]} patches per layer')
+        return manifest
+
+    def load(self, class_id):
+        '''return: list (one per layer) of read-only memory-mapped num_patches x dim fp16 arrays'''
+        manifest = self.manifest(class_id)
+        if manifest is None:
+            raise KeyError(f'no memory bank for class {class_id} in {self.bank_dir}, build it first')
+        class_dir = self.class_dir(class_id)
+        return [np.load(os.path.join(class_dir, f'layer_{layer}.npy'), mmap_mode='r') for layer in range(manifest['num_layers'])]
+
+    def get(self, class_id, device, dtype=torch.float16, index=None):
+        '''
+            return: list (one per layer) of num_patches x dim tensors, kept on `device` after the first call
+            index: 'exact', 'fp16' or 'ivfpq' returns one patch index per layer instead (see model/patch_knn.py),
+                   built on `device` the first time, few_shot_anomaly_map searches it like the tokens
+        '''
+        cache_key = (str(class_id), str(device), dtype if index is None else index)
+        if cache_key not in self.device_tokens:
+            if index is None:
+                self.device_tokens[cache_key] = [
+                    torch.tensor(tokens).to(device=device, dtype=dtype) for tokens in self.load(class_id)
+                ]
+            else:
+                self.device_tokens[cache_key] = [
+                    build_patch_index(torch.tensor(tokens).to(device), index).to(device) for tokens in self.load(class_id)
+                ]
+        return self.device_tokens[cache_key]
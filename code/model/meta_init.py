@@ -0,0 +1,86 @@
+import contextlib
+import json
+import os
+
+import torch
+from torch import nn
+
+from .checkpoint import load_checkpoint
+
+
+@contextlib.contextmanager
+def init_on_meta():
+    '''
+        parameters registered inside the context are created on the meta device: modules are built
+        without allocating or random-initializing their weights, see materialize. Buffers stay real,
+        they are small and often computed in __init__ (rotary tables, masks, positional embeddings)
+    '''
+    register_parameter = nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None and param.device.type != 'meta':
+            param_cls = type(module._parameters[name])
+            kwargs = module._parameters[name].__dict__
+            module._parameters[name] = param_cls(module._parameters[name].to('meta'), **kwargs)
+
+    nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def materialize(module, device, dtype=None):
+    '''
+        replace every meta parameter of module by an uninitialized tensor on device, in dtype for floating
+        point ones, and move the buffers there. The values have to come from a checkpoint afterwards.
+        return: module
+    '''
+    for submodule in module.modules():
+        for name, param in list(submodule._parameters.items()):
+            if param is None:
+                continue
+            param_dtype = dtype if dtype is not None and param.is_floating_point() else param.dtype
+            if param.device.type == 'meta':
+                data = torch.empty(param.shape, device=device, dtype=param_dtype)
+            else:
+                data = param.data.to(device=device, dtype=param_dtype)
+            submodule._parameters[name] = nn.Parameter(data, requires_grad=param.requires_grad)
+        for name, buffer in list(submodule._buffers.items()):
+            if buffer is None:
+                continue
+            buffer_dtype = dtype if dtype is not None and buffer.is_floating_point() else buffer.dtype
+            submodule._buffers[name] = buffer.to(device=device, dtype=buffer_dtype)
+    return module
+
+
+def reset_lora_parameters(module):
+    '''LoRA adapters are not in the base checkpoints, give them their usual init (A kaiming, B zero)'''
+    for submodule in module.modules():
+        if hasattr(submodule, 'reset_lora_parameters') and hasattr(submodule, 'lora_A'):
+            for adapter_name in submodule.lora_A.keys():
+                submodule.reset_lora_parameters(adapter_name)
+
+
+def pretrained_weight_files(pretrained_dir):
+    '''the pytorch_model*.bin shards of a save_pretrained directory'''
+    index_path = os.path.join(pretrained_dir, 'pytorch_model.bin.index.json')
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            shards = sorted(set(json.load(f)['weight_map'].values()))
+        return [os.path.join(pretrained_dir, shard) for shard in shards]
+    return [os.path.join(pretrained_dir, 'pytorch_model.bin')]
+
+
+def load_pretrained_weights(model, pretrained_dir, cache_dir=None):
+    '''
+        copy the shards of pretrained_dir into an already materialized model (e.g. the LlamaForCausalLM
+        inside the peft wrapper), every shard is memory-mapped, see model/checkpoint.py
+        return: the keys of model that none of the shards had
+    '''
+    loaded = set()
+    for path in pretrained_weight_files(pretrained_dir):
+        missing_keys, _ = load_checkpoint(model, path, cache_dir=cache_dir)
+        loaded.update(key for key in model.state_dict() if key not in missing_keys)
+    return [key for key in model.state_dict() if key not in loaded]
@@ -20,6 +20,18 @@ logger = logging.get_logger(__name__)
 
 _CONFIG_FOR_DOC = "LlamaConfig"
 
+# torch.nn.functional.scaled_dot_product_attention only exists from torch 2.0 on
+_SDPA_AVAILABLE = hasattr(nn.functional, "scaled_dot_product_attention")
+
+
+def _attention_backend(config):
+    # `config.attention_backend` is "eager" (explicit softmax, the default) or "sdpa"
+    backend = getattr(config, "attention_backend", "eager")
+    if backend == "sdpa" and not _SDPA_AVAILABLE:
+        logger.warning_once("attention_backend='sdpa' needs torch>=2.0, falling back to the eager attention")
+        return "eager"
+    return backend
+
 
 # Copied from transformers.models.bart.modeling_bart._make_causal_mask
 def _make_causal_mask(
@@ -168,6 +180,86 @@ class LlamaMLP(nn.Module):
         return self.down_proj(dropped_output) 
 
 
+class StaticKVCache:
+    """
+    Preallocated key / value buffers of every layer, [bsz, nh, max_length, hd] each, filled in place at the write
+    index `length` instead of concatenating the whole history at every decode step. Attention only sees the first
+    `length` positions. Indexing gives per-layer views, so `past_key_values[0][0].shape[2]` is the valid length like
+    for the tuple cache.
+    """
+
+    def __init__(self, keys: List[torch.Tensor], values: List[torch.Tensor], length: int = 0):
+        self.keys = keys
+        self.values = values
+        self.length = length
+
+    @classmethod
+    def allocate(cls, config: LlamaConfig, batch_size: int, max_length: int, dtype: torch.dtype, device: torch.device):
+        head_dim = config.hidden_size // config.num_attention_heads
+        shape = (batch_size, config.num_attention_heads, max_length, head_dim)
+        keys = [torch.empty(shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        values = [torch.empty(shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        return cls(keys, values)
+
+    @property
+    def max_length(self):
+        return self.keys[0].shape[2]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __bool__(self):
+        # an empty cache is handed to the prefill like `past_key_values=None`, see prepare_inputs_for_generation
+        return self.length > 0
+
+    def __getitem__(self, layer_idx):
+        return StaticKVCacheLayer(self, layer_idx)
+
+    def __iter__(self):
+        return (self[layer_idx] for layer_idx in range(len(self)))
+
+    def write(self, layer_idx, key_states, value_states):
+        # the write index only moves once all layers have seen the new tokens, see `advance`
+        end = self.length + key_states.shape[2]
+        if end > self.max_length:
+            raise ValueError(f"StaticKVCache holds {self.max_length} positions, {end} are needed")
+        self.keys[layer_idx][:, :, self.length : end].copy_(key_states)
+        self.values[layer_idx][:, :, self.length : end].copy_(value_states)
+        return self.keys[layer_idx][:, :, :end], self.values[layer_idx][:, :, :end]
+
+    def advance(self, num_tokens):
+        self.length += num_tokens
+
+    def truncate(self, length):
+        # later writes overwrite the dropped positions
+        if length > self.length:
+            raise ValueError(f"cannot truncate a StaticKVCache of length {self.length} to {length}")
+        self.length = length
+        return self
+
+    def index_select(self, index):
+        # keeps only the rows `index` of the batch, e.g. to drop finished sequences or reorder beams
+        keys = [key.index_select(0, index) for key in self.keys]
+        values = [value.index_select(0, index) for value in self.values]
+        return StaticKVCache(keys, values, self.length)
+
+
+class StaticKVCacheLayer:
+    def __init__(self, cache: StaticKVCache, layer_idx: int):
+        self.cache = cache
+        self.layer_idx = layer_idx
+
+    def __getitem__(self, idx):
+        buffers = self.cache.keys if idx == 0 else self.cache.values
+        return buffers[self.layer_idx][:, :, : self.cache.length]
+
+    def __iter__(self):
+        return iter((self[0], self[1]))
+
+    def update(self, key_states, value_states):
+        return self.cache.write(self.layer_idx, key_states, value_states)
+
+
 class LlamaAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
 
@@ -215,12 +307,21 @@ class LlamaAttention(nn.Module):
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
         # [bsz, nh, t, hd]
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, StaticKVCacheLayer):
+            # write in place, no copy of the history
+            key_states, value_states = past_key_value.update(key_states, value_states)
+        elif past_key_value is not None:
             # reuse k, v, self_attention
             key_states = torch.cat([past_key_value[0], key_states], dim=2)
             value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+        if not isinstance(past_key_value, StaticKVCacheLayer):
+            past_key_value = (key_states, value_states) if use_cache else None
+
+        if not output_attentions and _attention_backend(self.config) == "sdpa":
+            attn_output = self._sdpa_attention(query_states, key_states, value_states, attention_mask)
+            attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.hidden_size)
+            return self.o_proj(attn_output), None, past_key_value
 
         attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
 
@@ -258,6 +359,28 @@ class LlamaAttention(nn.Module):
 
         return attn_output, attn_weights, past_key_value
 
+    def _sdpa_attention(self, query_states, key_states, value_states, attention_mask):
+        # the fused kernel never materializes the [bsz, nh, q_len, kv_seq_len] weights
+        q_len, kv_seq_len = query_states.shape[2], key_states.shape[2]
+        if attention_mask is None:
+            # no padding, see LlamaModel._prepare_decoder_attention_mask: plain causal attention
+            return nn.functional.scaled_dot_product_attention(
+                query_states, key_states, value_states, is_causal=q_len > 1 and q_len == kv_seq_len
+            )
+        if attention_mask.size() != (query_states.shape[0], 1, q_len, kv_seq_len):
+            raise ValueError(
+                f"Attention mask should be of size {(query_states.shape[0], 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+            )
+        # padding + causal masks add up to -inf in half precision, clamp them back to finfo.min
+        min_value = torch.finfo(query_states.dtype).min
+        attention_mask = attention_mask.clamp(min=min_value).to(query_states.dtype)
+        # unlike eager, the fused kernels add the mask before any clamping: score + finfo.min overflows to -inf in
+        # half precision and a fully masked row (a left padding query) gives nan. Those rows attend to everything
+        # instead, like transformers' _unmask_unattended, their outputs are padding and never read
+        fully_masked = (attention_mask == min_value).all(dim=-1, keepdim=True)
+        attention_mask = attention_mask.masked_fill(fully_masked, 0)
+        return nn.functional.scaled_dot_product_attention(query_states, key_states, value_states, attn_mask=attention_mask)
+
 
 class LlamaDecoderLayer(nn.Module):
     def __init__(self, config: LlamaConfig):
@@ -554,13 +677,22 @@ class LlamaModel(LlamaPreTrainedModel):
             position_ids = position_ids.view(-1, seq_length).long()
 
         # embed positions
-        if attention_mask is None:
-            attention_mask = torch.ones(
-                (batch_size, seq_length_with_past), dtype=torch.bool, device=inputs_embeds.device
+        if (
+            attention_mask is None
+            and not output_attentions
+            and _attention_backend(self.config) == "sdpa"
+            and (past_key_values_length == 0 or seq_length == 1)
+        ):
+            # nothing is padded, the sdpa kernel applies the causal mask itself
+            pass
+        else:
+            if attention_mask is None:
+                attention_mask = torch.ones(
+                    (batch_size, seq_length_with_past), dtype=torch.bool, device=inputs_embeds.device
+                )
+            attention_mask = self._prepare_decoder_attention_mask(
+                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
             )
-        attention_mask = self._prepare_decoder_attention_mask(
-            attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
-        )
 
         hidden_states = inputs_embeds
 
@@ -623,6 +755,9 @@ class LlamaModel(LlamaPreTrainedModel):
             all_hidden_states += (hidden_states,)
 
         next_cache = next_decoder_cache if use_cache else None
+        if isinstance(past_key_values, StaticKVCache):
+            past_key_values.advance(seq_length)
+            next_cache = past_key_values if use_cache else None
         if not return_dict:
             return tuple(v for v in [hidden_states, next_cache, all_hidden_states, all_self_attns] if v is not None)
         return BaseModelOutputWithPast(
@@ -785,6 +920,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
 
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
+        if isinstance(past_key_values, StaticKVCache):
+            return past_key_values.index_select(beam_idx)
         reordered_past = ()
         for layer_past in past_key_values:
             reordered_past += (tuple(past_state.index_select(0, beam_idx) for past_state in layer_past),)
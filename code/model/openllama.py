@@ -3,12 +3,22 @@ import torch.nn.functional as F
 from .ImageBind import *
 from .ImageBind import data
 from .modeling_llama import LlamaForCausalLM
-from .AnomalyGPT_models import LinearLayer, PromptLearner
+from .AnomalyGPT_models import LinearLayer, PromptLearner, NativePromptLearner
+from .feature_cache import TextFeatureCache, checkpoint_fingerprint
+from .memory_bank import NormalMemoryBank
+from .patch_knn import max_cosine_similarity
+from .chat_session import ChatSession
+from .meta_init import init_on_meta, materialize, reset_lora_parameters, load_pretrained_weights
+from .bundle import Bundle
+from .lora_merge import causal_lm, merge_lora, unmerge_lora, unload_lora
+from .quantization import quantize_llama, load_quantized_llama
+from .decoding import sample_next_token, truncate_past_key_values, past_length, decode_batch
 from transformers import StoppingCriteria, StoppingCriteriaList
 from utils.loss import FocalLoss, BinaryDiceLoss
 import kornia as K
 from peft import LoraConfig, TaskType, get_peft_model # waue
 from transformers import LlamaTokenizer  # waue
+from transformers import LlamaConfig
 import torch
 from torch.nn.utils import rnn
 
@@ -37,29 +47,24 @@ prompt_templates = ['a photo of a {}.', 'a photo of the {}.']
 #                         'a photo of the {} for anomaly detection.', 'a photo of a {} for anomaly detection.'
 #                         ]
 
-# old
-"""
-objs = ['bottle', 'cable', 'capsule', 'carpet', 'grid', 'hazelnut', 'leather', 'metal nut', 'pill', 'screw', 'tile', 'toothbrush', 'transistor', 'wood', 'zipper', 'object',
-        'candle', 'cashew', 'chewinggum', 'fryum', 'macaroni', 'pcb', 'pipe fryum', 'macaroni1', 'macaroni2','pcb1', 'pcb2', 'pcb3', 'pcb4', 'capsules']
-"""
-
-objs = ['ablation', 'bottle', 'breakdown', 'cable', 'capsule', 'carpet', 'fracture', 'grid', 'groove', 'hazelnut', 'leather', 'metal nut', 'pill', 'screw', 'tile', 'toothbrush', 'transistor', 'wood', 'zipper', 'object',
-        'candle', 'cashew', 'chewinggum', 'fryum', 'macaroni', 'pcb', 'pipe fryum', 'macaroni1', 'macaroni2','pcb1', 'pcb2', 'pcb3', 'pcb4', 'capsules']
+class PromptSentences(dict):
 
-prompt_sentences = {}
+    '''tokenized [normal, abnormal] prompt sentences of each class, built on first use and kept on cpu'''
 
-for obj in objs:
-    prompt_sentence_obj = []
-    for i in range(len(prompt_state)):
-        prompted_state = [state.format(obj) for state in prompt_state[i]]
-        prompted_sentence = []
-        for s in prompted_state:
-            for template in prompt_templates:
-                prompted_sentence.append(template.format(s))
-        prompted_sentence = data.load_and_transform_text(prompted_sentence, torch.cuda.current_device())
-        prompt_sentence_obj.append(prompted_sentence)
-    prompt_sentences[obj] = prompt_sentence_obj
+    def __missing__(self, obj):
+        prompt_sentence_obj = []
+        for i in range(len(prompt_state)):
+            prompted_state = [state.format(obj) for state in prompt_state[i]]
+            prompted_sentence = []
+            for s in prompted_state:
+                for template in prompt_templates:
+                    prompted_sentence.append(template.format(s))
+            prompted_sentence = data.load_and_transform_text(prompted_sentence, 'cpu')
+            prompt_sentence_obj.append(prompted_sentence)
+        self[obj] = prompt_sentence_obj
+        return prompt_sentence_obj
 
+prompt_sentences = PromptSentences()
 
 
 def encode_text_with_prompt_ensemble(model, obj, device):
@@ -105,12 +110,17 @@ class StoppingCriteriaSub(StoppingCriteria):
         self.ENCOUNTERS = encounters
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
-        stop_count = 0
+        stop_count = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
         for stop in self.stops:
-            stop_count = (stop == input_ids[0]).sum().item()
-        if stop_count >= self.ENCOUNTERS:
-            return True
-        return False
+            stop_count += (stop == input_ids).sum(dim=-1)
+        # in batched generation every row has to reach its stop token
+        return bool((stop_count >= self.ENCOUNTERS).all())
+
+def find_class_name(prompt):
+    for name in CLASS_NAMES:
+        if name in prompt:
+            return name
+    return 'object'
 
 def build_one_instance(tokenizer, conversation):
     text_list = []
@@ -179,22 +189,78 @@ class OpenLLAMAPEFTModel(nn.Module):
     def __init__(self, **args):
         super(OpenLLAMAPEFTModel, self).__init__()
         self.args = args
-        imagebind_ckpt_path = args['imagebind_ckpt_path']
-        vicuna_ckpt_path = args['vicuna_ckpt_path']
+        imagebind_ckpt_path = args.get('imagebind_ckpt_path')
+        vicuna_ckpt_path = args.get('vicuna_ckpt_path')
+        # without the language model only the anomaly maps and scores are available, see score
+        self.load_llm = args.get('load_llm', True)
         max_tgt_len = args['max_tgt_len']
         stage = args['stage']
+        # build ImageBind and LLaMA on the meta device and fill them from their checkpoints straight in
+        # init_dtype on init_device: no random init and no fp32 copy on the host before .half().cuda()
+        self.meta_init = args.get('meta_init', False)
+        self.init_device = args.get('init_device', 'cuda')
+        self.init_dtype = args.get('init_dtype', torch.float16)
+        # where the memory-mapped copies of the checkpoints go, next to them by default
+        self.mmap_cache_dir = args.get('mmap_cache_dir')
+        # a packed inference bundle (see export_bundle.py) replaces every checkpoint path, the model is
+        # built on the meta device and filled from the memory-mapped bundle, LoRA is already merged
+        self.bundle = None
+        if args.get('bundle_path'):
+            self.bundle = Bundle(args['bundle_path'], verify=args.get('verify_bundle', False))
+            self.meta_init = True
+            args['imagebind_modalities'] = self.bundle.manifest['imagebind_modalities']
+            imagebind_ckpt_path = args['bundle_path']
 
         print (f'Initializing visual encoder from {imagebind_ckpt_path} ...')
 
-        self.visual_encoder, self.visual_hidden_size = imagebind_model.imagebind_huge(args)
-        imagebind_ckpt = torch.load(imagebind_ckpt_path, map_location=torch.device('cpu'))
-        self.visual_encoder.load_state_dict(imagebind_ckpt, strict=True)
+        # args['imagebind_modalities'] (e.g. ['vision', 'text']) builds and loads only those branches
+        if self.meta_init:
+            with init_on_meta():
+                self.visual_encoder, self.visual_hidden_size = imagebind_model.imagebind_huge(args)
+            materialize(self.visual_encoder, self.init_device, self.init_dtype)
+        else:
+            self.visual_encoder, self.visual_hidden_size = imagebind_model.imagebind_huge(args)
+        if self.bundle is not None:
+            self.bundle.load_into(self.visual_encoder, 'visual_encoder.')
+        else:
+            dropped = imagebind_model.load_imagebind_checkpoint(self.visual_encoder, imagebind_ckpt_path,
+                                                              mapped=self.meta_init, cache_dir=self.mmap_cache_dir)
+            if dropped:
+                print (f'[!] ImageBind modalities: {self.visual_encoder.modalities}, {dropped} checkpoint tensors skipped')
+
+        # the text features of the prompt ensemble only depend on the frozen checkpoint and the class name
+        prompt_fingerprint = repr((prompt_templates, prompt_normal, prompt_abnormal))
+        if self.bundle is not None:
+            # the bundle records the fingerprints of the checkpoint it was exported from
+            text_fingerprint = self.bundle.manifest['text_fingerprint']
+            imagebind_fingerprint = self.bundle.manifest['imagebind_fingerprint']
+        else:
+            text_fingerprint = checkpoint_fingerprint(imagebind_ckpt_path, prompt_fingerprint)
+            imagebind_fingerprint = checkpoint_fingerprint(imagebind_ckpt_path)
+        self.text_feature_cache = TextFeatureCache(
+            self.encode_class_text,
+            text_fingerprint,
+            args.get('text_feature_cache_dir', './ckpt/text_feature_cache'),
+        )
+        if self.bundle is not None:
+            self.text_feature_cache.features.update(self.bundle.text_features())
+        # patch tokens of the normal reference images, encoded once per class
+        self.memory_bank = NormalMemoryBank(
+            args.get('memory_bank_dir', './ckpt/memory_bank'),
+            imagebind_fingerprint,
+        )
 
         self.iter = 0
 
         self.image_decoder = LinearLayer(1280, 1024, 4)
 
-        self.prompt_learner = PromptLearner(1, 4096)
+        if self.load_llm:
+            # native_prompt_learner: the light stack on the 16 x 16 patch-level map, its native_net weights
+            # come from distill_prompt_learner.py, the rest loads from the AnomalyGPT checkpoints
+            if args.get('native_prompt_learner', False):
+                self.prompt_learner = NativePromptLearner(1, 4096)
+            else:
+                self.prompt_learner = PromptLearner(1, 4096)
 
         self.loss_focal = FocalLoss()
         self.loss_dice = BinaryDiceLoss()
@@ -206,6 +272,39 @@ class OpenLLAMAPEFTModel(nn.Module):
         self.visual_encoder.eval()
         print ('Visual encoder initialized.')
 
+        if self.load_llm:
+            self.init_language_decoder(vicuna_ckpt_path)
+        else:
+            print ('[!] load_llm is False, skip the language decoder: only score is available')
+            self.llama_model = None
+            self.llama_tokenizer = None
+            self.lora_mode = None
+
+        if self.bundle is not None:
+            for name in ('image_decoder', 'prompt_learner', 'llama_proj'):
+                if getattr(self, name, None) is not None:
+                    self.bundle.load_into(getattr(self, name), f'{name}.')
+
+        self.max_tgt_len = max_tgt_len
+        # reference patches compared at once by the few-shot nearest-neighbour search
+        self.few_shot_chunk_size = args.get('few_shot_chunk_size', 4096)
+        # None: search the memory bank tokens exactly, 'exact' / 'fp16' / 'ivfpq': through a patch index, see NormalMemoryBank.get
+        self.memory_bank_index = args.get('memory_bank_index')
+        # softmax at 224 x 224 for every layer (the original head) instead of at patch resolution
+        self.exact_anomaly_map = args.get('exact_anomaly_map', False)
+        # 'bf16': run ImageBind under bf16 autocast (e.g. on cpus with bf16 matmuls), outputs come back in vision_dtype
+        self.vision_autocast = args.get('vision_autocast')
+        # 'cpu' for cpu-only replicas (with init_device 'cpu' and init_dtype torch.float32), the current gpu by default
+        self.device = torch.device(args['device']) if args.get('device') else torch.cuda.current_device()
+
+
+    def init_language_decoder(self, vicuna_ckpt_path):
+        if self.bundle is not None:
+            self.init_language_decoder_from_bundle()
+            return
+        if self.args.get('quantized_llm_path'):
+            self.init_language_decoder_from_quantized(self.args['quantized_llm_path'])
+            return
         print (f'Initializing language decoder from {vicuna_ckpt_path} ...')
         
         # add the lora module
@@ -218,9 +317,33 @@ class OpenLLAMAPEFTModel(nn.Module):
             target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj']
         )
 
-        self.llama_model = LlamaForCausalLM.from_pretrained(vicuna_ckpt_path)
-        self.llama_model = get_peft_model(self.llama_model, peft_config)
-        self.llama_model.print_trainable_parameters()
+        # vicuna_ckpt_path already has the LoRA merged in (see export_merged_llama.py): no peft wrapper
+        lora_merged = self.args.get('lora_merged', False)
+        if self.meta_init:
+            config = LlamaConfig.from_pretrained(vicuna_ckpt_path)
+            config.attention_backend = self.args.get('attention_backend', 'eager')
+            with init_on_meta():
+                self.llama_model = LlamaForCausalLM(config)
+                if not lora_merged:
+                    self.llama_model = get_peft_model(self.llama_model, peft_config)
+            materialize(self.llama_model, self.init_device, self.init_dtype)
+            missing = load_pretrained_weights(causal_lm(self.llama_model), vicuna_ckpt_path, self.mmap_cache_dir)
+            param_names = {name for name, _ in causal_lm(self.llama_model).named_parameters()}
+            missing = [key for key in missing if key in param_names and 'lora_' not in key]
+            assert not missing, f'weights missing from {vicuna_ckpt_path}: {missing}'
+            reset_lora_parameters(self.llama_model)
+        else:
+            self.llama_model = LlamaForCausalLM.from_pretrained(vicuna_ckpt_path)
+            # 'eager' or 'sdpa', read by the attention layers at every forward so it can also be switched later
+            self.llama_model.config.attention_backend = self.args.get('attention_backend', 'eager')
+            if not lora_merged:
+                self.llama_model = get_peft_model(self.llama_model, peft_config)
+        if lora_merged:
+            self.lora_mode = 'unloaded'
+        else:
+            self.llama_model.print_trainable_parameters()
+            # 'adapter': trainable peft LoRA layers, 'merged' / 'unloaded': see merge_lora
+            self.lora_mode = 'adapter'
 
         self.llama_tokenizer = LlamaTokenizer.from_pretrained(vicuna_ckpt_path, use_fast=False)
         self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
@@ -231,23 +354,142 @@ class OpenLLAMAPEFTModel(nn.Module):
             self.visual_hidden_size, self.llama_model.config.hidden_size
         )
 
-        self.max_tgt_len = max_tgt_len
-        self.device = torch.cuda.current_device()
+    def init_language_decoder_from_bundle(self):
+        '''a plain LlamaForCausalLM with the LoRA already merged, no peft wrapper'''
+        manifest = self.bundle.manifest
+        if manifest['llama_config'] is None:
+            raise RuntimeError(f'[!] {self.bundle.bundle_dir} was exported without the language model, set load_llm to False')
+        print (f'Initializing language decoder from {self.bundle.bundle_dir} ...')
+        config = LlamaConfig.from_dict(manifest['llama_config'])
+        config.attention_backend = self.args.get('attention_backend', 'eager')
+        with init_on_meta():
+            self.llama_model = LlamaForCausalLM(config)
+        materialize(self.llama_model, self.init_device, self.init_dtype)
+        self.bundle.load_into(self.llama_model, 'llama_model.')
+        self.lora_mode = 'unloaded'
+
+        self.llama_tokenizer = LlamaTokenizer.from_pretrained(self.bundle.tokenizer_path, use_fast=False)
+        self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
+        self.llama_tokenizer.padding_side = "right"
+        print ('Language decoder initialized.')
 
+        self.llama_proj = nn.Linear(
+            self.visual_hidden_size, self.llama_model.config.hidden_size
+        )
+
+    def init_language_decoder_from_quantized(self, quantized_llm_path):
+        '''the int8 LlamaForCausalLM written by export_merged_llama.py --int8, cpu only'''
+        print (f'Initializing int8 language decoder from {quantized_llm_path} ...')
+        self.llama_model = load_quantized_llama(quantized_llm_path, self.args.get('attention_backend', 'eager'))
+        self.lora_mode = 'unloaded'
+
+        self.llama_tokenizer = LlamaTokenizer.from_pretrained(quantized_llm_path, use_fast=False)
+        self.llama_tokenizer.pad_token = self.llama_tokenizer.eos_token
+        self.llama_tokenizer.padding_side = "right"
+        print ('Language decoder initialized.')
+
+        self.llama_proj = nn.Linear(
+            self.visual_hidden_size, self.llama_model.config.hidden_size
+        )
+
+    def quantize_llm(self, include_lm_head=False):
+        '''
+            cpu inference: merge and unload the LoRA, then int8 weights with dynamic int8 activations for
+            every linear of the decoder layers (see model/quantization.py), embed_tokens stays fp32
+        '''
+        if self.llama_model is None or getattr(self.llama_model, 'quantized_modules', None):
+            return
+        self.merge_lora(unload=True)
+        quantize_llama(self.llama_model, include_lm_head=include_lm_head)
+        print (f'[!] {len(self.llama_model.quantized_modules)} linears of the language model quantized to int8')
+
+    def merge_lora(self, unload=False, keep_base=False):
+        '''
+            inference mode of the language model, once the LoRA weights are loaded: every q/k/v/o projection
+            becomes a single matmul with the delta folded into the base weight (computed in fp32)
+            unload: also replace the peft wrapper and LoRA layers by a plain LlamaForCausalLM, can not be undone
+            keep_base: keep a cpu copy of the base weights so unmerge_lora restores them exactly
+        '''
+        if self.llama_model is None or self.lora_mode == 'unloaded':
+            return
+        if unload:
+            self.llama_model = unload_lora(self.llama_model)
+            self.lora_mode = 'unloaded'
+        else:
+            merge_lora(self.llama_model, keep_base=keep_base)
+            self.lora_mode = 'merged'
+        print (f'[!] LoRA merged into the language model ({self.lora_mode})')
+
+    def unmerge_lora(self):
+        '''back to the separate LoRA adapters, e.g. for training'''
+        if self.lora_mode == 'unloaded':
+            raise RuntimeError('[!] the LoRA layers were unloaded, rebuild the model to train them')
+        if self.lora_mode == 'merged':
+            unmerge_lora(self.llama_model)
+            self.lora_mode = 'adapter'
+
+    def train(self, mode=True):
+        # the adapters only get gradients when they are not folded into the frozen base weights
+        if mode and getattr(self, 'lora_mode', None) in ('merged', 'unloaded'):
+            self.unmerge_lora()
+            print ('[!] LoRA unmerged for training')
+        return super(OpenLLAMAPEFTModel, self).train(mode)
+
+    @property
+    def _embed_tokens(self):
+        '''the token embedding of the language model, with or without the peft wrapper'''
+        return self.llama_model.get_input_embeddings()
+
+    def run_visual_encoder(self, inputs, **kwargs):
+        '''self.visual_encoder(inputs, **kwargs), under bf16 autocast when vision_autocast is set'''
+        if self.vision_autocast is None:
+            return self.visual_encoder(inputs, **kwargs)
+        assert self.vision_autocast == 'bf16', f'unknown vision_autocast {self.vision_autocast}'
+        device_type = 'cpu' if torch.device(self.device).type == 'cpu' else 'cuda'
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+            outputs = self.visual_encoder(inputs, **kwargs)
+        cast = lambda tensor: None if tensor is None else tensor.to(self.vision_dtype)
+        return {key: (cast(embeds), [cast(tokens) for tokens in layer_tokens]) for key, (embeds, layer_tokens) in outputs.items()}
+
+    def quantize_vision(self):
+        '''
+            cpu inference: int8 weights with dynamic int8 activations for the q, k, v, output and mlp projections
+            of the ImageBind vision trunk, see BlockWithMasking.quantize_dynamic_. Not combined with vision_autocast.
+        '''
+        trunk = self.visual_encoder.modality_trunks[ModalityType.VISION]
+        if trunk.is_quantized():
+            return
+        if self.vision_autocast is not None:
+            raise ValueError('[!] the int8 vision trunk takes fp32 activations, unset vision_autocast')
+        if next(trunk.parameters()).dtype != torch.float32 or next(trunk.parameters()).device.type != 'cpu':
+            raise ValueError('[!] dynamic quantization runs on fp32 cpu models')
+        trunk.quantize_dynamic_()
+        print (f'[!] {len(trunk.blocks)} ImageBind vision blocks quantized to int8')
+
+    @property
+    def vision_dtype(self):
+        '''dtype of the vision side, does not need the language model to be loaded'''
+        return next(self.image_decoder.parameters()).dtype
+
+    def encode_class_text(self, class_names):
+        if ModalityType.TEXT not in self.visual_encoder.modalities:
+            raise RuntimeError(f'[!] the ImageBind text branch is not built and the text features of {class_names} '
+                               f'are not in {self.text_feature_cache.cache_path}, add text to imagebind_modalities once to cache them')
+        return encode_text_with_prompt_ensemble(self.visual_encoder, class_names, self.device)
 
     def rot90_img(self,x,k):
         # k is 0,1,2,3
         degreesarr = [0., 90., 180., 270., 360]
-        degrees = torch.tensor(degreesarr[k]).to(self.llama_model.dtype).to(self.device)
+        degrees = torch.tensor(degreesarr[k]).to(self.vision_dtype).to(self.device)
         x = K.geometry.transform.rotate(x, angle = degrees, padding_mode='reflection')
         return x
 
     def encode_video(self, video_paths):
         inputs = {ModalityType.VISION: data.load_and_transform_video_data(video_paths, self.device)}
         # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+        inputs = {key: inputs[key].to(self.vision_dtype) for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs)
             video_embeds = embeddings[ModalityType.VISION][0] # bsz x 1024
         inputs_llama = self.llama_proj(video_embeds).unsqueeze(1) # bsz x 1 x llama_size
         atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device) # bsz x 1
@@ -256,9 +498,9 @@ class OpenLLAMAPEFTModel(nn.Module):
     def encode_audio(self, audio_paths):
         inputs = {ModalityType.AUDIO: data.load_and_transform_audio_data(audio_paths, self.device)}
         # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+        inputs = {key: inputs[key].to(self.vision_dtype) for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs)
             audio_embeds = embeddings[ModalityType.AUDIO][0] # bsz x 1024
         inputs_llama = self.llama_proj(audio_embeds).unsqueeze(1) # bsz x 1 x llama_size
         atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device) # bsz x 1
@@ -267,48 +509,53 @@ class OpenLLAMAPEFTModel(nn.Module):
     def encode_thermal(self, thermal_paths):
         inputs = {ModalityType.THERMAL: data.load_and_transform_thermal_data(thermal_paths, self.device)}
         # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+        inputs = {key: inputs[key].to(self.vision_dtype) for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs)
             image_embeds = embeddings['thermal'][0] # bsz x 1024
         inputs_llama = self.llama_proj(image_embeds).unsqueeze(1) # bsz x 1 x llama_size
         atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device) # bsz x 1
         return inputs_llama, atts_llama
 
-    def encode_image(self, image_paths):
-        inputs = {ModalityType.VISION: data.load_and_transform_vision_data(image_paths, self.device)}
-        # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+    def encode_vision_features(self, vision_inputs, features_only=False):
+        '''
+            one ImageBind pass shared by the text-similarity and the few-shot branches
+            vision_inputs: bsz x 3 x 224 x 224
+            features_only: skip the pooled embedding (None), the trunk stops after the deepest out layer
+            return: pooled embeddings (bsz x 1024), raw multi-layer patch tokens (list of bsz x h*w x 1280)
+                    and their image_decoder projections (layers x bsz x h*w x 1024)
+        '''
+        inputs = {ModalityType.VISION: vision_inputs.to(self.device).to(self.vision_dtype)}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs, features_only=features_only)
             image_embeds = embeddings['vision'][0] # bsz x 1024
-            patch_features = embeddings['vision'][1] # bsz x h*w x 1280
-        patch_tokens = self.image_decoder(patch_features) # bsz x h*w x 1024
+            patch_features = embeddings['vision'][1] # list of (1+h*w) x bsz x 1280
+            raw_patch_tokens = [patch_feature.transpose(0, 1)[:, 1:, :] for patch_feature in patch_features]
+        patch_tokens = self.image_decoder.forward_stacked(patch_features) # layers x bsz x h*w x 1024
+        return image_embeds, raw_patch_tokens, patch_tokens
 
+    def encode_image_with_patch_features(self, vision_inputs):
+        image_embeds, raw_patch_tokens, patch_tokens = self.encode_vision_features(vision_inputs)
         inputs_llama = self.llama_proj(image_embeds).unsqueeze(1) # bsz x 1 x llama_size
         atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device) # bsz x 1
+        return inputs_llama, atts_llama, patch_tokens, raw_patch_tokens
+
+    def encode_image(self, image_paths):
+        vision_inputs = data.load_and_transform_vision_data(image_paths, self.device)
+        inputs_llama, atts_llama, patch_tokens, _ = self.encode_image_with_patch_features(vision_inputs)
         return inputs_llama, atts_llama, patch_tokens
     
     def encode_image_for_web_demo(self, image_paths):
-        inputs = {ModalityType.VISION: data.load_and_transform_vision_data_for_web_demo(image_paths, self.device)}
-        # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
-        with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
-            image_embeds = embeddings['vision'][0] # bsz x 1024
-            patch_features = embeddings['vision'][1] # bsz x h*w x 1280
-        patch_tokens = self.image_decoder(patch_features) # bsz x h*w x 1024
-
-        inputs_llama = self.llama_proj(image_embeds).unsqueeze(1) # bsz x 1 x llama_size
-        atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device) # bsz x 1
+        vision_inputs = data.load_and_transform_vision_data_for_web_demo(image_paths, self.device)
+        inputs_llama, atts_llama, patch_tokens, _ = self.encode_image_with_patch_features(vision_inputs)
         return inputs_llama, atts_llama, patch_tokens
     
     def encode_image_for_one_shot(self, image_paths):
         inputs = {ModalityType.VISION: data.load_and_transform_vision_data(image_paths, self.device)}
         # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+        inputs = {key: inputs[key].to(self.vision_dtype) for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs, features_only=True)
             patch_features = embeddings['vision'][1] # bsz x h*w x 1280
             for i in range(len(patch_features)):
                 patch_features[i] = patch_features[i].transpose(0, 1)[:, 1:, :]
@@ -320,9 +567,9 @@ class OpenLLAMAPEFTModel(nn.Module):
             image_tensors = [image_tensors]
         inputs = {ModalityType.VISION: torch.stack(image_tensors, dim=0).to(self.device)}
         # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+        inputs = {key: inputs[key].to(self.vision_dtype) for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs, features_only=True)
             patch_features = embeddings['vision'][1] # bsz x h*w x 1280
             for i in range(len(patch_features)):
                 patch_features[i] = patch_features[i].transpose(0, 1)[:, 1:, :]
@@ -330,11 +577,11 @@ class OpenLLAMAPEFTModel(nn.Module):
         return patch_features
     
     def encode_image_for_one_shot_with_aug(self, image_paths):
-        image_tensors = data.load_and_transform_vision_data(image_paths, self.device).to(self.llama_model.dtype)
+        image_tensors = data.load_and_transform_vision_data(image_paths, self.device).to(self.vision_dtype)
         B,C,H,W = image_tensors.shape
         # print(B,C,H,W)
 
-        rotated_images = torch.zeros((4, B, C, H, W)).to(self.llama_model.dtype).to(self.device)
+        rotated_images = torch.zeros((4, B, C, H, W)).to(self.vision_dtype).to(self.device)
 
 
         for j, degree in enumerate([0, 1, 2, 3]):
@@ -348,28 +595,27 @@ class OpenLLAMAPEFTModel(nn.Module):
         # convert into visual dtype
         inputs = {key: inputs[key] for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs, features_only=True)
             patch_features = embeddings['vision'][1] # bsz x h*w x 1280
             for i in range(len(patch_features)):
                 patch_features[i] = patch_features[i].transpose(0, 1)[:, 1:, :].reshape(B,4,256,1280).reshape(B, 4 * 256, 1280)
 
         return patch_features
     
+    def build_memory_bank(self, class_id, normal_img_paths, with_rotation=False, force=False, coreset_size=None, coreset_ratio=None):
+        '''
+            encode the normal reference images of a class once, later queries pass 'normal_class_id' instead of the images
+            coreset_size / coreset_ratio: reduce the bank to a greedy k-center coreset so that few-shot latency
+                                          does not grow with the number of enrolled images
+        '''
+        encode_fn = self.encode_image_for_one_shot_with_aug if with_rotation else self.encode_image_for_one_shot
+        return self.memory_bank.build(class_id, normal_img_paths, encode_fn, with_rotation=with_rotation, force=force,
+                                      coreset_size=coreset_size, coreset_ratio=coreset_ratio, coreset_device=self.device)
+
     def encode_image_from_tensor(self, image_tensors):
         if not isinstance(image_tensors, list):
             image_tensors = [image_tensors]
-        inputs = {ModalityType.VISION: torch.stack(image_tensors, dim=0).to(self.device)}
-        # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
-        with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
-            image_embeds = embeddings['vision'][0] # bsz x 1024
-            patch_features = embeddings['vision'][1] # bsz x h*w x 1024
-        patch_tokens = self.image_decoder(patch_features)
-
-
-        inputs_llama = self.llama_proj(image_embeds).unsqueeze(1) # bsz x 1 x llama_size
-        atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(self.device) # bsz x 1
+        inputs_llama, atts_llama, patch_tokens, _ = self.encode_image_with_patch_features(torch.stack(image_tensors, dim=0))
         return inputs_llama, atts_llama, patch_tokens
     
     def encode_image_from_tensor_no_patch(self, image_tensors):
@@ -377,9 +623,9 @@ class OpenLLAMAPEFTModel(nn.Module):
             image_tensors = [image_tensors]
         inputs = {ModalityType.VISION: torch.stack(image_tensors, dim=0).to(self.device)}
         # convert into visual dtype
-        inputs = {key: inputs[key].to(self.llama_model.dtype) for key in inputs}
+        inputs = {key: inputs[key].to(self.vision_dtype) for key in inputs}
         with torch.no_grad():
-            embeddings = self.visual_encoder(inputs)
+            embeddings = self.run_visual_encoder(inputs)
             image_embeds = embeddings['vision'][0] # bsz x 1024
 
         inputs_llama = self.llama_proj(image_embeds).unsqueeze(1) # bsz x 1 x llama_size
@@ -401,20 +647,20 @@ class OpenLLAMAPEFTModel(nn.Module):
         p_before_tokens = self.llama_tokenizer(p_before, 
             return_tensors="pt", add_special_tokens=False).to(self.device)
         # peft model need deeper call
-        p_before_embeds = self.llama_model.model.model.embed_tokens(p_before_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
+        p_before_embeds = self._embed_tokens(p_before_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
 
         p_middle = '</Img> '
         p_middle_tokens = self.llama_tokenizer(p_middle, 
             return_tensors="pt", add_special_tokens=False).to(self.device)
         # peft model need deeper call
-        p_middle_embeds = self.llama_model.model.model.embed_tokens(p_middle_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
+        p_middle_embeds = self._embed_tokens(p_middle_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
 
 
-        p_after_embeds = self.llama_model.model.model.embed_tokens(input_ids).expand(batch_size, -1, -1) # bsz x s2 x embed_dim
+        p_after_embeds = self._embed_tokens(input_ids).expand(batch_size, -1, -1) # bsz x s2 x embed_dim
         bos = torch.ones([batch_size, 1],
                          dtype=p_before_tokens.input_ids.dtype,
                          device=p_before_tokens.input_ids.device) * self.llama_tokenizer.bos_token_id # bsz x 1
-        bos_embeds = self.llama_model.model.model.embed_tokens(bos) # bsz x 1 x embed_dim
+        bos_embeds = self._embed_tokens(bos) # bsz x 1 x embed_dim
 
         
 
@@ -453,23 +699,15 @@ class OpenLLAMAPEFTModel(nn.Module):
         if 'masks' in inputs:
 
             image_paths = inputs['images']
-            img_embeds, _, patch_tokens = self.encode_image_from_tensor(image_paths)
+            # the few-shot branch below reuses the raw patch tokens of this pass
+            img_embeds, _, patch_tokens, query_patch_tokens = self.encode_image_with_patch_features(torch.stack(image_paths, dim=0))
             class_name = inputs['class_names']
 
             loss_pixel = 0
-            feats_text_tensor = encode_text_with_prompt_ensemble(self.visual_encoder, class_name, self.device)
-
-            anomaly_maps = []
-            for layer in range(len(patch_tokens)):
-                patch_tokens[layer] = patch_tokens[layer] / patch_tokens[layer].norm(dim=-1, keepdim=True)
-                anomaly_map = (100.0 * patch_tokens[layer] @ feats_text_tensor.transpose(-2,-1))
-                B, L, C = anomaly_map.shape
-                H = int(np.sqrt(L))
-                anomaly_map = F.interpolate(anomaly_map.permute(0, 2, 1).view(B, 2, H, H),
-                                            size=224, mode='bilinear', align_corners=True)
+            feats_text_tensor = self.text_feature_cache.get(class_name, self.device, patch_tokens[0].dtype)
 
-                anomaly_map = torch.softmax(anomaly_map, dim=1)
-                anomaly_maps.append(anomaly_map)           
+            # the pixel loss needs every layer's softmax at full resolution
+            anomaly_map_all, anomaly_maps = self.anomaly_map_head(patch_tokens, feats_text_tensor, full_resolution=True)
 
             gt = inputs['masks']
             gt = torch.stack(gt, dim=0).to(self.device)
@@ -481,11 +719,6 @@ class OpenLLAMAPEFTModel(nn.Module):
                 f_loss = self.loss_focal(anomaly_maps[num], gt)
                 d_loss = self.loss_dice(anomaly_maps[num][:, 1, :, :], gt)
                 loss_pixel = loss_pixel + f_loss + d_loss
-
-            for num in range(len(anomaly_maps)):
-                anomaly_maps[num] = anomaly_maps[num][:,1,:,:]
-
-            anomaly_map_all = torch.mean(torch.stack(anomaly_maps, dim=0), dim=0).unsqueeze(1)
         
             if random.randint(0,1) == 0 and len(inputs['img_paths']) == len(image_paths):
 
@@ -500,21 +733,12 @@ class OpenLLAMAPEFTModel(nn.Module):
                     normal_paths.append(normal_path)
 
                 print(normal_paths)
-                query_patch_tokens = self.encode_image_for_one_shot_from_tensor(image_paths)
                 normal_patch_tokens = self.encode_image_for_one_shot_with_aug(normal_paths)
-                sims = []
-                B = len(image_paths)
-
-                for i in range(len(query_patch_tokens)):
-                    query_patch_tokens_reshaped = query_patch_tokens[i].view(B,256,1,1280)
-                    normal_tokens_reshaped = normal_patch_tokens[i].reshape(B,1,-1,1280)
-                    cosine_similarity_matrix = F.cosine_similarity(query_patch_tokens_reshaped, normal_tokens_reshaped, dim=-1)
-                    sim_max, _ = torch.max(cosine_similarity_matrix, dim=-1)
-                    sims.append(sim_max)
-
-                sim = torch.mean(torch.stack(sims,dim=0), dim=0).reshape(B,1,16,16)
-                sim = F.interpolate(sim,size=224, mode='bilinear', align_corners=True)
-                anomaly_map_all = 1 - sim # (anomaly_map_all + 1 - sim) / 2
+                # every image is compared with the 4 rotations of its own normal reference
+                anomaly_map_all = self.few_shot_anomaly_map(query_patch_tokens, normal_patch_tokens, per_query=True,
+                                                            patch_level=self.patch_level_maps) # (anomaly_map_all + 1 - sim) / 2
+            elif self.patch_level_maps:
+                anomaly_map_all = self.patch_anomaly_map(patch_tokens, feats_text_tensor)
 
             anomaly_map_prompts = self.prompt_learner(anomaly_map_all)
 
@@ -554,26 +778,9 @@ class OpenLLAMAPEFTModel(nn.Module):
             output_texts = inputs['output_texts']
 
 
-            feats_text_tensor = encode_text_with_prompt_ensemble(self.visual_encoder, ['object'] * len(image_paths), self.device)
-
-            anomaly_maps = []
-            for layer in range(len(patch_tokens)):
-                patch_tokens[layer] = patch_tokens[layer] / patch_tokens[layer].norm(dim=-1, keepdim=True)
-                # print(patch_tokens[layer].shape)
-                # anomaly_map = torch.bmm(patch_tokens[layer], feats_text_tensor.transpose(-2,-1))
-                anomaly_map = (100.0 * patch_tokens[layer] @ feats_text_tensor.transpose(-2,-1))
-                B, L, C = anomaly_map.shape
-                H = int(np.sqrt(L))
-                anomaly_map = F.interpolate(anomaly_map.permute(0, 2, 1).view(B, 2, H, H),
-                                            size=224, mode='bilinear', align_corners=True)
-                # anomaly_map_no_softmax = anomaly_map
-                anomaly_map = torch.softmax(anomaly_map, dim=1)
-                anomaly_maps.append(anomaly_map)
-
-            for num in range(len(anomaly_maps)):
-                anomaly_maps[num] = anomaly_maps[num][:,1,:,:]
+            feats_text_tensor = self.text_feature_cache.get(['object'] * len(image_paths), self.device, patch_tokens[0].dtype)
 
-            anomaly_map_all = torch.mean(torch.stack(anomaly_maps, dim=0), dim=0).unsqueeze(1)
+            anomaly_map_all = self.text_anomaly_map(patch_tokens, feats_text_tensor, self.patch_level_maps)
 
             anomaly_map_prompts = self.prompt_learner(anomaly_map_all)
 
@@ -600,60 +807,122 @@ class OpenLLAMAPEFTModel(nn.Module):
             return loss, gen_acc
 
 
+    def anomaly_logits(self, patch_tokens, feats_text_tensor):
+        '''
+            all layers at once
+            patch_tokens: layers x bsz x h*w x 1024 (or a list of bsz x h*w x 1024), feats_text_tensor: bsz x 2 x 1024
+            return: layers x bsz x 2 x h x w [normal, abnormal] logits at patch resolution
+        '''
+        if isinstance(patch_tokens, (list, tuple)):
+            patch_tokens = torch.stack(patch_tokens, dim=0)
+        # dividing the 2 similarities by the token norm is cheaper than normalizing the tokens themselves
+        logits = torch.matmul(patch_tokens, feats_text_tensor.transpose(-2, -1).unsqueeze(0)) # layers x bsz x h*w x 2
+        logits = 100.0 * logits / patch_tokens.norm(dim=-1, keepdim=True)
+        K, B, L, _ = logits.shape
+        H = int(np.sqrt(L))
+        return logits.permute(0, 1, 3, 2).reshape(K, B, 2, H, H)
+
+    def patch_anomaly_map(self, patch_tokens, feats_text_tensor):
+        '''return: bsz x 1 x h x w abnormal probability, softmax at patch resolution then mean over layers'''
+        logits = self.anomaly_logits(patch_tokens, feats_text_tensor)
+        return torch.softmax(logits, dim=2)[:, :, 1].mean(dim=0).unsqueeze(1)
+
+    def anomaly_map_head(self, patch_tokens, feats_text_tensor, full_resolution=False, size=224):
+        '''
+            fused multi-layer head
+            full_resolution: upsample every layer's logits to size x size before the softmax, exactly like the
+                             per-layer head the model was trained with, the pixel loss needs these maps
+            return: bsz x 1 x size x size anomaly map, and with full_resolution the layers x bsz x 2 x size x size
+                    per-layer softmax maps (None otherwise)
+        '''
+        if full_resolution:
+            logits = self.anomaly_logits(patch_tokens, feats_text_tensor)
+            K, B = logits.shape[:2]
+            layer_maps = F.interpolate(logits.flatten(0, 1), size=size, mode='bilinear', align_corners=True)
+            layer_maps = torch.softmax(layer_maps, dim=1).view(K, B, 2, size, size)
+            return layer_maps[:, :, 1].mean(dim=0).unsqueeze(1), layer_maps
+        # bilinear upsampling commutes with the mean over layers, so a single upsample is enough
+        anomaly_map = self.patch_anomaly_map(patch_tokens, feats_text_tensor)
+        return F.interpolate(anomaly_map, size=size, mode='bilinear', align_corners=True), None
+
+    @property
+    def patch_level_maps(self):
+        '''NativePromptLearner takes the h x w patch-level maps, they are only upsampled for the returned pixel maps'''
+        return isinstance(getattr(self, 'prompt_learner', None), NativePromptLearner)
+
+    def pixel_anomaly_map(self, anomaly_map, size=224):
+        '''bilinear upsampling of a patch-level map to size x size, size x size maps are returned as they are'''
+        if anomaly_map.shape[-1] == size:
+            return anomaly_map
+        return F.interpolate(anomaly_map, size=size, mode='bilinear', align_corners=True)
+
+    def text_anomaly_map(self, patch_tokens, feats_text_tensor, patch_level=False):
+        '''
+            patch_tokens: layers x bsz x h*w x 1024, feats_text_tensor: bsz x 2 x 1024
+            patch_level: the h x w map before the upsampling (see patch_anomaly_map), exact_anomaly_map does not apply
+            return: bsz x 1 x 224 x 224 (bsz x 1 x h x w with patch_level)
+        '''
+        if patch_level:
+            return self.patch_anomaly_map(patch_tokens, feats_text_tensor)
+        return self.anomaly_map_head(patch_tokens, feats_text_tensor, full_resolution=self.exact_anomaly_map)[0]
+
+    def few_shot_anomaly_map(self, query_patch_tokens, normal_patch_tokens, per_query=False, patch_level=False):
+        '''
+            query_patch_tokens: list of bsz x h*w x 1280
+            normal_patch_tokens: list of n x h*w x 1280 shared by every query image (or a patch index from model/patch_knn.py),
+                                 with per_query a list of bsz x n*h*w x 1280, one reference set per query image
+            patch_level: the h x w map before the upsampling
+            return: bsz x 1 x 224 x 224 (bsz x 1 x h x w with patch_level)
+        '''
+        sims = []
+        for i in range(len(query_patch_tokens)):
+            B, L, C = query_patch_tokens[i].shape
+            if hasattr(normal_patch_tokens[i], 'search'):
+                sim_max = normal_patch_tokens[i].search(query_patch_tokens[i])
+            else:
+                normal_tokens = normal_patch_tokens[i].reshape(B, -1, C) if per_query else normal_patch_tokens[i].reshape(-1, C)
+                # blocked matmul with a running max instead of a B x L x N x C broadcast
+                sim_max = max_cosine_similarity(query_patch_tokens[i], normal_tokens, self.few_shot_chunk_size)
+            sims.append(sim_max.to(query_patch_tokens[i].dtype))
+
+        H = int(np.sqrt(L))
+        sim = torch.mean(torch.stack(sims,dim=0), dim=0).reshape(B,1,H,H)
+        if patch_level:
+            return 1 - sim
+        sim = F.interpolate(sim,size=224, mode='bilinear', align_corners=True)
+        return 1 - sim
+
     def extract_multimodal_feature(self, inputs, web_demo):
         features = []
         if inputs['image_paths']:
             
-            prompt = inputs['prompt']
-            c_name = 'object'
-            for name in CLASS_NAMES:
-                if name in prompt:
-                    c_name = name
-                    break
-                
+            c_name = find_class_name(inputs['prompt'])
+
             if not web_demo:
-                image_embeds, _, patch_tokens = self.encode_image(inputs['image_paths'])
-                feats_text_tensor = encode_text_with_prompt_ensemble(self.visual_encoder, [c_name], self.device)
+                vision_inputs = data.load_and_transform_vision_data(inputs['image_paths'], self.device)
             else:
-                image_embeds, _, patch_tokens = self.encode_image_for_web_demo(inputs['image_paths'])
-                feats_text_tensor = encode_text_with_prompt_ensemble(self.visual_encoder, [c_name], self.device)
-
-            anomaly_maps = []
-            for layer in range(len(patch_tokens)):
-                patch_tokens[layer] = patch_tokens[layer] / patch_tokens[layer].norm(dim=-1, keepdim=True)
-                # print(patch_tokens[layer].shape)
-                # anomaly_map = torch.bmm(patch_tokens[layer], feats_text_tensor.transpose(-2,-1))
-                anomaly_map = (100.0 * patch_tokens[layer] @ feats_text_tensor.transpose(-2,-1))
-                B, L, C = anomaly_map.shape
-                H = int(np.sqrt(L))
-                anomaly_map = F.interpolate(anomaly_map.permute(0, 2, 1).view(B, 2, H, H),
-                                            size=224, mode='bilinear', align_corners=True)
-                anomaly_map = torch.softmax(anomaly_map, dim=1)
-                anomaly_maps.append(anomaly_map[:,1,:,:])
-
-            anomaly_map_ret = torch.mean(torch.stack(anomaly_maps, dim=0), dim=0).unsqueeze(1)
+                vision_inputs = data.load_and_transform_vision_data_for_web_demo(inputs['image_paths'], self.device)
+            # a single vision pass feeds both the text-similarity and the few-shot maps
+            image_embeds, _, patch_tokens, query_patch_tokens = self.encode_image_with_patch_features(vision_inputs)
+            feats_text_tensor = self.text_feature_cache.get([c_name], self.device, patch_tokens[0].dtype)
+
+            # patch-level maps for NativePromptLearner, the callers upsample them with pixel_anomaly_map
+            patch_level = self.patch_level_maps
+            anomaly_map_ret = self.text_anomaly_map(patch_tokens, feats_text_tensor, patch_level)
             # anomaly_map_all = anomaly_map_ret.unsqueeze(1).repeat((1,3,1,1))
             # anomaly_map_feature, _, _ = self.encode_image_from_tensor(anomaly_map_all)
             # image_embeds = anomaly_map_feature + image_embeds
-            if inputs['normal_img_paths']:
-                query_patch_tokens = self.encode_image_for_one_shot(inputs['image_paths'])
+            if inputs.get('normal_class_id') is not None:
+                normal_patch_tokens = self.memory_bank.get(inputs['normal_class_id'], self.device, query_patch_tokens[0].dtype, self.memory_bank_index)
+                anomaly_map_ret = self.few_shot_anomaly_map(query_patch_tokens, normal_patch_tokens, patch_level=patch_level)
+            elif inputs['normal_img_paths']:
                 if 'mvtec' in 'normal_img_paths':
                     normal_patch_tokens = self.encode_image_for_one_shot_with_aug(inputs['normal_img_paths'])
                 else:
                     normal_patch_tokens = self.encode_image_for_one_shot(inputs['normal_img_paths'])
-                sims = []
 
-                for i in range(len(query_patch_tokens)):
-                    query_patch_tokens_reshaped = query_patch_tokens[i].view(256,1,1280)
-                    normal_tokens_reshaped = normal_patch_tokens[i].reshape(1,-1,1280)
-                    cosine_similarity_matrix = F.cosine_similarity(query_patch_tokens_reshaped, normal_tokens_reshaped, dim=2)
-                    sim_max, _ = torch.max(cosine_similarity_matrix, dim=1)
-                    sims.append(sim_max)
+                anomaly_map_ret = self.few_shot_anomaly_map(query_patch_tokens, normal_patch_tokens, patch_level=patch_level) # (anomaly_map_ret + 1 - sim) / 2
 
-                sim = torch.mean(torch.stack(sims,dim=0), dim=0).reshape(1,1,16,16)
-                sim = F.interpolate(sim,size=224, mode='bilinear', align_corners=True)
-                anomaly_map_ret = 1 - sim # (anomaly_map_ret + 1 - sim) / 2
-                
 
             features.append(image_embeds)
         if inputs['audio_paths']:
@@ -678,34 +947,41 @@ class OpenLLAMAPEFTModel(nn.Module):
         # print(anomaly_map.shape)
         inputs['modality_embeds'].append(feature_embeds)
 
+        batch_size = feature_embeds.shape[0]
+        # self.prompt_learner.eval()
+        anomaly_map_prompts = self.prompt_learner(anomaly_map)
+        anomaly_map = self.pixel_anomaly_map(anomaly_map)
+        prefix_embeds = self.prepare_image_prefix_embedding(feature_embeds, anomaly_map_prompts)
+
+        text = prompt + '\n### Assistant:'
+        p_after_tokens = self.llama_tokenizer(text, add_special_tokens=False, return_tensors='pt').to(self.device)
+        p_after_embeds = self._embed_tokens(p_after_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s2 x embed_dim
+        inputs_embeds = torch.cat([prefix_embeds, p_after_embeds], dim=1) # bsz x (1+s1+1+s2) x embed_dim
+    
+        return inputs_embeds, anomaly_map
+
+    def prepare_image_prefix_embedding(self, feature_embeds, anomaly_map_prompts):
+        '''
+            the part of the prompt that only depends on the image
+            return: bsz x s x embed_dim embeddings of [bos, '### Human: <Img>', image, '</Img> ', prompt-learner tokens]
+        '''
         batch_size = feature_embeds.shape[0]
         p_before = PROMPT_START
         p_before_tokens = self.llama_tokenizer(p_before, 
             return_tensors="pt", add_special_tokens=False).to(self.device)
-        p_before_embeds = self.llama_model.model.model.embed_tokens(p_before_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
+        p_before_embeds = self._embed_tokens(p_before_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
         
         p_middle = '</Img> '
         p_middle_tokens = self.llama_tokenizer(p_middle, 
             return_tensors="pt", add_special_tokens=False).to(self.device)
         # peft model need deeper call
-        p_middle_embeds = self.llama_model.model.model.embed_tokens(p_middle_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
-
-        # self.prompt_learner.eval()
-        anomaly_map_prompts = self.prompt_learner(anomaly_map)
-
-
-
+        p_middle_embeds = self._embed_tokens(p_middle_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s1 x embed_dim
 
-        text = prompt + '\n### Assistant:'
-        p_after_tokens = self.llama_tokenizer(text, add_special_tokens=False, return_tensors='pt').to(self.device)
-        p_after_embeds = self.llama_model.model.model.embed_tokens(p_after_tokens.input_ids).expand(batch_size, -1, -1) # bsz x s2 x embed_dim
         bos = torch.ones([batch_size, 1],
                          dtype=p_before_tokens.input_ids.dtype,
                          device=p_before_tokens.input_ids.device) * self.llama_tokenizer.bos_token_id # bsz x 1
-        bos_embeds = self.llama_model.model.model.embed_tokens(bos) # bsz x 1 x embed_dim
-        inputs_embeds = torch.cat([bos_embeds, p_before_embeds, feature_embeds, p_middle_embeds, anomaly_map_prompts, p_after_embeds], dim=1) # bsz x (1+s1+1+s2) x embed_dim
-    
-        return inputs_embeds, anomaly_map
+        bos_embeds = self._embed_tokens(bos) # bsz x 1 x embed_dim
+        return torch.cat([bos_embeds, p_before_embeds, feature_embeds, p_middle_embeds, anomaly_map_prompts], dim=1)
 
     def generate(self, inputs, web_demo=False):
         '''
@@ -741,3 +1017,323 @@ class OpenLLAMAPEFTModel(nn.Module):
         )
         output_text = self.llama_tokenizer.decode(outputs[0][:-2], skip_special_tokens=True)
         return output_text, pixel_output
+
+    def answer_token_ids(self, answer):
+        '''vocabulary ids a response starting with `answer` can begin with, with and without the leading space'''
+        ids = {self.llama_tokenizer.convert_tokens_to_ids(piece) for piece in ('▁' + answer, answer)}
+        return sorted(i for i in ids if i is not None and i != self.llama_tokenizer.unk_token_id)
+
+    @torch.no_grad()
+    def classify(self, inputs, web_demo=False, max_continuation=0):
+        '''
+            Yes/No answer from a single prefill instead of sampling a whole response
+            inputs: as for generate, 'max_tgt_len', 'top_p' and 'temperature' are not used
+            max_continuation: if > 0, continue greedily after the Yes/No token for at most that many tokens,
+                              e.g. to recover the position phrase
+            return: probability of 'Yes' against 'No' at the first answer token, the response ('Yes' / 'No',
+                    or the greedy continuation), the anomaly map
+        '''
+        input_embeds, pixel_output = self.prepare_generation_embedding(inputs, web_demo)
+        outputs = self.llama_model(
+            inputs_embeds=input_embeds,
+            attention_mask=torch.ones(input_embeds.shape[:2], dtype=torch.long, device=input_embeds.device),
+            use_cache=max_continuation > 0,
+            return_dict=True,
+        )
+        logits = outputs.logits[0, -1].float()
+        yes_ids, no_ids = self.answer_token_ids('Yes'), self.answer_token_ids('No')
+        yes_no = torch.stack([logits[yes_ids].logsumexp(dim=0), logits[no_ids].logsumexp(dim=0)])
+        p_yes = float(yes_no.softmax(dim=0)[0])
+        if max_continuation <= 0:
+            return p_yes, 'Yes' if p_yes >= 0.5 else 'No', pixel_output
+
+        answer_ids = yes_ids if p_yes >= 0.5 else no_ids
+        first_id = answer_ids[int(logits[answer_ids].argmax())]
+        output_ids, _ = self.decode_with_past([first_id], outputs.past_key_values, max_continuation, None, None, do_sample=False)
+        output_ids = [first_id] + output_ids
+        if output_ids[-1] == 2277:
+            # drop the trailing '\n###' exactly like generate does
+            output_ids = output_ids[:-2]
+        return p_yes, self.llama_tokenizer.decode(output_ids, skip_special_tokens=True), pixel_output
+
+    def extract_multimodal_feature_batch(self, image_paths, class_names, normal_img_paths=None, web_demo=False, normal_class_ids=None):
+        '''
+            image_paths: list of n query images, encoded in a single ImageBind pass
+            class_names: list of n class names
+            normal_img_paths: None or a list of n lists of normal reference images (an entry may be empty)
+            normal_class_ids: None or a list of n memory bank class ids (an entry may be None), used instead of normal_img_paths
+            return: n x 1 x embed_dim image embeddings, n x 1 x 224 x 224 anomaly maps (the h x w patch-level
+                    ones for NativePromptLearner, see patch_level_maps)
+        '''
+        if not web_demo:
+            vision_inputs = data.load_and_transform_vision_data(image_paths, self.device)
+        else:
+            vision_inputs = data.load_and_transform_vision_data_for_web_demo(image_paths, self.device)
+        image_embeds, anomaly_maps = self.anomaly_maps_batch(vision_inputs, class_names, normal_img_paths, normal_class_ids,
+                                                             patch_level=self.patch_level_maps)
+        inputs_llama = self.llama_proj(image_embeds).unsqueeze(1) # bsz x 1 x llama_size
+        return inputs_llama, anomaly_maps
+
+    def anomaly_maps_batch(self, vision_inputs, class_names, normal_img_paths=None, normal_class_ids=None, features_only=False,
+                           patch_level=False):
+        '''
+            the vision side of extract_multimodal_feature_batch, never touches the language model
+            vision_inputs: n x 3 x 224 x 224, the other arguments as in extract_multimodal_feature_batch
+            features_only: maps only, the pooled embeddings are not computed (None)
+            patch_level: the h x w maps before the upsampling
+            return: n x 1024 pooled ImageBind embeddings, n x 1 x 224 x 224 anomaly maps (n x 1 x h x w with patch_level)
+        '''
+        image_embeds, query_patch_tokens, patch_tokens = self.encode_vision_features(vision_inputs, features_only)
+        feats_text_tensor = self.text_feature_cache.get(class_names, self.device, patch_tokens[0].dtype)
+        anomaly_maps = self.text_anomaly_map(patch_tokens, feats_text_tensor, patch_level)
+
+        if normal_img_paths and any(normal_img_paths):
+            # every distinct reference image is encoded once, even when shared between queries
+            unique_normal_paths = list(dict.fromkeys(p for paths in normal_img_paths if paths for p in paths))
+            normal_patch_tokens = self.encode_image_for_one_shot(unique_normal_paths)
+            path_to_idx = {path: idx for idx, path in enumerate(unique_normal_paths)}
+
+            anomaly_maps = anomaly_maps.clone()
+            for b, paths in enumerate(normal_img_paths):
+                if not paths:
+                    continue
+                ref_idx = torch.tensor([path_to_idx[p] for p in paths], device=normal_patch_tokens[0].device)
+                anomaly_maps[b] = self.few_shot_anomaly_map(
+                    [tokens[b:b+1] for tokens in query_patch_tokens],
+                    [tokens[ref_idx] for tokens in normal_patch_tokens],
+                    patch_level=patch_level,
+                )[0]
+
+        if normal_class_ids and any(class_id is not None for class_id in normal_class_ids):
+            anomaly_maps = anomaly_maps.clone()
+            for b, class_id in enumerate(normal_class_ids):
+                if class_id is None:
+                    continue
+                normal_patch_tokens = self.memory_bank.get(class_id, self.device, query_patch_tokens[0].dtype, self.memory_bank_index)
+                anomaly_maps[b] = self.few_shot_anomaly_map(
+                    [tokens[b:b+1] for tokens in query_patch_tokens], normal_patch_tokens, patch_level=patch_level)[0]
+
+        return image_embeds, anomaly_maps
+
+    @torch.no_grad()
+    def score(self, images, class_names, normal_refs=None, web_demo=False):
+        '''
+            anomaly maps and image-level scores from ImageBind, image_decoder and the few-shot matcher only,
+            works with load_llm=False
+            images: n image paths or an n x 3 x 224 x 224 tensor of already transformed images
+            class_names: n class names, or a single one shared by all images
+            normal_refs: None, a memory bank class id shared by all images, or n entries that are each None,
+                         a memory bank class id (see build_memory_bank) or a list of normal image paths
+            return: n x 1 x 224 x 224 anomaly maps, n image scores (max of the map)
+        '''
+        if torch.is_tensor(images):
+            vision_inputs = images
+        elif not web_demo:
+            vision_inputs = data.load_and_transform_vision_data(images, self.device)
+        else:
+            vision_inputs = data.load_and_transform_vision_data_for_web_demo(images, self.device)
+        n = vision_inputs.shape[0]
+        if isinstance(class_names, str):
+            class_names = [class_names] * n
+        if normal_refs is None or isinstance(normal_refs, str):
+            normal_refs = [normal_refs] * n
+        assert len(class_names) == len(normal_refs) == n
+
+        normal_img_paths = [refs if isinstance(refs, (list, tuple)) else None for refs in normal_refs]
+        normal_class_ids = [refs if isinstance(refs, str) else None for refs in normal_refs]
+        _, anomaly_maps = self.anomaly_maps_batch(vision_inputs, class_names, normal_img_paths, normal_class_ids, features_only=True)
+        return anomaly_maps, anomaly_maps.flatten(1).max(dim=1)[0]
+
+    def prepare_generation_embedding_batch(self, prompts, feature_embeds, anomaly_maps):
+        '''
+            prompts: list of n human prompts
+            feature_embeds: n x 1 x embed_dim, anomaly_maps: n x 1 x 224 x 224 (or n x 1 x h x w, see patch_level_maps)
+            return: left-padded n x s x embed_dim inputs_embeds and the n x s attention mask
+        '''
+        batch_size = feature_embeds.shape[0]
+        embed_tokens = self._embed_tokens
+
+        p_before_tokens = self.llama_tokenizer(PROMPT_START,
+            return_tensors="pt", add_special_tokens=False).to(self.device)
+        p_before_embeds = embed_tokens(p_before_tokens.input_ids)[0] # s1 x embed_dim
+        p_middle_tokens = self.llama_tokenizer('</Img> ',
+            return_tensors="pt", add_special_tokens=False).to(self.device)
+        p_middle_embeds = embed_tokens(p_middle_tokens.input_ids)[0] # s1 x embed_dim
+        bos = torch.tensor([self.llama_tokenizer.bos_token_id], dtype=torch.long, device=self.device)
+        bos_embeds = embed_tokens(bos) # 1 x embed_dim
+
+        anomaly_map_prompts = self.prompt_learner(anomaly_maps)
+
+        rows = []
+        for i in range(batch_size):
+            text = prompts[i] + '\n### Assistant:'
+            p_after_tokens = self.llama_tokenizer(text, add_special_tokens=False, return_tensors='pt').to(self.device)
+            p_after_embeds = embed_tokens(p_after_tokens.input_ids)[0] # s2 x embed_dim
+            rows.append(torch.cat([bos_embeds, p_before_embeds, feature_embeds[i], p_middle_embeds, anomaly_map_prompts[i], p_after_embeds], dim=0))
+
+        # decoder-only generation continues from the last position, so pad on the left
+        max_len = max(row.shape[0] for row in rows)
+        inputs_embeds = rows[0].new_zeros((batch_size, max_len, rows[0].shape[-1]))
+        attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long, device=self.device)
+        for i, row in enumerate(rows):
+            inputs_embeds[i, max_len - row.shape[0]:] = row
+            attention_mask[i, max_len - row.shape[0]:] = 1
+        return inputs_embeds, attention_mask
+
+    def decode_response(self, output_ids, stop_id=2277):
+        if torch.is_tensor(output_ids):
+            output_ids = output_ids.tolist()
+        if stop_id in output_ids:
+            output_ids = output_ids[:output_ids.index(stop_id) + 1]
+        elif self.llama_tokenizer.eos_token_id in output_ids:
+            # the answer ended with </s> instead of '\n###', there is nothing to drop
+            return self.llama_tokenizer.decode(output_ids[:output_ids.index(self.llama_tokenizer.eos_token_id)], skip_special_tokens=True)
+        # drop the trailing '\n###' exactly like generate does
+        return self.llama_tokenizer.decode(output_ids[:-2], skip_special_tokens=True)
+
+    @torch.no_grad()
+    def generate_batch(self, inputs, web_demo=False):
+        '''
+            inputs = {
+                'image_paths': n query images,
+                'prompts': n human input prompts (or a single 'prompt' shared by all images),
+                'class_names': optional, n class names, found in the prompts when missing,
+                'normal_img_paths': optional, n lists of normal reference images,
+                'normal_class_ids': optional, n memory bank class ids, see build_memory_bank,
+                'max_tgt_len': generation length,
+                'top_p': top_p,
+                'temperature': temperature,
+                'sync_every': optional, steps between host syncs of the decode loop,
+                'static_kv_cache': optional, decode into a preallocated StaticKVCache
+            }
+            return: n responses, n x 1 x 224 x 224 anomaly maps
+        '''
+        image_paths = inputs['image_paths']
+        prompts = inputs.get('prompts') or [inputs['prompt']] * len(image_paths)
+        class_names = inputs.get('class_names') or [find_class_name(prompt) for prompt in prompts]
+        assert len(prompts) == len(image_paths) == len(class_names)
+
+        feature_embeds, anomaly_maps = self.extract_multimodal_feature_batch(
+            image_paths, class_names, inputs.get('normal_img_paths'), web_demo, inputs.get('normal_class_ids'))
+        input_embeds, attention_mask = self.prepare_generation_embedding_batch(prompts, feature_embeds, anomaly_maps)
+
+        # finished rows leave the batch instead of decoding padding until the longest answer ends
+        outputs = decode_batch(
+            self.llama_model,
+            self._embed_tokens,
+            input_embeds,
+            attention_mask,
+            max_new_tokens=inputs['max_tgt_len'],
+            top_p=inputs['top_p'],
+            temperature=inputs['temperature'],
+            stop_sequences=((2277,),),
+            pad_token_id=self.llama_tokenizer.pad_token_id,
+            eos_token_id=self.llama_tokenizer.eos_token_id,
+            sync_every=inputs.get('sync_every', 8),
+            static_cache=inputs.get('static_kv_cache', False),
+        )
+        output_texts = [self.decode_response(output_ids) for output_ids in outputs]
+        return output_texts, self.pixel_anomaly_map(anomaly_maps)
+
+    def tokenize_continuation(self, text):
+        '''token ids of text appended to an existing sequence, without the sentencepiece dummy prefix'''
+        input_ids = self.llama_tokenizer(text, add_special_tokens=False).input_ids
+        if input_ids and not text.startswith(' ') and input_ids[0] == self.llama_tokenizer.convert_tokens_to_ids('▁'):
+            input_ids = input_ids[1:]
+        return input_ids
+
+    def decode_with_past(self, input_ids, past_key_values, max_tgt_len, top_p, temperature, stop_id=2277, do_sample=True):
+        '''
+            prefill input_ids on top of past_key_values, then sample (or pick greedily) one token at a time until stop_id
+            return: the generated ids (stop_id included), the past_key_values of everything that was fed
+        '''
+        embed_tokens = self._embed_tokens
+        embeds = embed_tokens(torch.tensor([input_ids], dtype=torch.long, device=self.device)) # 1 x s x embed_dim
+        output_ids = []
+        for _ in range(max_tgt_len):
+            attention_mask = torch.ones([1, past_length(past_key_values) + embeds.shape[1]], dtype=torch.long, device=self.device)
+            outputs = self.llama_model(
+                inputs_embeds=embeds,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+            past_key_values = outputs.past_key_values
+            if do_sample:
+                next_token = sample_next_token(outputs.logits[:, -1, :], top_p, temperature)
+            else:
+                next_token = outputs.logits[:, -1, :].argmax(dim=-1)
+            output_ids.append(int(next_token))
+            if output_ids[-1] == stop_id:
+                break
+            embeds = embed_tokens(next_token.unsqueeze(1))
+        return output_ids, past_key_values
+
+    @torch.no_grad()
+    def start_chat(self, image_path, normal_img_path=None, prompt='', web_demo=True):
+        '''
+            encode the image, run the anomaly head and the prompt learner, and prefill the image prefix once
+            prompt: the first question, only used to find the class name of the text features
+            return: a ChatSession to pass to chat / ask
+        '''
+        session = ChatSession(image_path, normal_img_path)
+        inputs = {
+            'prompt': prompt,
+            'image_paths': [image_path],
+            'normal_img_paths': [normal_img_path] if normal_img_path else [],
+            'audio_paths': [],
+            'video_paths': [],
+            'thermal_paths': [],
+        }
+        session.feature_embeds, session.anomaly_map = self.extract_multimodal_feature(inputs, web_demo)
+        session.anomaly_map_prompts = self.prompt_learner(session.anomaly_map)
+        session.anomaly_map = self.pixel_anomaly_map(session.anomaly_map)
+        prefix_embeds = self.prepare_image_prefix_embedding(session.feature_embeds, session.anomaly_map_prompts)
+        outputs = self.llama_model(
+            inputs_embeds=prefix_embeds,
+            attention_mask=torch.ones(prefix_embeds.shape[:2], dtype=torch.long, device=self.device),
+            use_cache=True,
+            return_dict=True,
+        )
+        session.prefix_past_key_values = outputs.past_key_values
+        session.reset_conversation()
+        return session
+
+    def answer(self, past_key_values, input_ids, max_tgt_len, top_p, temperature):
+        output_ids, past_key_values = self.decode_with_past(input_ids, past_key_values, max_tgt_len, top_p, temperature)
+        # drop the trailing '\n###' exactly like generate does
+        answer_ids = output_ids[:-2]
+        response = self.llama_tokenizer.decode(answer_ids, skip_special_tokens=True)
+        return response, answer_ids, past_key_values
+
+    @torch.no_grad()
+    def chat(self, session, question, max_tgt_len=512, top_p=0.01, temperature=1.0):
+        '''
+            one turn of the conversation, only the new human message is prefilled
+            return: the response, the 1 x 1 x 224 x 224 anomaly map of the session
+        '''
+        if session.history:
+            # the cache ends right after the previous answer
+            input_ids = self.tokenize_continuation(f'\n### Human: {question}\n### Assistant:')
+        else:
+            input_ids = self.llama_tokenizer(question + '\n### Assistant:', add_special_tokens=False).input_ids
+        start = past_length(session.past_key_values)
+        response, answer_ids, past_key_values = self.answer(session.past_key_values, input_ids, max_tgt_len, top_p, temperature)
+        # keep the question and the answer, not the stop tokens, for the next turn
+        session.past_key_values = truncate_past_key_values(past_key_values, start + len(input_ids) + len(answer_ids))
+        session.history.append((question, response))
+        return response, session.anomaly_map
+
+    @torch.no_grad()
+    def ask(self, session, questions, max_tgt_len=512, top_p=0.01, temperature=1.0):
+        '''
+            independent single-turn questions about the image of the session, all sharing its prefilled prefix
+            return: the responses, the 1 x 1 x 224 x 224 anomaly map of the session
+        '''
+        responses = []
+        for question in questions:
+            input_ids = self.llama_tokenizer(question + '\n### Assistant:', add_special_tokens=False).input_ids
+            response, _, _ = self.answer(session.prefix_past_key_values, input_ids, max_tgt_len, top_p, temperature)
+            responses.append(response)
+        return responses, session.anomaly_map
@@ -0,0 +1,167 @@
+import torch
+
+
+def normalize_tokens(tokens, eps=1e-8):
+    return tokens / tokens.norm(dim=-1, keepdim=True).clamp_min(eps)
+
+
+def compute_dtype(tensor):
+    # half matmuls are slow (or missing) on cpu
+    if tensor.device.type == 'cpu' and tensor.dtype in (torch.float16, torch.bfloat16):
+        return torch.float32
+    return tensor.dtype
+
+
+def max_cosine_similarity(query, bank, chunk_size=4096, normalized=False):
+    '''
+        query: bsz x L x C query patch tokens
+        bank: M x C reference patch tokens shared by every query, or bsz x M x C (one bank per query image)
+        chunk_size: reference patches compared at once, memory is bounded by bsz x L x chunk_size
+        return: bsz x L, the cosine similarity of every query patch to its nearest reference patch
+    '''
+    dtype = compute_dtype(query)
+    query = query.to(dtype)
+    if not normalized:
+        query = normalize_tokens(query)
+    best = torch.full(query.shape[:-1], float('-inf'), dtype=dtype, device=query.device)
+    for start in range(0, bank.shape[-2], chunk_size):
+        chunk = bank[..., start:start + chunk_size, :].to(device=query.device, dtype=dtype)
+        if not normalized:
+            chunk = normalize_tokens(chunk)
+        sim = torch.matmul(query, chunk.transpose(-2, -1)) # bsz x L x chunk
+        best = torch.maximum(best, sim.amax(dim=-1))
+    return best
+
+
+class ExactPatchIndex:
+
+    '''Normalized reference patches searched with blocked matmuls, optionally stored in fp16.'''
+
+    def __init__(self, tokens, dtype=None, chunk_size=4096):
+        tokens = normalize_tokens(tokens.reshape(-1, tokens.shape[-1]).float())
+        self.tokens = tokens.to(dtype) if dtype is not None else tokens
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.tokens.shape[0]
+
+    def to(self, device):
+        self.tokens = self.tokens.to(device)
+        return self
+
+    def search(self, query):
+        '''query: bsz x L x C -> bsz x L max cosine similarity'''
+        return max_cosine_similarity(normalize_tokens(query.to(compute_dtype(query))), self.tokens, self.chunk_size, normalized=True)
+
+
+def kmeans(x, k, iters=20, spherical=False, chunk_size=16384, seed=0):
+    '''
+        x: n x d, plain Lloyd iterations with a chunked assignment step
+        spherical: assign by inner product and keep the centroids on the unit sphere
+        return: k x d centroids, n assignments
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    k = min(k, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:k].to(x.device)].clone()
+    for _ in range(iters):
+        assign = assign_to_centroids(x, centroids, spherical, chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=k).to(x.dtype).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp_min(1), centroids)
+        if spherical:
+            centroids = normalize_tokens(centroids)
+    return centroids, assign_to_centroids(x, centroids, spherical, chunk_size)
+
+
+def assign_to_centroids(x, centroids, spherical=False, chunk_size=16384):
+    assign = []
+    for start in range(0, x.shape[0], chunk_size):
+        chunk = x[start:start + chunk_size]
+        if spherical:
+            assign.append((chunk @ centroids.T).argmax(dim=1))
+        else:
+            assign.append(torch.cdist(chunk, centroids).argmin(dim=1))
+    return torch.cat(assign)
+
+
+class IVFPQPatchIndex:
+
+    '''Approximate max inner product search over normalized reference patches.
+
+    A spherical k-means coarse quantizer splits the bank into `n_lists` inverted lists, the
+    residuals to the list centroids are product-quantized into `n_subquantizers` uint8 codes.
+    A query only scans the `n_probe` lists with the closest centroids and scores each entry
+    as <q, centroid> + sum of the per-subspace lookup table entries of its code.
+    '''
+
+    def __init__(self, tokens, n_lists=64, n_subquantizers=64, n_centroids=256, n_probe=8, iters=20, chunk_size=1024):
+        tokens = normalize_tokens(tokens.reshape(-1, tokens.shape[-1]).float())
+        dim = tokens.shape[-1]
+        assert dim % n_subquantizers == 0, f'{dim} is not divisible into {n_subquantizers} subquantizers'
+        assert n_centroids <= 256, 'codes are stored as uint8'
+        self.n_probe = n_probe
+        self.n_subquantizers = n_subquantizers
+        self.chunk_size = chunk_size
+
+        self.coarse_centroids, assign = kmeans(tokens, n_lists, iters, spherical=True)
+        residuals = (tokens - self.coarse_centroids[assign]).reshape(-1, n_subquantizers, dim // n_subquantizers)
+        codebooks, codes = [], []
+        for m in range(n_subquantizers):
+            codebook, code = kmeans(residuals[:, m], n_centroids, iters)
+            codebooks.append(codebook)
+            codes.append(code)
+        self.codebooks = torch.stack(codebooks, dim=0) # n_subquantizers x n_centroids x dsub
+        codes = torch.stack(codes, dim=1).to(torch.uint8) # n x n_subquantizers
+
+        # inverted lists, sorted by coarse assignment
+        order = torch.argsort(assign)
+        self.codes = codes[order]
+        counts = torch.bincount(assign, minlength=self.coarse_centroids.shape[0])
+        self.list_offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def to(self, device):
+        self.coarse_centroids = self.coarse_centroids.to(device)
+        self.codebooks = self.codebooks.to(device)
+        self.codes = self.codes.to(device)
+        return self
+
+    def search(self, query):
+        '''query: bsz x L x C -> bsz x L approximate max cosine similarity'''
+        shape = query.shape[:-1]
+        query = normalize_tokens(query.reshape(-1, query.shape[-1]).float())
+        coarse = query @ self.coarse_centroids.T # q x n_lists
+        probe = coarse.topk(min(self.n_probe, coarse.shape[1]), dim=1).indices
+        # lookup tables: q x n_subquantizers x n_centroids
+        tables = torch.einsum('qmd,mkd->qmk', query.reshape(query.shape[0], self.n_subquantizers, -1), self.codebooks)
+
+        best = torch.full((query.shape[0],), float('-inf'), device=query.device)
+        for j in range(coarse.shape[1]):
+            begin, end = self.list_offsets[j], self.list_offsets[j + 1]
+            rows = (probe == j).any(dim=1).nonzero(as_tuple=True)[0]
+            if begin == end or rows.numel() == 0:
+                continue
+            row_tables = tables[rows]
+            for start in range(begin, end, self.chunk_size):
+                codes = self.codes[start:min(end, start + self.chunk_size)].long().T # n_subquantizers x n
+                scores = row_tables.gather(2, codes.unsqueeze(0).expand(rows.numel(), -1, -1)).sum(dim=1)
+                scores = scores.amax(dim=1) + coarse[rows, j]
+                best[rows] = torch.maximum(best[rows], scores)
+        return best.reshape(shape)
+
+
+def build_patch_index(tokens, kind='exact', **kwargs):
+    '''
+        tokens: ... x C reference patch tokens of one layer
+        kind: 'exact' (fp32), 'fp16' or 'ivfpq'
+    '''
+    if kind == 'exact':
+        return ExactPatchIndex(tokens, **kwargs)
+    if kind == 'fp16':
+        return ExactPatchIndex(tokens, dtype=torch.float16, **kwargs)
+    if kind == 'ivfpq':
+        return IVFPQPatchIndex(tokens, **kwargs)
+    raise ValueError(f'unknown patch index {kind}')
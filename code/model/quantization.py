@@ -0,0 +1,104 @@
+import inspect
+import json
+import os
+
+import torch
+from torch import nn
+from transformers import LlamaConfig
+
+try:
+    import torch.ao.nn.quantized.dynamic as nnqd
+except ImportError: # torch<1.13
+    import torch.nn.quantized.dynamic as nnqd
+
+from .modeling_llama import LlamaForCausalLM
+from .meta_init import init_on_meta, materialize
+
+QUANTIZED_FILE = 'pytorch_model_int8.pt'
+QUANTIZATION_FILE = 'quantization.json'
+DECODER_LINEARS = ('q_proj', 'k_proj', 'v_proj', 'o_proj', 'gate_proj', 'up_proj', 'down_proj')
+
+
+def quantizable_linears(model, include_lm_head=False):
+    '''
+        names of the nn.Linear of the decoder layers (attention and mlp projections), and of lm_head if asked,
+        embed_tokens is never quantized: prompt_wrap and the decode loops feed its fp32 rows as inputs_embeds
+    '''
+    names = []
+    for name, module in model.named_modules():
+        if type(module) is not nn.Linear:
+            continue
+        if name.rpartition('.')[2] in DECODER_LINEARS or (include_lm_head and name == 'lm_head'):
+            names.append(name)
+    return names
+
+
+def quantize_llama(model, include_lm_head=False):
+    '''
+        int8 weights with dynamic (per batch) int8 activations for the decoder linears, in place
+        model: a plain fp32 LlamaForCausalLM on cpu, merge and unload the LoRA first (see lora_merge.unload_lora)
+        return: model
+    '''
+    if any('lora_' in name for name, _ in model.named_parameters()):
+        raise ValueError('[!] unload the LoRA layers before quantizing, see lora_merge.unload_lora')
+    if next(model.parameters()).dtype != torch.float32 or next(model.parameters()).device.type != 'cpu':
+        raise ValueError('[!] dynamic quantization runs on fp32 cpu models, call .float().cpu() first')
+    names = quantizable_linears(model, include_lm_head)
+    torch.ao.quantization.quantize_dynamic(model, set(names), dtype=torch.qint8, inplace=True)
+    model.quantized_modules = names
+    return model
+
+
+def quantized_size(model):
+    '''bytes of the model weights: the float parameters and buffers plus the packed int8 weights'''
+    size = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    for module in model.modules():
+        if isinstance(module, nnqd.Linear):
+            weight, bias = module._weight_bias()
+            size += weight.numel() * weight.element_size()
+            size += 0 if bias is None else bias.numel() * bias.element_size()
+    return size
+
+
+def save_quantized_llama(model, save_dir):
+    '''the quantized state dict, the config and the list of quantized modules, see load_quantized_llama'''
+    os.makedirs(save_dir, exist_ok=True)
+    model.config.save_pretrained(save_dir)
+    torch.save(model.state_dict(), os.path.join(save_dir, QUANTIZED_FILE))
+    with open(os.path.join(save_dir, QUANTIZATION_FILE), 'w') as f:
+        json.dump({
+            'dtype': 'qint8',
+            'engine': torch.backends.quantized.engine,
+            'modules': model.quantized_modules,
+        }, f, indent=2)
+
+
+@torch.no_grad()
+def load_quantized_llama(save_dir, attention_backend='eager'):
+    '''
+        build the LlamaForCausalLM on the meta device, swap the quantized linears for empty int8 ones
+        and fill everything from save_dir, the fp32 weights are never randomly initialized
+        return: the quantized model on cpu
+    '''
+    with open(os.path.join(save_dir, QUANTIZATION_FILE)) as f:
+        quantization = json.load(f)
+    if quantization['engine'] != torch.backends.quantized.engine:
+        print(f'[!] {save_dir} was quantized with the {quantization["engine"]} engine, this one uses {torch.backends.quantized.engine}')
+    config = LlamaConfig.from_pretrained(save_dir)
+    config.attention_backend = attention_backend
+    with init_on_meta():
+        model = LlamaForCausalLM(config)
+    for name in quantization['modules']:
+        linear = model.get_submodule(name)
+        parent_name, _, child_name = name.rpartition('.')
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child_name, nnqd.Linear(linear.in_features, linear.out_features,
+                                                bias_=linear.bias is not None, dtype=torch.qint8))
+    materialize(model, 'cpu', torch.float32)
+
+    load_kwargs = {'map_location': torch.device('cpu')}
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        load_kwargs['mmap'] = True
+    model.load_state_dict(torch.load(os.path.join(save_dir, QUANTIZED_FILE), **load_kwargs), strict=True)
+    model.quantized_modules = quantization['modules']
+    return model.eval()
@@ -1,5 +1,6 @@
 import os
-from model.openllama import OpenLLAMAPEFTModel
+from model.openllama import OpenLLAMAPEFTModel, find_class_name
+from model.checkpoint import load_checkpoint
 import torch
 from torchvision import transforms
 from sklearn.metrics import roc_auc_score
@@ -15,9 +16,40 @@ parser = argparse.ArgumentParser("AnomalyGPT", add_help=True)
 parser.add_argument("--few_shot", type=bool, default=True)
 parser.add_argument("--k_shot", type=int, default=1)
 parser.add_argument("--round", type=int, default=14)
+parser.add_argument("--coreset_size", type=int, default=None)
+parser.add_argument("--coreset_ratio", type=float, default=None)
+# search the memory bank through a patch index (model/patch_knn.py) instead of the exact blocked matmul
+parser.add_argument("--memory_bank_index", type=str, default=None, choices=['exact', 'fp16', 'ivfpq'])
+# anomaly maps and image scores only, the language model is not loaded and precision is not computed
+parser.add_argument("--score_only", action='store_true')
+# test images per score call with --score_only
+parser.add_argument("--batch_size", type=int, default=16)
+# sample the whole response with generate instead of reading the Yes/No probability of the first answer token
+parser.add_argument("--sample_response", action='store_true')
+# 'sdpa' runs the language model attention through torch.nn.functional.scaled_dot_product_attention (torch>=2.0)
+parser.add_argument("--attention_backend", type=str, default='eager', choices=['eager', 'sdpa'])
+# build ImageBind without its text branch, the text features of every class must already be in the text feature cache
+parser.add_argument("--text_free", action='store_true')
+# a packed inference bundle written by export_bundle.py, replaces the four checkpoints below
+parser.add_argument("--bundle_path", type=str, default=None)
+# fold the LoRA deltas into the Vicuna weights and drop the peft wrapper once the checkpoints are loaded
+parser.add_argument("--merge_lora", action='store_true')
+# cpu-only replicas: everything in fp32 on the cpu, --int8 quantizes the language model after the LoRA merge
+parser.add_argument("--device", type=str, default='cuda', choices=['cuda', 'cpu'])
+parser.add_argument("--int8", action='store_true')
+# an int8 language model written by export_merged_llama.py --int8, replaces vicuna_ckpt_path
+parser.add_argument("--quantized_llm_path", type=str, default=None)
+# the ImageBind vision trunk with int8 linears (--vision_int8, cpu only) or under bf16 autocast (--vision_bf16, cpu or cuda)
+parser.add_argument("--vision_int8", action='store_true')
+parser.add_argument("--vision_bf16", action='store_true')
+# the prompt learner on the 16 x 16 patch-level anomaly map, with the native_net weights written by distill_prompt_learner.py
+parser.add_argument("--native_prompt_learner", type=str, default=None)
 
 
 command_args = parser.parse_args()
+if command_args.native_prompt_learner is not None and command_args.bundle_path is not None:
+    # the bundles are exported with the original PromptLearner, the native_net weights would not load into one
+    parser.error('--native_prompt_learner does not apply to --bundle_path, load the checkpoints instead')
 
 
 describles = {}
@@ -48,14 +80,40 @@ args = {
     'lora_r': 32,
     'lora_alpha': 32,
     'lora_dropout': 0.1,
+    'text_feature_cache_dir': './ckpt/text_feature_cache',
+    'memory_bank_dir': './ckpt/memory_bank',
+    'memory_bank_index': command_args.memory_bank_index,
+    'load_llm': not command_args.score_only,
+    'attention_backend': command_args.attention_backend,
+    # only the vision (and text) branches of ImageBind are used
+    'imagebind_modalities': ['vision'] if command_args.text_free else ['vision', 'text'],
+    'bundle_path': command_args.bundle_path,
+    'quantized_llm_path': command_args.quantized_llm_path,
+    'native_prompt_learner': command_args.native_prompt_learner is not None,
 }
+if command_args.device == 'cpu':
+    args.update({'device': 'cpu', 'init_device': 'cpu', 'init_dtype': torch.float32})
+if command_args.vision_bf16:
+    args['vision_autocast'] = 'bf16'
 
 model = OpenLLAMAPEFTModel(**args)
-delta_ckpt = torch.load(args['delta_ckpt_path'], map_location=torch.device('cpu'))
-model.load_state_dict(delta_ckpt, strict=False)
-delta_ckpt = torch.load(args['anomalygpt_ckpt_path'], map_location=torch.device('cpu'))
-model.load_state_dict(delta_ckpt, strict=False)
-model = model.eval().half().cuda()
+model = model.eval()
+if command_args.device == 'cuda':
+    model = model.half().cuda()
+# copied from the memory-mapped checkpoints straight into the fp16 cuda weights
+if command_args.bundle_path is None:
+    load_checkpoint(model, args['delta_ckpt_path'])
+    load_checkpoint(model, args['anomalygpt_ckpt_path'])
+if command_args.native_prompt_learner is not None:
+    missing_keys, _ = load_checkpoint(model, command_args.native_prompt_learner)
+    assert not any(key.startswith('prompt_learner.native_net.') for key in missing_keys), \
+        f'native_net missing from {command_args.native_prompt_learner}, see distill_prompt_learner.py'
+if command_args.merge_lora:
+    model.merge_lora(unload=True)
+if command_args.int8:
+    model.quantize_llm()
+if command_args.vision_int8:
+    model.quantize_vision()
 
 print(f'[!] init the 7b model over ...')
 
@@ -71,6 +129,7 @@ def predict(
     temperature,
     history,
     modality_cache,  
+    normal_class_id=None,
 ):
     
     prompt_text = ''
@@ -84,7 +143,7 @@ def predict(
     else:
         prompt_text += f' Human: {input}'
 
-    response, pixel_output = model.generate({
+    inputs = {
         'prompt': prompt_text,
         'image_paths': [image_path] if image_path else [],
         'audio_paths': [],
@@ -94,8 +153,13 @@ def predict(
         'top_p': top_p,
         'temperature': temperature,
         'max_tgt_len': max_length,
-        'modality_embeds': modality_cache
-    })
+        'modality_embeds': modality_cache,
+        'normal_class_id': normal_class_id,
+    }
+    if command_args.sample_response:
+        response, pixel_output = model.generate(inputs)
+    else:
+        _, response, pixel_output = model.classify(inputs)
 
     return response, pixel_output
 
@@ -116,6 +180,9 @@ datas_csv_path = '../data/VisA/split_csv/1cls.csv'
 CLASS_NAMES = ['candle', 'capsules', 'cashew', 'chewinggum', 'fryum', 'macaroni1', 'macaroni2','pcb1', 'pcb2', 'pcb3', 'pcb4', 'pipe_fryum']
 
 precision = []
+
+# encode the prompt ensembles of every class in one text pass (or read them from the cache)
+model.text_feature_cache.prefetch([find_class_name(describles[c_name] + ' ' + input) for c_name in CLASS_NAMES])
 file_paths = {}
 normal_img_path = {}
 
@@ -148,9 +215,24 @@ for c_name in CLASS_NAMES:
     p_label = []
     i_pred = []
     i_label = []
-    for file_path in tqdm(file_paths[c_name]):
-        if FEW_SHOT:
-            resp, anomaly_map = predict(describles[c_name] + ' ' + input, file_path, normal_img_path[c_name], 512, 0.01, 1.0, [], [])
+    # zero-shot without references (e.g. --k_shot 0), like empty normal_img_paths
+    normal_class_id = f'visa_{c_name}' if FEW_SHOT and normal_img_path[c_name] else None
+    if normal_class_id is not None:
+        # the normal references are encoded once per class and then served from the memory bank
+        model.build_memory_bank(normal_class_id, normal_img_path[c_name], coreset_size=command_args.coreset_size, coreset_ratio=command_args.coreset_ratio)
+    score_only_maps = []
+    if command_args.score_only:
+        # the test images of the class go through score batch_size at a time
+        for start in tqdm(range(0, len(file_paths[c_name]), command_args.batch_size)):
+            anomaly_maps, _ = model.score(file_paths[c_name][start:start + command_args.batch_size],
+                                          find_class_name(describles[c_name] + ' ' + input), normal_class_id)
+            score_only_maps += list(anomaly_maps)
+    for idx, file_path in enumerate(tqdm(file_paths[c_name], disable=command_args.score_only)):
+        if command_args.score_only:
+            anomaly_map = score_only_maps[idx]
+            resp = None
+        elif normal_class_id is not None:
+            resp, anomaly_map = predict(describles[c_name] + ' ' + input, file_path, normal_img_path[c_name], 512, 0.01, 1.0, [], [], normal_class_id)
         else:
             resp, anomaly_map = predict(describles[c_name] + ' ' + input, file_path, None, 512, 0.01, 1.0, [], [])
         is_normal = 'Normal' in file_path.split('/')[-2]
@@ -177,7 +259,9 @@ for c_name in CLASS_NAMES:
 
 
         # print(file_path, resp)
-        if 'Normal' not in file_path and 'Yes' in resp:
+        if resp is None:
+            pass
+        elif 'Normal' not in file_path and 'Yes' in resp:
             right += 1
         elif 'Normal' in file_path and 'No' in resp:
             right += 1
@@ -195,7 +279,8 @@ for c_name in CLASS_NAMES:
     
     p_auc_list.append(p_auroc)
     i_auc_list.append(i_auroc)
-    precision.append(100 * right / (right + wrong))
+    if right + wrong > 0:
+        precision.append(100 * right / (right + wrong))
 
     print(c_name, 'right:',right,'wrong:',wrong)
     print(c_name, "i_AUROC:", i_auroc)
@@ -1,6 +1,7 @@
 import gradio as gr
 import mdtex2html
 from model.openllama import OpenLLAMAPEFTModel
+from model.checkpoint import load_checkpoint
 import torch
 from io import BytesIO
 from PIL import Image as PILImage
@@ -20,17 +21,15 @@ args = {
     'max_tgt_len': 128,
     'lora_r': 32,
     'lora_alpha': 32,
-    'lora_dropout': 0.1
+    'lora_dropout': 0.1,
+    'imagebind_modalities': ['vision', 'text'],
 }
 
 model = OpenLLAMAPEFTModel(**args)
-#delta_ckpt = torch.load(args['delta_ckpt_path'], map_location=torch.device('cpu'))
-delta_ckpt = torch.load(args['delta_ckpt_path'], map_location=torch.device('cuda'))
-model.load_state_dict(delta_ckpt, strict=False)
-#delta_ckpt = torch.load(args['anomalygpt_ckpt_path'], map_location=torch.device('cpu'))
-delta_ckpt = torch.load(args['anomalygpt_ckpt_path'], map_location=torch.device('cuda'))
-model.load_state_dict(delta_ckpt, strict=False)
 model = model.eval().half().cuda()
+# copied from the memory-mapped checkpoints straight into the fp16 cuda weights
+load_checkpoint(model, args['delta_ckpt_path'])
+load_checkpoint(model, args['anomalygpt_ckpt_path'])
 
 
 """Override Chatbot.postprocess"""
@@ -90,7 +89,7 @@ def predict(
     top_p, 
     temperature, 
     history, 
-    modality_cache, 
+    session, 
 ):
     
     if image_path is None and normal_img_path is None:
@@ -98,30 +97,12 @@ def predict(
     else:
         print(f'[!] image path: {image_path}\n[!] normal image path: {normal_img_path}\n')
 
-    # prepare the prompt
-    prompt_text = ''
-    for idx, (q, a) in enumerate(history):
-        if idx == 0:
-            prompt_text += f'{q}\n### Assistant: {a}\n###'
-        else:
-            prompt_text += f' Human: {q}\n### Assistant: {a}\n###'
-    if len(history) == 0:
-        prompt_text += f'{input}'
-    else:
-        prompt_text += f' Human: {input}'
-
-    response, pixel_output = model.generate({
-        'prompt': prompt_text,
-        'image_paths': [image_path] if image_path else [],
-        'normal_img_paths': [normal_img_path] if normal_img_path else [],
-        'audio_paths': [],
-        'video_paths': [],
-        'thermal_paths': [],
-        'top_p': top_p,
-        'temperature': temperature,
-        'max_tgt_len': max_length,
-        'modality_embeds': modality_cache
-    },web_demo=True)
+    # the session keeps the image features, the anomaly map and the kv cache of the conversation,
+    # a new image (or a cleared history) starts a new one
+    if session is None or not session.matches(image_path, normal_img_path) or len(session.history) != len(history):
+        session = model.start_chat(image_path, normal_img_path, input, web_demo=True)
+        history = []
+    response, pixel_output = model.chat(session, input, max_length, top_p, temperature)
     chatbot.append((parse_text(input), parse_text(response)))
     history.append((input, response))
 
@@ -158,7 +139,7 @@ def predict(
     output =  PILImage.open('output.png').convert('L')
 
 
-    return chatbot, history, modality_cache, output
+    return chatbot, history, session, output
 
 
 
@@ -167,7 +148,7 @@ def reset_user_input():
 
 
 def reset_state():
-    return gr.update(value=''), None, None, [], [], [], PILImage.open('ffffff.png')
+    return gr.update(value=''), None, None, [], [], None, PILImage.open('ffffff.png')
 
 
 
@@ -204,7 +185,7 @@ with gr.Blocks() as demo:
                     emptyBtn = gr.Button("Clear History")
                     
     history = gr.State([])
-    modality_cache = gr.State([])
+    session = gr.State(None)
 
     submitBtn.click(
         predict, [
@@ -216,11 +197,11 @@ with gr.Blocks() as demo:
             top_p, 
             temperature, 
             history, 
-            modality_cache,
+            session,
         ], [
             chatbot, 
             history,
-            modality_cache,
+            session,
             image_output
         ],
         show_progress=True
@@ -233,7 +214,7 @@ with gr.Blocks() as demo:
         normal_img_path,
         chatbot, 
         history, 
-        modality_cache,
+        session,
         image_output
     ], show_progress=True)
 